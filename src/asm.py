@@ -0,0 +1,631 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import re
+import struct
+from elf import Symbol, STT_FUNC, STT_OBJECT
+from state import RVState
+
+# Register numbers by architectural and ABI name
+REGISTERS = {f"x{i}": i for i in range(32)}
+REGISTERS.update({name: i for i, name in enumerate([
+    "zero", "ra", "sp", "gp", "tp", "t0", "t1", "t2", "s0", "s1", "a0", "a1", "a2", "a3", "a4", "a5",
+    "a6", "a7", "s2", "s3", "s4", "s5", "s6", "s7", "s8", "s9", "s10", "s11", "t3", "t4", "t5", "t6"])})
+REGISTERS["fp"] = 8
+
+# Format, opcode, funct3 and funct7 of every RV32IM instruction
+INSTRUCTIONS = {
+    "add":    ("R", 0b0110011, 0b000, 0b0000000),
+    "sub":    ("R", 0b0110011, 0b000, 0b0100000),
+    "sll":    ("R", 0b0110011, 0b001, 0b0000000),
+    "slt":    ("R", 0b0110011, 0b010, 0b0000000),
+    "sltu":   ("R", 0b0110011, 0b011, 0b0000000),
+    "xor":    ("R", 0b0110011, 0b100, 0b0000000),
+    "srl":    ("R", 0b0110011, 0b101, 0b0000000),
+    "sra":    ("R", 0b0110011, 0b101, 0b0100000),
+    "or":     ("R", 0b0110011, 0b110, 0b0000000),
+    "and":    ("R", 0b0110011, 0b111, 0b0000000),
+    "mul":    ("R", 0b0110011, 0b000, 0b0000001),
+    "mulh":   ("R", 0b0110011, 0b001, 0b0000001),
+    "mulhsu": ("R", 0b0110011, 0b010, 0b0000001),
+    "mulhu":  ("R", 0b0110011, 0b011, 0b0000001),
+    "div":    ("R", 0b0110011, 0b100, 0b0000001),
+    "divu":   ("R", 0b0110011, 0b101, 0b0000001),
+    "rem":    ("R", 0b0110011, 0b110, 0b0000001),
+    "remu":   ("R", 0b0110011, 0b111, 0b0000001),
+    "addi":   ("I", 0b0010011, 0b000, 0),
+    "slti":   ("I", 0b0010011, 0b010, 0),
+    "sltiu":  ("I", 0b0010011, 0b011, 0),
+    "xori":   ("I", 0b0010011, 0b100, 0),
+    "ori":    ("I", 0b0010011, 0b110, 0),
+    "andi":   ("I", 0b0010011, 0b111, 0),
+    "slli":   ("SH", 0b0010011, 0b001, 0b0000000),
+    "srli":   ("SH", 0b0010011, 0b101, 0b0000000),
+    "srai":   ("SH", 0b0010011, 0b101, 0b0100000),
+    "lb":     ("L", 0b0000011, 0b000, 0),
+    "lh":     ("L", 0b0000011, 0b001, 0),
+    "lw":     ("L", 0b0000011, 0b010, 0),
+    "lbu":    ("L", 0b0000011, 0b100, 0),
+    "lhu":    ("L", 0b0000011, 0b101, 0),
+    "sb":     ("S", 0b0100011, 0b000, 0),
+    "sh":     ("S", 0b0100011, 0b001, 0),
+    "sw":     ("S", 0b0100011, 0b010, 0),
+    "beq":    ("B", 0b1100011, 0b000, 0),
+    "bne":    ("B", 0b1100011, 0b001, 0),
+    "blt":    ("B", 0b1100011, 0b100, 0),
+    "bge":    ("B", 0b1100011, 0b101, 0),
+    "bltu":   ("B", 0b1100011, 0b110, 0),
+    "bgeu":   ("B", 0b1100011, 0b111, 0),
+    "jal":    ("J", 0b1101111, 0, 0),
+    "jalr":   ("JR", 0b1100111, 0b000, 0),
+    "lui":    ("U", 0b0110111, 0, 0),
+    "auipc":  ("U", 0b0010111, 0, 0),
+    "ecall":  ("SYS", 0b1110011, 0b000, 0),
+    "ebreak": ("SYS", 0b1110011, 0b000, 1),
+    "fence":  ("SYS", 0b0001111, 0b000, 0x0FF),
+}
+
+# Pseudo-instructions that expand to two instructions
+DOUBLE = {"la", "call", "tail"}
+
+# Branches with swapped operands and branches against zero
+SWAPPED = {"bgt": "blt", "ble": "bge", "bgtu": "bltu", "bleu": "bgeu"}
+AGAINST_ZERO = {"beqz": ("beq", False), "bnez": ("bne", False), "bltz": ("blt", False), "bgez": ("bge", False),
+                "bgtz": ("blt", True), "blez": ("bge", True)}
+
+# Instructions whose encoding depends on their own address, by the kind of their offset field:
+# "B" for the branch immediate, "J" for the jump immediate and "HI_LO" for an auipc and the
+# 12-bit immediate of the following instruction. Their last operand is the target.
+PC_RELATIVE = {"jal": "J", "j": "J", "la": "HI_LO", "call": "HI_LO", "tail": "HI_LO"}
+PC_RELATIVE.update({m: "B" for m in (*SWAPPED, *AGAINST_ZERO)})
+PC_RELATIVE.update({m: "B" for m, (format, *_) in INSTRUCTIONS.items() if format == "B"})
+
+LABEL = re.compile(r"\s*([A-Za-z_.$][\w.$]*)\s*:")
+# Numeric local labels like 1:, referenced as 1b (backward) or 1f (forward)
+LOCAL_LABEL = re.compile(r"\s*(\d+)\s*:")
+LOCAL_REFERENCE = re.compile(r"\b(\d+)([bf])\b")
+MEMORY_OPERAND = re.compile(r"(.*)\(\s*(\w+)\s*\)$")
+RELOCATION = re.compile(r"%(hi|lo)\((.+)\)$")
+
+def fits12(value: int) -> bool:
+    return -2048 <= value < 2048
+
+def split_hi_lo(value: int) -> tuple[int, int]:
+    """
+    Splits a 32-bit value into the upper immediate of a lui or auipc and
+    the signed 12-bit immediate of the following addi, load or jalr.
+    """
+    value &= 0xFFFFFFFF
+    low = (value & 0xFFF) - ((value & 0x800) << 1)
+    return ((value - low) >> 12) & 0xFFFFF, low
+
+class Assembly:
+    """
+    The output of the assembler: a memory image and its symbols.
+
+    Attributes:
+        text_address (int): Address of the first instruction and of the image.
+        data_address (int): Address of the data section.
+        image (bytes): The code and data, to be loaded at text_address.
+        symbols (dict[str, int]): Address of every label.
+        entry (int): Address where execution starts.
+        text_size (int): Size of the code in bytes.
+    """
+    text_address: int
+    data_address: int
+    image:        bytes
+    symbols:      dict[str, int]
+    entry:        int
+    text_size:    int
+
+    def __init__(self, text_address: int, data_address: int, image: bytes, symbols: dict[str, int],
+                 entry: int, text_size: int) -> None:
+        self.text_address = text_address
+        self.data_address = data_address
+        self.image = image
+        self.symbols = symbols
+        self.entry = entry
+        self.text_size = text_size
+
+    def load(self, state: RVState) -> int:
+        """
+        Loads the image into the state.
+
+        Returns:
+            int: The entry address.
+        """
+        state.load_memory(self.text_address, self.image)
+        return self.entry
+
+    def symbol_table(self) -> list[Symbol]:
+        """
+        Returns the labels as ELF symbols, so that they can be used for reports
+        like coverage. Labels in the code are functions, labels in the data are
+        objects, and every symbol extends to the next label or the end of its section.
+        """
+        text_end = self.text_address + self.text_size
+        data_end = self.text_address + len(self.image)
+        labels = sorted(self.symbols.items(), key=lambda item: item[1])
+        table = []
+        for i, (name, address) in enumerate(labels):
+            in_text = address < text_end
+            end = text_end if in_text else data_end
+            if i + 1 < len(labels) and labels[i + 1][1] < end:
+                end = labels[i + 1][1]
+            table.append(Symbol(name, address, end - address, STT_FUNC if in_text else STT_OBJECT))
+        return table
+
+class Assembler:
+    """
+    Two-pass assembler for RV32IM programs.
+
+    Supported are all RV32I and M instructions, labels, the pseudo-instructions
+    nop, li, la, mv, not, neg, seqz, snez, j, jr, call, tail, ret and branches
+    against zero or with swapped operands, %hi()/%lo() relocations and the
+    directives .text, .data, .word, .half, .byte, .space, .align, .string
+    and .globl. The code starts at text_address, followed by the data section
+    at the next page. Execution starts at the first .globl label, _start, or
+    the first instruction.
+
+    Numeric local labels like 1: may be defined any number of times, and 1b
+    and 1f refer to the closest definition before and after the line.
+    They are not included in the symbols of the assembly.
+
+    The first pass only splits every line and computes addresses. li expands
+    to one instruction if its value is a literal that fits into 12 bits.
+    """
+
+    def __init__(self, text_address: int = 0) -> None:
+        self.text_address = text_address
+
+    def assemble(self, source: str) -> Assembly:
+        """
+        Assembles a program.
+
+        Parameters:
+            source (str): The assembly source.
+        Returns:
+            Assembly: The image and symbols.
+        Raises:
+            ValueError: If a line cannot be assembled, with its line number.
+        """
+        # Pass 1: collect instructions, data and label offsets per section
+        instructions = []   # (line, mnemonic, operands, offset)
+        data = bytearray()
+        data_fixups = []    # (line, expression, offset)
+        labels = {}         # name -> (in_text, offset)
+        local_labels = {}   # name of a definition of a numeric label -> (in_text, offset)
+        local_counts = {}   # numeric label -> number of definitions so far
+        sources = {}        # line -> operands as written, for lines that reference numeric labels
+        globals_ = []
+        in_text = True
+        text_size = 0
+
+        for number, line in enumerate(source.splitlines(), 1):
+            line = _strip_comment(line)
+            while ":" in line:
+                match = LABEL.match(line)
+                if match is not None:
+                    name = match.group(1)
+                    if name in labels:
+                        raise ValueError(f"Line {number}: label '{name}' is already defined")
+                    labels[name] = (in_text, text_size if in_text else len(data))
+                else:
+                    match = LOCAL_LABEL.match(line)
+                    if match is None:
+                        break
+                    local = match.group(1)
+                    local_counts[local] = count = local_counts.get(local, 0) + 1
+                    local_labels[_local_name(local, count)] = (in_text, text_size if in_text else len(data))
+                line = line[match.end():]
+            parts = line.split(None, 1)
+            if not parts:
+                continue
+            mnemonic = parts[0].lower()
+            rest = parts[1].strip() if len(parts) > 1 else ""
+            if ("b" in rest or "f" in rest) and mnemonic not in (".string", ".asciz"):
+                # Replace references to numeric labels with the name of the definition they refer to,
+                # and keep the line as written for error messages
+                sources[number] = rest
+                rest = LOCAL_REFERENCE.sub(lambda m: _local_name(m.group(1), local_counts.get(m.group(1), 0)
+                                                                 + (m.group(2) == "f")), rest)
+
+            if mnemonic[0] == ".":
+                operands = _split_operands(rest)
+                try:
+                    if mnemonic == ".text":
+                        in_text = True
+                    elif mnemonic == ".data":
+                        in_text = False
+                    elif mnemonic in (".globl", ".global"):
+                        globals_.extend(operands)
+                    elif mnemonic in (".word", ".half", ".byte"):
+                        if in_text:
+                            raise ValueError(f"{mnemonic} is only supported in the data section")
+                        size = {".word": 4, ".half": 2, ".byte": 1}[mnemonic]
+                        for operand in operands:
+                            if size == 4 and not _is_literal(operand):
+                                data_fixups.append((number, operand, len(data)))
+                                data += bytes(4)
+                            else:
+                                data += (int(operand, 0) & ((1 << 8 * size) - 1)).to_bytes(size, "little")
+                    elif mnemonic == ".space" or mnemonic == ".zero":
+                        if in_text:
+                            raise ValueError(f"{mnemonic} is only supported in the data section")
+                        data += bytes(int(operands[0], 0))
+                    elif mnemonic == ".align":
+                        alignment = 1 << int(operands[0], 0)
+                        if in_text:
+                            while text_size % alignment:
+                                instructions.append((number, "addi", ["x0", "x0", "0"], text_size))
+                                text_size += 4
+                        else:
+                            data += bytes(-len(data) % alignment)
+                    elif mnemonic in (".string", ".asciz"):
+                        if in_text:
+                            raise ValueError(f"{mnemonic} is only supported in the data section")
+                        text = rest
+                        if len(text) < 2 or text[0] != '"' or text[-1] != '"':
+                            raise ValueError(f"{mnemonic} expects a quoted string")
+                        data += text[1:-1].encode().decode("unicode_escape").encode("latin-1") + b"\0"
+                    else:
+                        raise ValueError(f"Unknown directive {mnemonic}")
+                except (IndexError, ValueError) as e:
+                    raise ValueError(f"Line {number}: {e}") from None
+                continue
+
+            if not in_text:
+                raise ValueError(f"Line {number}: instruction '{mnemonic}' in the data section")
+            instructions.append((number, mnemonic, rest, text_size))
+            if mnemonic in DOUBLE or (mnemonic == "li" and not _li_fits12(_split_operands(rest))):
+                text_size += 8
+            else:
+                text_size += 4
+
+        # Place the data section on the page after the code and resolve the labels
+        data_address = (self.text_address + text_size + 0xFFF) & ~0xFFF
+        symbols = {name: (self.text_address if text else data_address) + offset
+                   for name, (text, offset) in labels.items()}
+        resolved = dict(symbols)
+        resolved.update({name: (self.text_address if text else data_address) + offset
+                         for name, (text, offset) in local_labels.items()})
+
+        # Pass 2: encode the instructions
+        words = []
+        encode = _Encoder(resolved)
+        for number, mnemonic, operands, offset in instructions:
+            try:
+                words.extend(encode.instruction(mnemonic, operands, self.text_address + offset))
+            except (KeyError, IndexError, ValueError) as e:
+                if isinstance(e, KeyError):
+                    name = str(e.args[0])
+                    message = f"Unknown symbol '{name}'" if "^" not in name \
+                        else f"Undefined numeric label '{name.partition('^')[0]}'"
+                elif isinstance(e, IndexError) or str(e).startswith(("not enough", "too many")):
+                    message = f"Wrong number of operands for '{mnemonic}'"
+                else:
+                    message = str(e)
+                raise ValueError(f"Line {number}: {message} in '{mnemonic} {sources.get(number, operands)}'") from None
+
+        for number, expression, offset in data_fixups:
+            try:
+                data[offset:offset + 4] = (encode.value(expression) & 0xFFFFFFFF).to_bytes(4, "little")
+            except (KeyError, ValueError):
+                raise ValueError(f"Line {number}: cannot resolve '{sources.get(number, expression)}'") from None
+
+        code = struct.pack(f"<{len(words)}I", *words)
+        image = code
+        if data:
+            image += bytes(data_address - self.text_address - len(code)) + bytes(data)
+
+        entry = self.text_address
+        for name in globals_ + ["_start"]:
+            if name in symbols:
+                entry = symbols[name]
+                break
+        return Assembly(self.text_address, data_address, image, symbols, entry, text_size)
+
+def _local_name(label: str, count: int) -> str:
+    """
+    Returns the symbol name of the count-th definition of a numeric local label.
+    """
+    return f"{label}^{count}"
+
+def _strip_comment(line: str) -> str:
+    """
+    Removes a comment from a line. A # inside a quoted literal, like in .string "a#b", does not start one.
+    """
+    comment = line.find("#")
+    if comment < 0:
+        return line
+    if '"' not in line[:comment] and "'" not in line[:comment]:
+        return line[:comment]
+    quote = None
+    escaped = False
+    for i, char in enumerate(line):
+        if escaped:
+            escaped = False
+        elif quote is not None:
+            if char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char == "#":
+            return line[:i]
+    return line
+
+def _split_operands(operands: str) -> list[str]:
+    return operands.replace(" ", "").replace("\t", "").split(",") if operands else []
+
+def _li_fits12(operands: list[str]) -> bool:
+    """
+    Checks whether a li expands to a single addi: its value must be a literal that fits into 12 bits.
+    """
+    return len(operands) == 2 and _is_literal(operands[1]) and fits12(int(operands[1], 0))
+
+def _is_literal(operand: str) -> bool:
+    try:
+        int(operand, 0)
+        return True
+    except ValueError:
+        return False
+
+class _Encoder:
+    """
+    Encodes single instructions and pseudo-instructions once all symbols are known.
+
+    Lines that do not depend on their address are encoded once and then
+    looked up, since generated kernels repeat the same lines many times.
+    Branches, jumps, la, call and tail are encoded once without their target,
+    and only the offset to the target is computed for every line.
+    """
+
+    def __init__(self, symbols: dict[str, int]) -> None:
+        self.symbols = symbols
+        self.cache = {}
+        self.formats = {"R": self.encode_r, "I": self.encode_i, "SH": self.encode_shift, "L": self.encode_load,
+                        "S": self.encode_store, "B": self.encode_branch, "J": self.encode_jal,
+                        "JR": self.encode_jalr, "U": self.encode_upper, "SYS": self.encode_system}
+
+    def value(self, expression: str) -> int:
+        """
+        Evaluates a literal, a symbol, a symbol plus or minus a literal,
+        or a %hi()/%lo() relocation of one of these.
+        """
+        try:
+            return int(expression, 0)
+        except ValueError:
+            pass
+        match = RELOCATION.match(expression)
+        if match:
+            high, low = split_hi_lo(self.value(match.group(2)))
+            return high if match.group(1) == "hi" else low
+        for sign in ("+", "-"):
+            symbol, found, offset = expression.rpartition(sign)
+            if found and symbol:
+                offset = int(offset, 0)
+                return self.symbols[symbol.strip()] + (offset if sign == "+" else -offset)
+        return self.symbols[expression]
+
+    def target(self, expression: str, pc: int) -> int:
+        """
+        Returns the pc-relative offset of a branch or jump target, given as a label or a literal offset.
+        """
+        try:
+            return int(expression, 0)
+        except ValueError:
+            return self.value(expression) - pc
+
+    def instruction(self, mnemonic: str, operands: str, pc: int) -> list[int]:
+        """
+        Encodes an instruction or pseudo-instruction with its operands as written in the source.
+        """
+        kind = PC_RELATIVE.get(mnemonic)
+        if kind is None:
+            key = (mnemonic, operands)
+            words = self.cache.get(key)
+            if words is None:
+                words = self.cache[key] = self.expand(mnemonic, _split_operands(operands), pc)
+            return words
+
+        # Only the offset to the target depends on the address, so the rest of
+        # the line is encoded once with a zero offset and the offset is added
+        head, _, target = operands.rpartition(",")
+        key = (mnemonic, head)
+        words = self.cache.get(key)
+        if words is None:
+            words = self.cache[key] = self.expand(mnemonic, _split_operands(head) + ["0"], 0)
+        target = target.strip()
+        address = self.symbols.get(target)
+        if address is not None:
+            offset = address - pc
+        else:
+            target = "".join(target.split())
+            if not target:
+                raise IndexError("Missing target")
+            offset = self.value(target) - pc if mnemonic == "la" else self.target(target, pc)
+        return self.relocate(kind, words, offset)
+
+    @staticmethod
+    def relocate(kind: str, words: list[int], offset: int) -> list[int]:
+        """
+        Adds a pc-relative offset to the words of a line that were encoded with a zero offset.
+        """
+        if kind == "B":
+            return [words[0] | _branch_offset(offset)]
+        if kind == "J":
+            return [words[0] | _jump_offset(offset)]
+        high, low = split_hi_lo(offset)
+        return [words[0] | high << 12, words[1] | (low & 0xFFF) << 20]
+
+    def expand(self, mnemonic: str, operands: list[str], pc: int) -> list[int]:
+        if mnemonic in INSTRUCTIONS:
+            return [self.encode(mnemonic, operands, pc)]
+
+        # Expand the pseudo-instructions
+        n = len(operands)
+        if mnemonic == "nop":
+            return [self.encode("addi", ["x0", "x0", "0"], pc)]
+        if mnemonic == "li":
+            value = self.value(operands[1])
+            if _li_fits12(operands):
+                return [self.encode("addi", [operands[0], "x0", str(value)], pc)]
+            high, low = split_hi_lo(value)
+            return [self.encode("lui", [operands[0], str(high)], pc),
+                    self.encode("addi", [operands[0], operands[0], str(low)], pc + 4)]
+        if mnemonic == "la":
+            high, low = split_hi_lo(self.value(operands[1]) - pc)
+            return [self.encode("auipc", [operands[0], str(high)], pc),
+                    self.encode("addi", [operands[0], operands[0], str(low)], pc + 4)]
+        if mnemonic in ("call", "tail"):
+            link = "ra" if mnemonic == "call" else "x0"
+            scratch = "ra" if mnemonic == "call" else "t1"
+            high, low = split_hi_lo(self.target(operands[-1], pc))
+            return [self.encode("auipc", [scratch, str(high)], pc),
+                    self.encode("jalr", [link, f"{low}({scratch})"], pc + 4)]
+        if mnemonic == "mv":
+            return [self.encode("addi", [operands[0], operands[1], "0"], pc)]
+        if mnemonic == "not":
+            return [self.encode("xori", [operands[0], operands[1], "-1"], pc)]
+        if mnemonic == "neg":
+            return [self.encode("sub", [operands[0], "x0", operands[1]], pc)]
+        if mnemonic == "seqz":
+            return [self.encode("sltiu", [operands[0], operands[1], "1"], pc)]
+        if mnemonic == "snez":
+            return [self.encode("sltu", [operands[0], "x0", operands[1]], pc)]
+        if mnemonic == "j":
+            return [self.encode("jal", ["x0", operands[0]], pc)]
+        if mnemonic == "jr":
+            return [self.encode("jalr", ["x0", f"0({operands[0]})"], pc)]
+        if mnemonic == "ret" and n == 0:
+            return [self.encode("jalr", ["x0", "0(ra)"], pc)]
+        if mnemonic in SWAPPED:
+            return [self.encode(SWAPPED[mnemonic], [operands[1], operands[0], operands[2]], pc)]
+        if mnemonic in AGAINST_ZERO:
+            base, swap = AGAINST_ZERO[mnemonic]
+            pair = ["x0", operands[0]] if swap else [operands[0], "x0"]
+            return [self.encode(base, pair + [operands[1]], pc)]
+        raise ValueError(f"Unknown instruction '{mnemonic}'")
+
+    @staticmethod
+    def register(name: str) -> int:
+        try:
+            return REGISTERS[name]
+        except KeyError:
+            if name.lower() in REGISTERS:
+                return REGISTERS[name.lower()]
+            raise ValueError(f"Unknown register '{name}'") from None
+
+    def memory(self, operand: str) -> tuple[int, int]:
+        """
+        Parses a memory operand like -8(sp) into the base register and the offset.
+        """
+        match = MEMORY_OPERAND.match(operand)
+        if match is None:
+            raise ValueError(f"Expected a memory operand like 0(sp), got '{operand}'")
+        offset = match.group(1).strip()
+        return self.register(match.group(2)), self.value(offset) if offset else 0
+
+    def encode(self, mnemonic: str, operands: list[str], pc: int) -> int:
+        format, opcode, funct3, funct7 = INSTRUCTIONS[mnemonic]
+        return self.formats[format](operands, pc, opcode, funct3, funct7)
+
+    def encode_r(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rd, rs1, rs2 = operands
+        register = self.register
+        return opcode | register(rd) << 7 | funct3 << 12 | register(rs1) << 15 | register(rs2) << 20 \
+               | funct7 << 25
+
+    def encode_i(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rd, rs1, imm = operands
+        imm = self.value(imm)
+        _check(fits12(imm), f"Immediate {imm} does not fit into 12 bits")
+        return opcode | self.register(rd) << 7 | funct3 << 12 | self.register(rs1) << 15 | (imm & 0xFFF) << 20
+
+    def encode_shift(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rd, rs1, shamt = operands
+        shamt = self.value(shamt)
+        _check(0 <= shamt < 32, f"Shift amount {shamt} is out of range")
+        return opcode | self.register(rd) << 7 | funct3 << 12 | self.register(rs1) << 15 | shamt << 20 \
+               | funct7 << 25
+
+    def encode_load(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rd, address = operands
+        rs1, imm = self.memory(address)
+        _check(fits12(imm), f"Offset {imm} does not fit into 12 bits")
+        return opcode | self.register(rd) << 7 | funct3 << 12 | rs1 << 15 | (imm & 0xFFF) << 20
+
+    def encode_store(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rs2, address = operands
+        rs1, imm = self.memory(address)
+        _check(fits12(imm), f"Offset {imm} does not fit into 12 bits")
+        return opcode | (imm & 0x1F) << 7 | funct3 << 12 | rs1 << 15 | self.register(rs2) << 20 \
+               | (imm >> 5 & 0x7F) << 25
+
+    def encode_branch(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rs1, rs2, target = operands
+        return opcode | funct3 << 12 | self.register(rs1) << 15 | self.register(rs2) << 20 \
+               | _branch_offset(self.target(target, pc))
+
+    def encode_jal(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        # jal target / jal rd, target
+        _check(len(operands) in (1, 2), "Wrong number of operands for 'jal'")
+        rd = self.register(operands[0]) if len(operands) == 2 else 1
+        return opcode | rd << 7 | _jump_offset(self.target(operands[-1], pc))
+
+    def encode_jalr(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        # jalr rs1 / jalr rd, offset(rs1) / jalr rd, rs1, offset
+        n = len(operands)
+        _check(n in (1, 2, 3), "Wrong number of operands for 'jalr'")
+        if n == 1:
+            rd, rs1, imm = 1, self.register(operands[0]), 0
+        elif n == 2:
+            rd = self.register(operands[0])
+            rs1, imm = self.memory(operands[1])
+        else:
+            rd, rs1, imm = self.register(operands[0]), self.register(operands[1]), self.value(operands[2])
+        _check(fits12(imm), f"Offset {imm} does not fit into 12 bits")
+        return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | (imm & 0xFFF) << 20
+
+    def encode_upper(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        rd, imm = operands
+        imm = self.value(imm)
+        _check(-(1 << 19) <= imm < 1 << 20, f"Upper immediate {imm} does not fit into 20 bits")
+        return opcode | self.register(rd) << 7 | (imm & 0xFFFFF) << 12
+
+    def encode_system(self, operands: list[str], pc: int, opcode: int, funct3: int, funct7: int) -> int:
+        _check(not operands, "System instructions take no operands")
+        return opcode | funct3 << 12 | funct7 << 20
+
+def _branch_offset(imm: int) -> int:
+    """
+    Returns the immediate fields of a branch with the given offset.
+    """
+    _check(-4096 <= imm < 4096 and imm % 2 == 0, f"Branch offset {imm} is out of range")
+    return (imm >> 11 & 1) << 7 | (imm >> 1 & 0xF) << 8 | (imm >> 5 & 0x3F) << 25 | (imm >> 12 & 1) << 31
+
+def _jump_offset(imm: int) -> int:
+    """
+    Returns the immediate fields of a jal with the given offset.
+    """
+    _check(-(1 << 20) <= imm < 1 << 20 and imm % 2 == 0, f"Jump offset {imm} is out of range")
+    return (imm >> 12 & 0xFF) << 12 | (imm >> 11 & 1) << 20 | (imm >> 1 & 0x3FF) << 21 | (imm >> 20 & 1) << 31
+
+def _check(condition: bool, message: str) -> None:
+    if not condition:
+        raise ValueError(message)
+
+def assemble(source: str, text_address: int = 0) -> Assembly:
+    """
+    Assembles a program with the default settings.
+
+    Parameters:
+        source (str): The assembly source.
+        text_address (int): Address of the first instruction.
+    Returns:
+        Assembly: The image and symbols.
+    """
+    return Assembler(text_address).assemble(source)
@@ -0,0 +1,398 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import numpy as np
+from elf import Symbol
+from extensions.rv32i import LOADS, STORES
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from nums import u8, u32
+from state import RVState
+from vm import VM
+
+# Kinds of memory accesses in a trace
+FETCH = 0
+LOAD  = 1
+STORE = 2
+
+class CacheConfig:
+    """
+    Geometry and timing of a single cache.
+
+    Attributes:
+        size (int): Capacity in bytes.
+        ways (int): Associativity.
+        line_size (int): Line size in bytes.
+        replacement (str): Replacement policy, "lru" or "plru" (tree pseudo-LRU).
+        latency (int): Cycles to access this cache, charged to the level above on a miss.
+    """
+    size:        int
+    ways:        int
+    line_size:   int
+    replacement: str
+    latency:     int
+
+    def __init__(self, size: int, ways: int, line_size: int = 64, replacement: str = "lru",
+                 latency: int = 1) -> None:
+        sets = size // (ways * line_size) if ways > 0 and line_size > 0 else 0
+        if sets <= 0 or sets * ways * line_size != size:
+            raise ValueError(f"Cache size {size} is not a multiple of {ways} ways x {line_size} byte lines")
+        for name, value in (("sets", sets), ("line size", line_size)):
+            if value & (value - 1):
+                raise ValueError(f"Number of {name} must be a power of two, got {value}")
+        if replacement not in ("lru", "plru"):
+            raise ValueError(f"Unknown replacement policy '{replacement}'")
+        if replacement == "plru" and ways & (ways - 1):
+            raise ValueError(f"Tree PLRU requires a power of two ways, got {ways}")
+        self.size = size
+        self.ways = ways
+        self.line_size = line_size
+        self.replacement = replacement
+        self.latency = latency
+
+    @property
+    def sets(self) -> int:
+        return self.size // (self.ways * self.line_size)
+
+class Cache:
+    """
+    A set-associative cache with write-allocate and no write-back cost.
+
+    Accesses are simulated in batches. Since the sets are independent,
+    a batch is split by set and the n-th access of every set is simulated
+    in the same vectorized round, so the number of Python-level iterations
+    is the largest number of accesses to a single set, not the batch size.
+
+    Attributes:
+        config (CacheConfig): Geometry and timing of the cache.
+        tags (np.ndarray[int64]): Line number held by every way, -1 if invalid.
+        stamps (np.ndarray[int64]): Last use of every way (LRU only).
+        tree (np.ndarray[u8]): PLRU tree bits of every set (PLRU only).
+        accesses (int): Number of simulated accesses.
+        hits (int): Number of hits.
+    """
+    config:   CacheConfig
+    tags:     np.ndarray
+    stamps:   np.ndarray
+    tree:     np.ndarray
+    accesses: int
+    hits:     int
+
+    def __init__(self, config: CacheConfig) -> None:
+        self.config = config
+        self.line_bits = config.line_size.bit_length() - 1
+        self.set_mask = config.sets - 1
+        self.levels = config.ways.bit_length() - 1
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Invalidates all lines and clears the statistics.
+        """
+        sets, ways = self.config.sets, self.config.ways
+        self.tags = np.full((sets, ways), -1, dtype=np.int64)
+        self.stamps = np.full((sets, ways), -1, dtype=np.int64)
+        self.tree = np.zeros((sets, max(ways - 1, 1)), dtype=u8)
+        self.clock = 0
+        self.accesses = 0
+        self.hits = 0
+
+    @property
+    def misses(self) -> int:
+        return self.accesses - self.hits
+
+    def access(self, addresses: np.ndarray) -> np.ndarray[bool]:
+        """
+        Simulates a batch of accesses in program order.
+
+        Parameters:
+            addresses (np.ndarray): Byte addresses of the accesses.
+        Returns:
+            np.ndarray[bool]: Whether each access hit.
+        """
+        lines = addresses.astype(np.int64) >> self.line_bits
+        sets = lines & self.set_mask
+        hits = np.zeros(lines.size, dtype=bool)
+        self.accesses += lines.size
+        if lines.size == 0:
+            return hits
+
+        # Group the accesses by set, keeping program order within a set
+        order = np.argsort(sets, kind="stable")
+        sorted_sets, sorted_lines = sets[order], lines[order]
+
+        # Repeated accesses to the line a set just used hit without changing its state
+        repeat = np.zeros(order.size, dtype=bool)
+        repeat[1:] = (sorted_sets[1:] == sorted_sets[:-1]) & (sorted_lines[1:] == sorted_lines[:-1])
+        hits[order[repeat]] = True
+        order, sorted_sets, sorted_lines = order[~repeat], sorted_sets[~repeat], sorted_lines[~repeat]
+
+        # Rank of every access within its set
+        index = np.arange(order.size)
+        first = np.ones(order.size, dtype=bool)
+        first[1:] = sorted_sets[1:] != sorted_sets[:-1]
+        rank = index - np.maximum.accumulate(np.where(first, index, 0))
+
+        # Simulate one access per set and round
+        by_rank = np.argsort(rank, kind="stable")
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2))
+        for r in range(bounds.size - 1):
+            selected = by_rank[bounds[r]:bounds[r + 1]]
+            hits[order[selected]] = self._round(sorted_sets[selected], sorted_lines[selected])
+
+        self.hits += int(hits.sum())
+        return hits
+
+    def _round(self, sets: np.ndarray, lines: np.ndarray) -> np.ndarray[bool]:
+        """
+        Simulates one access to each of the given distinct sets.
+        """
+        match = self.tags[sets] == lines[:, None]
+        hit = match.any(axis=1)
+        way = np.where(hit, match.argmax(axis=1), self._victims(sets))
+        self.tags[sets, way] = lines
+        self._touch(sets, way)
+        return hit
+
+    def _victims(self, sets: np.ndarray) -> np.ndarray:
+        if self.config.replacement == "lru":
+            # Invalid ways have the smallest stamp and are filled first
+            return self.stamps[sets].argmin(axis=1)
+
+        # Follow the tree bits from the root to the pseudo least recently used way
+        node = np.zeros(sets.size, dtype=np.int64)
+        for _ in range(self.levels):
+            node = 2 * node + 1 + self.tree[sets, node]
+        victim = node - (self.config.ways - 1)
+
+        invalid = self.tags[sets] < 0
+        return np.where(invalid.any(axis=1), invalid.argmax(axis=1), victim)
+
+    def _touch(self, sets: np.ndarray, way: np.ndarray) -> None:
+        if self.config.replacement == "lru":
+            self.clock += 1
+            self.stamps[sets, way] = self.clock
+            return
+
+        # Point every tree node on the path away from the used way
+        node = np.zeros(sets.size, dtype=np.int64)
+        for level in range(self.levels - 1, -1, -1):
+            direction = (way >> level) & 1
+            self.tree[sets, node] = 1 - direction
+            node = 2 * node + 1 + direction
+
+    def stats(self) -> dict:
+        return {
+            "accesses": self.accesses,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / self.accesses if self.accesses else 0.0,
+        }
+
+class CacheHierarchy:
+    """
+    Split L1 instruction and data caches backed by a unified L2.
+
+    Stall cycles are charged to the instruction that caused the access:
+    an L1 miss costs the L2 latency and an L2 miss additionally costs the
+    memory latency. L1 hits are assumed to be covered by the pipeline.
+
+    Attributes:
+        l1i (Cache): The L1 instruction cache.
+        l1d (Cache): The L1 data cache.
+        l2 (Cache): The unified L2 cache.
+        memory_latency (int): Cycles to access main memory.
+        stalls (dict[int, int]): Stall cycles per instruction address.
+        misses (dict[int, int]): L1 misses per instruction address.
+    """
+    l1i:            Cache
+    l1d:            Cache
+    l2:             Cache
+    memory_latency: int
+    stalls:         dict[int, int]
+    misses:         dict[int, int]
+
+    def __init__(self, l1i: CacheConfig | None = None, l1d: CacheConfig | None = None,
+                 l2: CacheConfig | None = None, memory_latency: int = 100) -> None:
+        """
+        Initializes the hierarchy. The defaults resemble a small in-order core.
+
+        Parameters:
+            l1i (CacheConfig | None): L1 instruction cache, default 16 KiB 4-way.
+            l1d (CacheConfig | None): L1 data cache, default 16 KiB 4-way.
+            l2 (CacheConfig | None): L2 cache, default 256 KiB 8-way with 12 cycles latency.
+            memory_latency (int): Cycles to access main memory.
+        """
+        self.l1i = Cache(l1i or CacheConfig(16 * 1024, 4))
+        self.l1d = Cache(l1d or CacheConfig(16 * 1024, 4))
+        self.l2 = Cache(l2 or CacheConfig(256 * 1024, 8, latency=12))
+        self.memory_latency = memory_latency
+        self.stalls = {}
+        self.misses = {}
+
+    def simulate(self, kinds: np.ndarray[u8], pcs: np.ndarray[u32], addresses: np.ndarray[u32]) -> None:
+        """
+        Simulates a batch of traced accesses in program order.
+
+        Parameters:
+            kinds (np.ndarray[u8]): FETCH, LOAD or STORE for every access.
+            pcs (np.ndarray[u32]): Address of the instruction that caused every access.
+            addresses (np.ndarray[u32]): Accessed addresses.
+        """
+        fetch = kinds == FETCH
+        l1_hit = np.empty(kinds.size, dtype=bool)
+        l1_hit[fetch] = self.l1i.access(addresses[fetch])
+        l1_hit[~fetch] = self.l1d.access(addresses[~fetch])
+
+        # Only the L1 misses reach the L2, still in program order
+        l1_miss = np.flatnonzero(~l1_hit)
+        l2_hit = self.l2.access(addresses[l1_miss])
+        stall = np.where(l2_hit, self.l2.config.latency, self.l2.config.latency + self.memory_latency)
+
+        # Accumulate per instruction address
+        miss_pcs, inverse = np.unique(pcs[l1_miss], return_inverse=True)
+        stall_sums = np.bincount(inverse, weights=stall, minlength=miss_pcs.size)
+        miss_counts = np.bincount(inverse, minlength=miss_pcs.size)
+        for pc, cycles, count in zip(miss_pcs.tolist(), stall_sums.tolist(), miss_counts.tolist()):
+            self.stalls[pc] = self.stalls.get(pc, 0) + int(cycles)
+            self.misses[pc] = self.misses.get(pc, 0) + count
+
+    def report(self, symbols: list[Symbol] | None = None) -> dict:
+        """
+        Summarizes the simulation.
+
+        Parameters:
+            symbols (list[Symbol] | None): Symbols used to attribute stalls to functions.
+                Without function symbols the stalls are reported per instruction address.
+        Returns:
+            dict: Statistics of every cache and the stall cycles per function,
+                sorted by stall cycles in descending order.
+        """
+        functions = sorted((s for s in symbols or [] if s.is_function), key=lambda s: s.address)
+        starts = np.array([s.address for s in functions], dtype=np.int64)
+
+        per_function = {}
+        for pc, cycles in self.stalls.items():
+            i = int(np.searchsorted(starts, pc, side="right")) - 1
+            if i >= 0 and (functions[i].size == 0 or pc < functions[i].address + functions[i].size):
+                name = functions[i].name
+            else:
+                name = f"{pc:#010x}"
+            entry = per_function.setdefault(name, {"name": name, "l1_misses": 0, "stall_cycles": 0})
+            entry["l1_misses"] += self.misses[pc]
+            entry["stall_cycles"] += cycles
+
+        return {
+            "l1i": self.l1i.stats(),
+            "l1d": self.l1d.stats(),
+            "l2": self.l2.stats(),
+            "stall_cycles": sum(self.stalls.values()),
+            "functions": sorted(per_function.values(), key=lambda f: f["stall_cycles"], reverse=True),
+        }
+
+class FetchTracer(ImplWrapper):
+    """
+    Records the instruction fetch of every executed instruction.
+    """
+
+    def __init__(self, impl: InstructionImpl, trace: "CacheTracer") -> None:
+        super().__init__(impl)
+        self.trace = trace
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        self.trace.record(FETCH, pc, pc)
+        self.impl.execute(state, instruction)
+
+class MemoryTracer(FetchTracer):
+    """
+    Records the instruction fetch and the data access of a load or store.
+    """
+
+    def __init__(self, impl: InstructionImpl, trace: "CacheTracer", kind: int) -> None:
+        super().__init__(impl, trace)
+        self.kind = kind
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        imm = instruction.imm_i if self.kind == LOAD else instruction.imm_s
+        address = (int(state.rf[instruction.rs1]) + int(imm)) & 0xFFFFFFFF
+        self.trace.record(FETCH, pc, pc)
+        self.trace.record(self.kind, pc, address)
+        self.impl.execute(state, instruction)
+
+class CacheTracer:
+    """
+    Feeds the instruction fetches and data accesses of a VM into a cache hierarchy.
+
+    Accesses are appended to preallocated NumPy buffers and simulated
+    whenever the buffers are full, or when flush() is called.
+    Only the scalar loads and stores of RV32I are traced as data accesses.
+
+    Attributes:
+        vm (VM): The traced VM.
+        hierarchy (CacheHierarchy): The simulated caches.
+        batch_size (int): Number of accesses per simulated batch.
+    """
+
+    def __init__(self, vm: VM, hierarchy: CacheHierarchy | None = None, batch_size: int = 1 << 16) -> None:
+        """
+        Initializes the tracer and instruments the VM.
+        """
+        self.vm = vm
+        self.hierarchy = hierarchy or CacheHierarchy()
+        self.batch_size = batch_size
+        self._kinds = np.zeros(batch_size, dtype=u8)
+        self._pcs = np.zeros(batch_size, dtype=u32)
+        self._addresses = np.zeros(batch_size, dtype=u32)
+        self._position = 0
+
+        impls = vm.instruction_implementations
+        self._original = list(impls)
+        for i, impl in enumerate(impls):
+            base = unwrap(impl)
+            if isinstance(base, LOADS):
+                impls[i] = MemoryTracer(impl, self, LOAD)
+            elif isinstance(base, STORES):
+                impls[i] = MemoryTracer(impl, self, STORE)
+            else:
+                impls[i] = FetchTracer(impl, self)
+        vm.flush_decode_cache()
+
+    def record(self, kind: int, pc: int, address: int) -> None:
+        """
+        Appends an access to the trace buffers.
+        """
+        position = self._position
+        if position == self.batch_size:
+            self.flush()
+            position = 0
+        self._kinds[position] = kind
+        self._pcs[position] = pc
+        self._addresses[position] = address
+        self._position = position + 1
+
+    def flush(self) -> None:
+        """
+        Simulates all buffered accesses.
+        """
+        n = self._position
+        if n:
+            self.hierarchy.simulate(self._kinds[:n], self._pcs[:n], self._addresses[:n])
+        self._position = 0
+
+    def detach(self) -> None:
+        """
+        Simulates the remaining accesses and removes the instrumentation from the VM.
+        """
+        self.flush()
+        self.vm.instruction_implementations[:] = self._original
+        self.vm.flush_decode_cache()
+
+    def report(self, symbols: list[Symbol] | None = None) -> dict:
+        """
+        Simulates the remaining accesses and returns the report of the hierarchy.
+        """
+        self.flush()
+        return self.hierarchy.report(symbols)
@@ -0,0 +1,264 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import json
+import numpy as np
+from elf import Symbol
+from nums import u8, u32
+from vm import VM, BRANCH_OPCODE
+
+class Coverage:
+    """
+    Code coverage of an address range, stored as packed bitmaps with one
+    bit per instruction slot, i.e. slot (pc - base) >> 2.
+
+    Attributes:
+        base (int): The first address of the covered range.
+        slots (int): The number of instruction slots in the range.
+        executed (np.ndarray[u8]): Packed bitmap of executed instructions.
+        taken (np.ndarray[u8]): Packed bitmap of branches that were taken.
+        not_taken (np.ndarray[u8]): Packed bitmap of branches that fell through.
+        branches (np.ndarray[u8]): Packed bitmap of the branch instructions in the range.
+    """
+    base:      int
+    slots:     int
+    executed:  np.ndarray[u8]
+    taken:     np.ndarray[u8]
+    not_taken: np.ndarray[u8]
+    branches:  np.ndarray[u8]
+
+    def __init__(self, base: int, slots: int, executed: np.ndarray[u8], taken: np.ndarray[u8],
+                 not_taken: np.ndarray[u8], branches: np.ndarray[u8]) -> None:
+        self.base = base
+        self.slots = slots
+        self.executed = executed
+        self.taken = taken
+        self.not_taken = not_taken
+        self.branches = branches
+
+    @staticmethod
+    def merge(coverages: list["Coverage"]) -> "Coverage":
+        """
+        Merges the coverage of several runs over the same address range.
+
+        Parameters:
+            coverages (list[Coverage]): The coverages to merge.
+        Returns:
+            Coverage: The union of all coverages.
+        """
+        if not coverages:
+            raise ValueError("Cannot merge an empty list of coverages")
+        first = coverages[0]
+        if any(c.base != first.base or c.slots != first.slots for c in coverages):
+            raise ValueError("Cannot merge coverages of different address ranges")
+
+        def union(field: str) -> np.ndarray[u8]:
+            return np.bitwise_or.reduce(np.stack([getattr(c, field) for c in coverages]), axis=0)
+
+        return Coverage(first.base, first.slots, union("executed"), union("taken"),
+                        union("not_taken"), union("branches"))
+
+    def save(self, path: str) -> None:
+        """
+        Saves the coverage to a compressed NumPy archive.
+        """
+        np.savez_compressed(path, base=self.base, slots=self.slots, executed=self.executed,
+                            taken=self.taken, not_taken=self.not_taken, branches=self.branches)
+
+    @staticmethod
+    def load(path: str) -> "Coverage":
+        """
+        Loads a coverage saved with save().
+        """
+        with np.load(path) as f:
+            return Coverage(int(f["base"]), int(f["slots"]), f["executed"], f["taken"],
+                            f["not_taken"], f["branches"])
+
+    def _unpack(self, bits: np.ndarray[u8]) -> np.ndarray[bool]:
+        return np.unpackbits(bits, count=self.slots).astype(bool)
+
+    def functions(self, symbols: list[Symbol] | None = None) -> list[dict]:
+        """
+        Summarizes the coverage per function.
+
+        Parameters:
+            symbols (list[Symbol] | None): Symbols of the image, e.g. from elf.read_symbols().
+                Without function symbols the whole range is reported as one function.
+        Returns:
+            list[dict]: One summary per function inside the covered range.
+        """
+        end = self.base + self.slots * 4
+        functions = [(s.name, s.address, s.address + s.size) for s in symbols or []
+                     if s.is_function and s.size > 0 and self.base <= s.address < end]
+        if not functions:
+            functions = [("<image>", self.base, end)]
+
+        executed = self._unpack(self.executed)
+        taken = self._unpack(self.taken)
+        not_taken = self._unpack(self.not_taken)
+        branches = self._unpack(self.branches)
+
+        summaries = []
+        for name, start, stop in functions:
+            first = (start - self.base) >> 2
+            last = min((stop - self.base + 3) >> 2, self.slots)
+            summaries.append({
+                "name": name,
+                "start": start,
+                "end": stop,
+                "instructions": int(last - first),
+                "executed": int(executed[first:last].sum()),
+                "branches": int(branches[first:last].sum()),
+                "taken": int(taken[first:last].sum()),
+                "not_taken": int(not_taken[first:last].sum()),
+            })
+        return summaries
+
+    def to_json(self, symbols: list[Symbol] | None = None) -> str:
+        """
+        Exports the per-function coverage as JSON.
+        """
+        return json.dumps({
+            "base": self.base,
+            "slots": self.slots,
+            "functions": self.functions(symbols),
+        }, indent=2)
+
+    def to_lcov(self, source: str, symbols: list[Symbol] | None = None) -> str:
+        """
+        Exports the coverage in lcov tracefile format.
+
+        Without debug information there are no source lines, so instruction
+        addresses are used as line numbers.
+
+        Parameters:
+            source (str): Name to report as the source file, e.g. the program path.
+            symbols (list[Symbol] | None): Symbols of the image.
+        Returns:
+            str: The lcov tracefile.
+        """
+        executed = self._unpack(self.executed)
+        taken = self._unpack(self.taken)
+        not_taken = self._unpack(self.not_taken)
+        branches = self._unpack(self.branches)
+
+        lines = ["TN:", f"SF:{source}"]
+        functions = self.functions(symbols)
+        for f in functions:
+            lines.append(f"FN:{f['start']},{f['name']}")
+        for f in functions:
+            first = (f["start"] - self.base) >> 2
+            lines.append(f"FNDA:{int(executed[first]) if first < self.slots else 0},{f['name']}")
+        lines.append(f"FNF:{len(functions)}")
+        lines.append(f"FNH:{sum(1 for f in functions if f['executed'])}")
+
+        for slot in np.flatnonzero(branches):
+            address = self.base + int(slot) * 4
+            for direction, bits in enumerate((taken, not_taken)):
+                count = int(bits[slot]) if executed[slot] else "-"
+                lines.append(f"BRDA:{address},0,{direction},{count}")
+        lines.append(f"BRF:{int(branches.sum()) * 2}")
+        lines.append(f"BRH:{int((taken & branches).sum() + (not_taken & branches).sum())}")
+
+        for slot in range(self.slots):
+            lines.append(f"DA:{self.base + slot * 4},{int(executed[slot])}")
+        lines.append(f"LF:{self.slots}")
+        lines.append(f"LH:{int(executed.sum())}")
+        lines.append("end_of_record")
+        return "\n".join(lines) + "\n"
+
+class CoverageCollector:
+    """
+    Collects the executed instructions and branch directions of a VM
+    for an address range, usually the text segment of the program.
+
+    No instruction is wrapped while collecting: the engines pass the range
+    of every executed block and the address it continued at to mark(), and
+    compiled regions do so once per block and direction of a run, so hot
+    loops stay compiled and spin loops are still fast-forwarded. The bitmaps
+    are plain bytearrays during the run and are packed when coverage() is called.
+
+    Attributes:
+        vm (VM): The observed VM.
+        base (int): The first address of the covered range.
+        slots (int): The number of instruction slots in the range.
+    """
+    vm:    VM
+    base:  int
+    slots: int
+
+    def __init__(self, vm: VM, base: int, size: int) -> None:
+        """
+        Initializes the collector and attaches it to the VM.
+
+        Parameters:
+            vm (VM): The VM to observe.
+            base (int): The first address of the covered range.
+            size (int): The size of the covered range in bytes.
+        Raises:
+            ValueError: If the range is out of bounds.
+            RuntimeError: If another collector is attached to the VM.
+        """
+        if base < 0 or size <= 0 or base + size > vm.state.mem.size:
+            raise ValueError(f"Coverage range out of bounds: {base} + {size} exceeds memory size")
+        if vm.coverage is not None:
+            raise RuntimeError("Another coverage collector is attached to the VM")
+
+        self.vm = vm
+        self.base = base
+        self.slots = (size + 3) >> 2
+        self._executed = bytearray(self.slots)
+        self._taken = bytearray(self.slots)
+        self._not_taken = bytearray(self.slots)
+
+        vm.coverage = self
+        # Regions compiled before only mark their blocks if they are compiled again
+        vm.flush_decode_cache()
+
+    def mark(self, start: int, end: int, next_pc: int) -> None:
+        """
+        Marks the instructions from start to end as executed. If the last
+        of them is a branch, next_pc tells the direction it took.
+
+        Parameters:
+            start (int): Address of the first executed instruction.
+            end (int): Address after the last executed instruction.
+            next_pc (int): Address execution continued at.
+        """
+        first = max((start - self.base) >> 2, 0)
+        last = min((end - self.base) >> 2, self.slots)
+        if first >= last:
+            return
+        self._executed[first:last] = b"\1" * (last - first)
+        if last == (end - self.base) >> 2 and int(self.vm.state.mem[end - 4]) & 0x7F == BRANCH_OPCODE:
+            if next_pc == end:
+                self._not_taken[last - 1] = 1
+            else:
+                self._taken[last - 1] = 1
+
+    def detach(self) -> None:
+        """
+        Detaches the collector from the VM.
+        """
+        if self.vm.coverage is self:
+            self.vm.coverage = None
+            self.vm.flush_decode_cache()
+
+    def coverage(self) -> Coverage:
+        """
+        Returns the coverage collected so far.
+
+        Returns:
+            Coverage: The packed coverage bitmaps.
+        """
+        # Find all branch instructions in the range by their opcode
+        words = self.vm.state.mem[self.base:self.base + self.slots * 4]
+        words = np.frombuffer(words.tobytes().ljust(self.slots * 4, b"\0"), dtype=u32)
+        branches = (words & 0x7F) == BRANCH_OPCODE
+
+        def pack(bits: bytearray | np.ndarray) -> np.ndarray[u8]:
+            return np.packbits(np.frombuffer(bits, dtype=u8) if isinstance(bits, bytearray) else bits)
+
+        return Coverage(self.base, self.slots, pack(self._executed), pack(self._taken),
+                        pack(self._not_taken), pack(branches))
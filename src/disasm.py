@@ -0,0 +1,200 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import os
+import multiprocessing
+from collections import namedtuple
+import numpy as np
+from elf import Symbol
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import u32, i64
+
+# Opcodes of instructions with a pc-relative target
+BRANCH_OPCODE = 0b1100011
+JAL_OPCODE    = 0b1101111
+
+# Opcodes whose implementations also test rs1, like vmv.x.s, which requires rs1 = 0
+RS1_OPCODES = (0b1010111, 0b1110011)
+
+# Minimum number of words per worker process, smaller images are disassembled in this process
+MIN_WORDS_PER_PROCESS = 1 << 14
+
+# The fields of an Instruction as plain integers, decoded for many words at once.
+# Implementations only read these fields when disassembling, so they accept it in place of an Instruction.
+Fields = namedtuple("Fields", ["instruction_word", "opcode", "funct3", "funct7", "funct12", "rd", "rs1", "rs2",
+                               "imm_i", "imm_s", "imm_b", "imm_u", "imm_j"])
+
+def decode_fields(words: np.ndarray) -> list[Fields]:
+    """
+    Decodes all fields of many instruction words with vectorized operations.
+    """
+    w = np.asarray(words, dtype=u32).astype(i64)
+    sign = w >> 31
+    imm_i = w >> 20 | sign * -4096
+    imm_s = (w >> 20 & 0xFE0) | (w >> 7 & 0x1F) | sign * -4096
+    imm_b = (w << 4 & 0x800) | (w >> 20 & 0x7E0) | (w >> 7 & 0x1E) | sign * -4096
+    imm_j = (w & 0xFF000) | (w >> 9 & 0x800) | (w >> 20 & 0x7FE) | sign * -(1 << 20)
+    columns = [w, w & 0x7F, w >> 12 & 0x7, w >> 25, w >> 20, w >> 7 & 0x1F, w >> 15 & 0x1F, w >> 20 & 0x1F,
+               imm_i, imm_s, imm_b, w & 0xFFFFF000, imm_j]
+    return list(map(Fields._make, zip(*(column.tolist() for column in columns))))
+
+# Implementations of the worker processes, inherited from the parent when they are forked
+_worker_impls: list[InstructionImpl] = []
+
+def _init_worker(impls: list[InstructionImpl]) -> None:
+    global _worker_impls
+    _worker_impls = impls
+
+def _disassemble_words(words: np.ndarray, kinds: np.ndarray) -> list[str]:
+    """
+    Disassembles words whose implementation is already known, -1 for unknown words.
+    """
+    impls = _worker_impls
+    return [impls[kind].disassemble(fields) if kind >= 0 else "unknown"
+            for fields, kind in zip(decode_fields(words), kinds.tolist())]
+
+def _disassemble_chunk(chunk: tuple[np.ndarray, np.ndarray]) -> list[str]:
+    return _disassemble_words(*chunk)
+
+def selector(words: np.ndarray) -> np.ndarray:
+    """
+    Packs the fields that select an implementation into one key per word:
+    opcode, funct3, funct7 and rs2, which also holds the low bits of funct12,
+    and rs1 for the opcodes in RS1_OPCODES. For other opcodes, rs1 is left out
+    of the key, so that their words form fewer distinct keys.
+    """
+    words = words.astype(i64)
+    opcode = words & 0x7F
+    rs1 = np.where(np.isin(opcode, RS1_OPCODES), words >> 15 & 0x1F, 0)
+    return opcode << 15 | (words >> 12 & 0x7) << 22 | (words >> 25 & 0x7F) << 5 | (words >> 20 & 0x1F) | rs1 << 25
+
+def selected_words(keys: np.ndarray) -> np.ndarray:
+    """
+    Returns an instruction word for every selector, with the fields that are not part of it cleared.
+    """
+    keys = np.asarray(keys, dtype=i64)
+    return (keys >> 15 & 0x7F | (keys >> 22 & 0x7) << 12 | (keys >> 5 & 0x7F) << 25 | (keys & 0x1F) << 20
+            | (keys >> 25 & 0x1F) << 15).astype(u32)
+
+class Disassembler:
+    """
+    Disassembles whole memory images at once.
+
+    Instead of matching every word against all implementations, the words
+    are grouped by the fields that select an implementation. Implementations
+    are assumed to only depend on opcode, funct3, funct7 and rs2, and for the
+    vector and system opcodes also on rs1. Every
+    distinct selector is matched once, so the result for a word does not
+    depend on the other words. The fields of all words are decoded with NumPy, so
+    only the text of every instruction is produced per word, which is split
+    across worker processes for large images.
+
+    Attributes:
+        impls (list[InstructionImpl]): The instruction implementations, e.g. of a VM.
+        processes (int): Number of worker processes, 1 to disassemble in this process.
+    """
+    impls:     list[InstructionImpl]
+    processes: int
+
+    def __init__(self, impls: list[InstructionImpl], processes: int | None = None) -> None:
+        self.impls = list(impls)
+        self.processes = processes if processes is not None else os.cpu_count() or 1
+
+    def match(self, key: int) -> int:
+        """
+        Returns the index of the implementation matching a selector, or -1 if none matches.
+
+        Raises:
+            ValueError: If multiple implementations match.
+        """
+        return self._match(Instruction(selected_words(np.array([key]))[0]))
+
+    def _match(self, instruction: Instruction | Fields) -> int:
+        matches = [i for i, impl in enumerate(self.impls) if impl.match(instruction)]
+        if len(matches) > 1:
+            word = Instruction(u32(instruction.instruction_word))
+            raise ValueError(f"Multiple instruction implementations match {word}")
+        return matches[0] if matches else -1
+
+    def classify(self, words: np.ndarray) -> np.ndarray:
+        """
+        Finds the implementation of every word.
+
+        Parameters:
+            words (np.ndarray): The instruction words.
+        Returns:
+            np.ndarray: Index into impls for every word, -1 for unknown words.
+        """
+        keys, inverse = np.unique(selector(words), return_inverse=True)
+        # Match the decoded fields as plain integers, which is faster than with Instruction objects
+        kinds = np.array([self._match(fields) for fields in decode_fields(selected_words(keys))], dtype=i64)
+        return kinds[inverse.ravel()]
+
+    def disassemble(self, words: np.ndarray) -> list[str]:
+        """
+        Disassembles instruction words.
+
+        Parameters:
+            words (np.ndarray): The instruction words.
+        Returns:
+            list[str]: The disassembled instructions, "unknown" for words without an implementation.
+        """
+        words = np.asarray(words, dtype=u32)
+        kinds = self.classify(words)
+        processes = min(self.processes, words.size // MIN_WORDS_PER_PROCESS)
+        if processes <= 1 or multiprocessing.get_start_method() != "fork":
+            _init_worker(self.impls)
+            return _disassemble_words(words, kinds)
+
+        # Forked workers inherit the implementations, which may hold unpicklable streams
+        chunks = list(zip(np.array_split(words, processes * 4), np.array_split(kinds, processes * 4)))
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(self.impls,)) as pool:
+            texts = pool.map(_disassemble_chunk, chunks)
+        return [text for chunk in texts for text in chunk]
+
+    def listing(self, data: bytes, base: int = 0, symbols: list[Symbol] | None = None) -> str:
+        """
+        Produces a listing of a code image with addresses, words, instructions
+        and labels. Targets of branches and jumps are labeled with the symbol
+        at their address or as L_<address>, and every branch and jump names
+        the label of its target.
+
+        Parameters:
+            data (bytes): The code, starting at base. A trailing partial word is ignored.
+            base (int): Address of the first byte.
+            symbols (list[Symbol] | None): Symbols to label addresses with.
+        Returns:
+            str: The listing.
+        """
+        words = np.frombuffer(data[:len(data) & ~3], dtype="<u4").astype(u32)
+        texts = self.disassemble(words)
+        addresses = base + 4 * np.arange(words.size, dtype=i64)
+
+        # Compute the targets of all branches and jumps at once
+        w = words.astype(i64)
+        opcode = w & 0x7F
+        imm_b = (w << 4 & 0x800) | (w >> 20 & 0x7E0) | (w >> 7 & 0x1E) | (w >> 31) * -4096
+        imm_j = (w & 0xFF000) | (w >> 9 & 0x800) | (w >> 20 & 0x7FE) | (w >> 31) * -(1 << 20)
+        transfers = (opcode == BRANCH_OPCODE) | (opcode == JAL_OPCODE)
+        targets = addresses + np.where(opcode == BRANCH_OPCODE, imm_b, imm_j)
+
+        labels = {}
+        for target in np.unique(targets[transfers]).tolist():
+            labels[target] = f"L_{target:08x}"
+        for symbol in symbols or []:
+            labels[symbol.address] = symbol.name
+
+        lines = []
+        label_addresses = {address for address in labels if base <= address < base + 4 * words.size}
+        transfer_targets = dict(zip(np.flatnonzero(transfers).tolist(), targets[transfers].tolist()))
+        for i, (word, text) in enumerate(zip(words.tolist(), texts)):
+            address = base + 4 * i
+            if address in label_addresses:
+                lines.append(f"{labels[address]}:")
+            target = transfer_targets.get(i)
+            if target is not None:
+                text = f"{text:<32} # {labels[target]}"
+            lines.append(f"  {address:08x}:  {word:08x}  {text}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,135 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import struct
+from state import RVState
+
+ELF_MAGIC = b"\x7fELF"
+
+# Segment, section and symbol constants from the ELF specification
+PT_LOAD    = 1
+PF_X       = 1
+SHT_SYMTAB = 2
+STT_OBJECT = 1
+STT_FUNC   = 2
+
+class Symbol:
+    """
+    A symbol from the symbol table of an ELF file.
+
+    Attributes:
+        name (str): The name of the symbol.
+        address (int): The address of the symbol.
+        size (int): The size of the symbol in bytes.
+        type (int): The symbol type, e.g. STT_FUNC or STT_OBJECT.
+    """
+    name:    str
+    address: int
+    size:    int
+    type:    int
+
+    def __init__(self, name: str, address: int, size: int, type: int) -> None:
+        self.name = name
+        self.address = address
+        self.size = size
+        self.type = type
+
+    @property
+    def is_function(self) -> bool:
+        return self.type == STT_FUNC
+
+    def __repr__(self) -> str:
+        return f"Symbol(name={self.name!r}, address={self.address:#010x}, size={self.size}, type={self.type})"
+
+def is_elf(data: bytes) -> bool:
+    """
+    Checks whether the given data is a 32-bit little-endian ELF file.
+    """
+    return len(data) >= 52 and data[:4] == ELF_MAGIC and data[4] == 1 and data[5] == 1
+
+def read_symbols(data: bytes) -> list[Symbol]:
+    """
+    Reads the symbol table of a 32-bit little-endian ELF file.
+
+    Parameters:
+        data (bytes): The contents of the ELF file.
+    Returns:
+        list[Symbol]: The named symbols sorted by address.
+    Raises:
+        ValueError: If the data is not a 32-bit little-endian ELF file.
+    """
+    if not is_elf(data):
+        raise ValueError("Not a 32-bit little-endian ELF file")
+
+    shoff, = struct.unpack_from("<I", data, 0x20)
+    shentsize, shnum = struct.unpack_from("<HH", data, 0x2E)
+    sections = [struct.unpack_from("<10I", data, shoff + i * shentsize) for i in range(shnum)]
+
+    symbols = []
+    for _, sh_type, _, _, offset, size, link, _, _, entsize in sections:
+        if sh_type != SHT_SYMTAB:
+            continue
+        strtab_offset = sections[link][4]
+        for pos in range(offset, offset + size, entsize or 16):
+            st_name, value, st_size, info, _, _ = struct.unpack_from("<IIIBBH", data, pos)
+            if st_name == 0:
+                continue
+            end = data.index(b"\0", strtab_offset + st_name)
+            name = data[strtab_offset + st_name:end].decode(errors="replace")
+            symbols.append(Symbol(name, value, st_size, info & 0xF))
+
+    symbols.sort(key=lambda symbol: symbol.address)
+    return symbols
+
+def load_elf(state: RVState, data: bytes) -> int:
+    """
+    Loads the PT_LOAD segments of a 32-bit little-endian ELF file into memory.
+
+    Parameters:
+        state (RVState): The state to load the segments into.
+        data (bytes): The contents of the ELF file.
+    Returns:
+        int: The entry point of the program.
+    Raises:
+        ValueError: If the data is not a 32-bit little-endian ELF file.
+    """
+    if not is_elf(data):
+        raise ValueError("Not a 32-bit little-endian ELF file")
+
+    entry, phoff = struct.unpack_from("<II", data, 0x18)
+    phentsize, phnum = struct.unpack_from("<HH", data, 0x2A)
+    # Load the segments without copying them out of the file first
+    contents = memoryview(data)
+    for i in range(phnum):
+        p_type, offset, vaddr, _, filesz, memsz, _, _ = struct.unpack_from("<8I", data, phoff + i * phentsize)
+        if p_type != PT_LOAD:
+            continue
+        state.load_memory(vaddr, contents[offset:offset + filesz])
+        if memsz > filesz:
+            # Zero the part of the segment that is not backed by the file (.bss)
+            state.load_memory(vaddr + filesz, bytes(memsz - filesz))
+    return entry
+
+def code_segments(data: bytes) -> list[tuple[int, bytes]]:
+    """
+    Returns the executable PT_LOAD segments of a 32-bit little-endian ELF file.
+
+    Parameters:
+        data (bytes): The contents of the ELF file.
+    Returns:
+        list[tuple[int, bytes]]: The address and contents of every executable segment.
+    Raises:
+        ValueError: If the data is not a 32-bit little-endian ELF file.
+    """
+    if not is_elf(data):
+        raise ValueError("Not a 32-bit little-endian ELF file")
+
+    phoff, = struct.unpack_from("<I", data, 0x1C)
+    phentsize, phnum = struct.unpack_from("<HH", data, 0x2A)
+    segments = []
+    for i in range(phnum):
+        p_type, offset, vaddr, _, filesz, _, flags, _ = struct.unpack_from("<8I", data, phoff + i * phentsize)
+        if p_type == PT_LOAD and flags & PF_X:
+            segments.append((vaddr, data[offset:offset + filesz]))
+    return segments
@@ -0,0 +1,425 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING
+import numpy as np
+from state import RVState, PAGE_SHIFT, PAGE_SIZE
+from region import UNLIMITED
+
+if TYPE_CHECKING:
+    from vm import VM
+
+# Reasons for an engine to return from run()
+HALTED   = "halted"     # The guest halted, e.g. through the exit system call
+BUDGET   = "budget"     # The requested number of steps was executed
+DIVERGED = "diverged"   # The lockstep engine found a difference between its engines
+WATCHPOINT = "watchpoint" # A watched memory location was accessed
+BREAKPOINT = "breakpoint" # The program counter reached a breakpoint
+
+# Further reasons for VM.run() to return
+TIMEOUT             = "timeout"             # The wall-clock budget of the run was used up
+EBREAK              = "ebreak"              # The guest halted with an EBREAK instruction
+ILLEGAL_INSTRUCTION = "illegal instruction" # No implementation matches the instruction, or it is not supported
+ACCESS_FAULT        = "access fault"        # An access or instruction fetch was outside of memory
+IDLE                = "idle"                # The guest spins in an idle loop that no instruction can end
+
+# Opcode of ECALL, EBREAK and CSR accesses, whose effects are not reproducible
+SYSTEM_OPCODE = 0b1110011
+
+class Stop(Exception):
+    """
+    Raised to end VM.run() at an instruction boundary, which then returns
+    the reason. Raised either by an instruction implementation after it
+    completed, which counts the instruction as retired, or by an engine
+    before it executes the instruction at a breakpoint.
+
+    Attributes:
+        reason (str): The reason returned by VM.run(), e.g. WATCHPOINT.
+    """
+    reason: str
+
+    def __init__(self, reason: str) -> None:
+        super().__init__(reason)
+        self.reason = reason
+
+class RunResult(str):
+    """
+    The result of VM.run(). It is the reason string itself, e.g. HALTED or
+    ACCESS_FAULT, so it can be compared with the reasons directly.
+
+    Attributes:
+        reason (str): Why the run ended.
+        instret (int): Retired instruction counter after the run.
+        steps (int): Number of instructions retired by the run.
+        elapsed (float): Wall-clock duration of the run in seconds.
+        exit_code (int | None): The value of a0 if the guest halted, otherwise None.
+        error (Exception | None): The exception of an illegal instruction or access fault.
+    """
+    instret:   int
+    steps:     int
+    elapsed:   float
+    exit_code: int | None
+    error:     Exception | None
+
+    def __new__(cls, reason: str, instret: int, steps: int, elapsed: float,
+                exit_code: int | None = None, error: Exception | None = None) -> "RunResult":
+        result = super().__new__(cls, reason)
+        result.instret = instret
+        result.steps = steps
+        result.elapsed = elapsed
+        result.exit_code = exit_code
+        result.error = error
+        return result
+
+    @property
+    def reason(self) -> str:
+        return str(self)
+
+    def __repr__(self) -> str:
+        return (f"RunResult(reason={self.reason!r}, instret={self.instret}, steps={self.steps}, "
+                f"elapsed={self.elapsed:.6f}, exit_code={self.exit_code}, error={self.error!r})")
+
+class Engine(ABC):
+    """
+    Abstract base class for the ways a VM can execute instructions.
+
+    All engines must produce the same state as the reference engine after
+    every run, including the retired instruction counter, so that a faster
+    engine can be validated against it with the LockstepEngine.
+    """
+    name: str
+
+    @abstractmethod
+    def run(self, vm: "VM", n_steps: int) -> str:
+        """
+        Runs the VM for a number of steps or until it halts.
+
+        Parameters:
+            vm (VM): The VM to run.
+            n_steps (int): Number of steps to execute. If negative, runs until halted.
+        Returns:
+            str: The reason for returning, HALTED or BUDGET.
+        """
+        pass
+
+class ReferenceEngine(Engine):
+    """
+    Executes one instruction at a time with VM.step(), matching every
+    instruction against all implementations. Slow, but simple enough to
+    serve as the reference for all other engines.
+    """
+    name = "reference"
+
+    def run(self, vm: "VM", n_steps: int) -> str:
+        state = vm.state
+        breakpoints = vm.breakpoints
+        # A negative count stays non-zero, so -1 runs until halted
+        remaining = n_steps
+        while not state.halt and remaining != 0:
+            if breakpoints and int(state.pc) in breakpoints:
+                raise Stop(BREAKPOINT)
+            vm.step()
+            remaining -= 1
+        return HALTED if state.halt else BUDGET
+
+class BlockEngine(Engine):
+    """
+    Executes decoded blocks from the decode cache of the VM.
+
+    The retired instruction counter is only updated once per block. The
+    cache is flushed when a decoded instruction is overwritten. Spin loops
+    are fast-forwarded, and loops whose back edge runs hot_threshold times
+    are compiled into a region that keeps their registers in Python locals.
+
+    Blocks end before breakpoints, and blocks at breakpoints are never
+    cached, so breakpoints are only checked on a cache miss. While coverage
+    is collected, the instructions of every executed block are marked at once.
+    """
+    name = "block"
+
+    def run(self, vm: "VM", n_steps: int) -> str:
+        state = vm.state
+        blocks = vm.blocks
+        # A negative count stays non-zero, so -1 runs until halted
+        remaining = n_steps
+        while not state.halt and remaining != 0:
+            if state.code_modified:
+                vm.flush_decode_cache()
+
+            pc = int(state.pc)
+            block = blocks.get(pc)
+            if block is None:
+                if vm.breakpoints and pc in vm.breakpoints:
+                    raise Stop(BREAKPOINT)
+                if vm.intercepts and pc in vm.intercepts:
+                    vm.step()
+                    remaining -= 1
+                    continue
+                block = vm.decode_block(pc)
+
+            # Run the compiled region of a hot loop
+            if block.region is not None:
+                executed = block.region.function(state, remaining if remaining >= 0 else UNLIMITED)
+                if executed:
+                    remaining -= executed
+                    continue
+
+            # Single-step if the block is unknown or longer than the remaining steps
+            if block.length == 0 or 0 < remaining < block.length:
+                vm.step()
+                remaining -= 1
+                continue
+
+            loop = block.loop
+            if loop is not None:
+                before = state.rf.copy()
+            try:
+                for execute, instruction in block.entries:
+                    execute(state, instruction)
+            except BaseException:
+                # Count the instructions completed before the faulting one
+                completed = (int(state.pc) - pc) >> 2
+                state.instret += completed
+                if vm.coverage is not None:
+                    vm.coverage.mark(pc, pc + 4 * completed, int(state.pc))
+                raise
+            state.instret += block.length
+            remaining -= block.length
+
+            next_pc = int(state.pc)
+            if vm.coverage is not None:
+                vm.coverage.mark(pc, pc + 4 * block.length, next_pc)
+            if next_pc <= pc:
+                if loop is not None and next_pc == pc:
+                    remaining = vm.fast_forward(block, before, remaining)
+                elif vm.hot_threshold is not None:
+                    # Count the back edge and compile the loop once it is hot
+                    count = vm.back_edges.get(next_pc, 0) + 1
+                    vm.back_edges[next_pc] = count
+                    if count == vm.hot_threshold:
+                        vm.compile_loop(next_pc, pc + 4 * block.length)
+        return HALTED if state.halt else BUDGET
+
+class Divergence:
+    """
+    The first difference between the candidate and the reference engine
+    found by the LockstepEngine.
+
+    Attributes:
+        pc (int): Address of the block after which the states differ.
+        instret (int): Retired instructions before the block.
+        location (str): What differs: "pc", "halt", "instret", a register like "x5",
+            a memory address like "mem[0x00001000]" or "exception".
+        expected (object): The value in the reference engine.
+        actual (object): The value in the candidate engine.
+    """
+    pc:       int
+    instret:  int
+    location: str
+    expected: object
+    actual:   object
+
+    def __init__(self, pc: int, instret: int, location: str, expected: object, actual: object) -> None:
+        self.pc = pc
+        self.instret = instret
+        self.location = location
+        self.expected = expected
+        self.actual = actual
+
+    def __repr__(self) -> str:
+        return (f"Divergence(pc={self.pc:#010x}, instret={self.instret}, location={self.location!r}, "
+                f"expected={self.expected!r}, actual={self.actual!r})")
+
+class LockstepEngine(Engine):
+    """
+    Runs a candidate engine on the VM and a reference engine on a shadow
+    copy of it, one block at a time, and compares the registers, the program
+    counter and the memory pages written by the block after every block.
+    The dirty page flags of the VM are saved and cleared around every block
+    and merged back afterwards, so the cost of a comparison does not grow
+    with the pages written earlier, and the flags still cover the whole run.
+
+    The implementations of the VM are shared with the shadow, so the state
+    that extensions keep outside of RVState is saved before every block and
+    restored for the reference, and compared like the registers afterwards.
+
+    System instructions and intercepted routines have effects outside the
+    state, like output or the current time, so they only run on the VM and
+    their results are copied to the shadow. The shadow is also synchronized
+    with the registers and dirty pages of the VM at the start of every run,
+    so the host may modify the state between runs.
+
+    The run stops at the first difference, which is kept in divergence.
+    A fault is only reported if the other engine faults differently.
+
+    Attributes:
+        candidate (Engine): The engine under test, which runs on the VM.
+        reference (Engine): The engine that runs on the shadow.
+        shadow (VM | None): The shadow VM, created by the first run.
+        divergence (Divergence | None): The first difference that was found.
+        blocks (int): Number of compared blocks.
+    """
+    name = "lockstep"
+    candidate:  Engine
+    reference:  Engine
+    shadow:     "VM | None"
+    divergence: Divergence | None
+    blocks:     int
+
+    def __init__(self, candidate: Engine | None = None, reference: Engine | None = None) -> None:
+        self.candidate = candidate if candidate is not None else BlockEngine()
+        self.reference = reference if reference is not None else ReferenceEngine()
+        self.shadow = None
+        self.divergence = None
+        self.blocks = 0
+
+    def run(self, vm: "VM", n_steps: int) -> str:
+        if self.divergence is not None:
+            return DIVERGED
+        state = vm.state
+        shadow = self._synchronize(vm)
+
+        remaining = n_steps
+        while not state.halt and remaining != 0:
+            # Only the pages written by this block are flagged while it runs, so that the
+            # comparison does not grow with the pages written earlier in the run
+            dirty = state.dirty.copy()
+            state.dirty.fill(False)
+            try:
+                executed = self._block(vm, shadow, remaining)
+            finally:
+                state.dirty |= dirty
+            if self.divergence is not None:
+                return DIVERGED
+            remaining -= executed
+        return HALTED if state.halt else BUDGET
+
+    def _block(self, vm: "VM", shadow: "VM", remaining: int) -> int:
+        """
+        Runs one block on both engines and compares them, or runs a system
+        instruction or intercepted routine on the VM and copies its results.
+
+        Returns:
+            int: The number of instructions executed by the VM.
+        """
+        state = vm.state
+        pc = int(state.pc)
+        instret = state.instret
+        if pc in vm.intercepts or self._is_system(state, pc):
+            self.candidate.run(vm, 1)
+            self._copy_state(state, shadow.state)
+            return 1
+
+        # Run the candidate for one block, then the reference for as many steps
+        block = vm.blocks.get(pc) or vm.decode_block(pc)
+        count = max(block.length, 1)
+        if 0 < remaining < count:
+            count = remaining
+        # Both engines execute the same implementations, so the state of extensions
+        # is swapped: the reference starts from the state the candidate started from
+        before = vm.snapshot_extensions()
+        error = None
+        try:
+            self.candidate.run(vm, count)
+        except Exception as e:
+            error = e
+        executed = state.instret - instret
+        actual = vm.snapshot_extensions()
+        vm.restore_extensions(before)
+
+        expected_error = None
+        try:
+            self.reference.run(shadow, executed)
+            if error is not None:
+                self.reference.run(shadow, 1)
+        except Exception as e:
+            expected_error = e
+        expected = vm.snapshot_extensions()
+        vm.restore_extensions(actual)
+
+        self.blocks += 1
+        self.divergence = self._compare(shadow.state, state, pc, instret, expected_error, error) \
+            or self._compare_extensions(vm, expected, actual, pc, instret)
+        if error is not None and self.divergence is None:
+            raise error
+        return executed
+
+    def _synchronize(self, vm: "VM") -> "VM":
+        """
+        Creates the shadow VM on the first run and copies the registers
+        and dirty pages of the VM to it.
+        """
+        if self.shadow is None or self.shadow.state.mem.size != vm.state.mem.size:
+            self.shadow = type(vm)(vm.state.mem.size, engine=self.reference)
+            self.shadow.state = vm.state.clone()
+        self.shadow.instruction_implementations[:] = vm.instruction_implementations
+        self.shadow.flush_decode_cache()
+        self._copy_state(vm.state, self.shadow.state)
+        return self.shadow
+
+    @staticmethod
+    def _copy_state(source: RVState, target: RVState) -> None:
+        target.rf[:] = source.rf
+        target.pc = source.pc
+        target.halt = source.halt
+        target.instret = source.instret
+        for page in np.flatnonzero(source.dirty):
+            start = int(page) << PAGE_SHIFT
+            target.mem[start:start + PAGE_SIZE] = source.mem[start:start + PAGE_SIZE]
+        target.dirty.fill(False)
+
+    @staticmethod
+    def _is_system(state: RVState, pc: int) -> bool:
+        return pc + 4 <= state.mem.size and int(state.mem[pc]) & 0x7F == SYSTEM_OPCODE
+
+    @staticmethod
+    def _compare(expected: RVState, actual: RVState, pc: int, instret: int,
+                 expected_error: Exception | None, actual_error: Exception | None) -> Divergence | None:
+        """
+        Compares the state of the reference with the state of the candidate after a block.
+        Memory is compared in all pages that either engine has written.
+        """
+        if type(expected_error) is not type(actual_error):
+            return Divergence(pc, instret, "exception", repr(expected_error), repr(actual_error))
+        if int(expected.pc) != int(actual.pc):
+            return Divergence(pc, instret, "pc", int(expected.pc), int(actual.pc))
+        if expected.halt != actual.halt:
+            return Divergence(pc, instret, "halt", expected.halt, actual.halt)
+        if expected.instret != actual.instret:
+            return Divergence(pc, instret, "instret", expected.instret, actual.instret)
+        registers = np.flatnonzero(expected.rf != actual.rf)
+        if registers.size:
+            r = int(registers[0])
+            return Divergence(pc, instret, f"x{r}", int(expected.rf[r]), int(actual.rf[r]))
+
+        for page in np.flatnonzero(expected.dirty | actual.dirty):
+            start = int(page) << PAGE_SHIFT
+            difference = np.flatnonzero(expected.mem[start:start + PAGE_SIZE] != actual.mem[start:start + PAGE_SIZE])
+            if difference.size:
+                address = start + int(difference[0])
+                return Divergence(pc, instret, f"mem[{address:#010x}]",
+                                  int(expected.mem[address]), int(actual.mem[address]))
+        expected.dirty.fill(False)
+        return None
+
+    @staticmethod
+    def _compare_extensions(vm: "VM", expected: list, actual: list, pc: int, instret: int) -> Divergence | None:
+        """
+        Compares the extension states after the reference ran with those after the candidate ran.
+        """
+        for extension, before, after in zip(vm.extensions, expected, actual):
+            if before is None:
+                continue
+            fields = zip(before, after) if isinstance(before, tuple) else [(before, after)]
+            for index, (a, b) in enumerate(fields):
+                if isinstance(a, np.ndarray):
+                    difference = np.flatnonzero(a != b)
+                    if difference.size:
+                        i = int(difference[0])
+                        return Divergence(pc, instret, f"{type(extension).__name__}[{index}][{i}]",
+                                          a[i].item(), b[i].item())
+                elif a != b:
+                    return Divergence(pc, instret, f"{type(extension).__name__}[{index}]", a, b)
+        return None
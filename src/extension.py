@@ -10,6 +10,10 @@ class Extension(ABC):
     Abstract base class for RISC-V extensions.
     
     Extensions can add new instructions or modify existing ones.
+
+    An extension that keeps architectural state outside of RVState, like
+    the vector registers of V, overrides snapshot(), restore() and reset(),
+    so that tools that save and restore the state of a VM include it.
     """
 
     @abstractmethod
@@ -21,3 +25,22 @@ class Extension(ABC):
             list: A list of instruction implementations.
         """
         pass
+
+    def snapshot(self) -> object | None:
+        """
+        Returns a copy of the architectural state the extension keeps, or None if it keeps none.
+        The copy is a tuple of values and NumPy arrays, so that the lockstep engine can compare it.
+        """
+        return None
+
+    def restore(self, snapshot: object | None) -> None:
+        """
+        Restores a copy returned by snapshot().
+        """
+        pass
+
+    def reset(self) -> None:
+        """
+        Resets the architectural state the extension keeps to its initial value.
+        """
+        pass
@@ -0,0 +1,485 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+
+from extension import Extension
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import signed32
+from state import RVState
+
+class Zba(Extension):
+    """
+    RISC-V Zba extension for address generation.
+    This extension implements the shift-and-add instructions used for array indexing.
+    """
+
+    def get_instruction_implementations(self):
+        return [
+            Sh1add(),
+            Sh2add(),
+            Sh3add(),
+        ]
+
+class Zbb(Extension):
+    """
+    RISC-V Zbb extension for basic bit manipulation.
+    This extension implements bit counting, min/max, rotates, byte operations
+    and logical operations with negated operands, computed with Python integer
+    primitives instead of shift-and-mask sequences.
+    """
+
+    def get_instruction_implementations(self):
+        return [
+            # Logical instructions with negated operands
+            Andn(),
+            Orn(),
+            Xnor(),
+            # Bit counting instructions
+            Clz(),
+            Ctz(),
+            Cpop(),
+            # Minimum and maximum instructions
+            Min(),
+            Minu(),
+            Max(),
+            Maxu(),
+            # Sign and zero extension instructions
+            SextB(),
+            SextH(),
+            ZextH(),
+            # Rotate instructions
+            Rol(),
+            Ror(),
+            Rori(),
+            # Byte instructions
+            OrcB(),
+            Rev8(),
+        ]
+
+def unsigned(value) -> int:
+    """
+    Returns a register value as an unsigned 32-bit Python integer.
+    """
+    return int(value) & 0xFFFFFFFF
+
+class Sh1add(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b010     \
+           and instruction.funct7 == 0b0010000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Shift rs1 left by 1 and add rs2
+        state.rf[instruction.rd] = signed32((a << 1) + b)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"sh1add x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Sh2add(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b100     \
+           and instruction.funct7 == 0b0010000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Shift rs1 left by 2 and add rs2
+        state.rf[instruction.rd] = signed32((a << 2) + b)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"sh2add x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Sh3add(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b110     \
+           and instruction.funct7 == 0b0010000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Shift rs1 left by 3 and add rs2
+        state.rf[instruction.rd] = signed32((a << 3) + b)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"sh3add x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Andn(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b111     \
+           and instruction.funct7 == 0b0100000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # AND with the inverted rs2
+        state.rf[instruction.rd] = signed32(a & ~b)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"andn x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Orn(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b110     \
+           and instruction.funct7 == 0b0100000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # OR with the inverted rs2
+        state.rf[instruction.rd] = signed32(a | (~b & 0xFFFFFFFF))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"orn x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Xnor(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b100     \
+           and instruction.funct7 == 0b0100000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Inverted XOR
+        state.rf[instruction.rd] = signed32(~(a ^ b))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"xnor x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Clz(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000 \
+           and instruction.rs2 == 0b00000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Count leading zeros, 32 for zero
+        state.rf[instruction.rd] = signed32(32 - a.bit_length())
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"clz x{instruction.rd}, x{instruction.rs1}"
+
+class Ctz(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000 \
+           and instruction.rs2 == 0b00001
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Count trailing zeros, 32 for zero
+        state.rf[instruction.rd] = signed32((a & -a).bit_length() - 1 if a else 32)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"ctz x{instruction.rd}, x{instruction.rs1}"
+
+class Cpop(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000 \
+           and instruction.rs2 == 0b00010
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Count the set bits
+        state.rf[instruction.rd] = signed32(a.bit_count())
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"cpop x{instruction.rd}, x{instruction.rs1}"
+
+class Min(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b100     \
+           and instruction.funct7 == 0b0000101
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Signed minimum
+        state.rf[instruction.rd] = signed32(min(signed32(a), signed32(b)))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"min x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Minu(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b101     \
+           and instruction.funct7 == 0b0000101
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Unsigned minimum
+        state.rf[instruction.rd] = signed32(min(a, b))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"minu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Max(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b110     \
+           and instruction.funct7 == 0b0000101
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Signed maximum
+        state.rf[instruction.rd] = signed32(max(signed32(a), signed32(b)))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"max x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Maxu(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b111     \
+           and instruction.funct7 == 0b0000101
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Unsigned maximum
+        state.rf[instruction.rd] = signed32(max(a, b))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"maxu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class SextB(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000 \
+           and instruction.rs2 == 0b00100
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Sign-extend the least significant byte
+        state.rf[instruction.rd] = signed32(((a & 0xFF) ^ 0x80) - 0x80)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"sext.b x{instruction.rd}, x{instruction.rs1}"
+
+class SextH(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000 \
+           and instruction.rs2 == 0b00101
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Sign-extend the least significant halfword
+        state.rf[instruction.rd] = signed32(((a & 0xFFFF) ^ 0x8000) - 0x8000)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"sext.h x{instruction.rd}, x{instruction.rs1}"
+
+class ZextH(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b100     \
+           and instruction.funct7 == 0b0000100 \
+           and instruction.rs2 == 0b00000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Zero-extend the least significant halfword
+        state.rf[instruction.rd] = signed32(a & 0xFFFF)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"zext.h x{instruction.rd}, x{instruction.rs1}"
+
+class Rol(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0110000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Rotate left by the lower 5 bits of rs2
+        state.rf[instruction.rd] = signed32((a << (b & 0x1F)) | (a >> ((32 - (b & 0x1F)) & 0x1F)))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"rol x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Ror(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0110011 \
+           and instruction.funct3 == 0b101     \
+           and instruction.funct7 == 0b0110000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source registers as unsigned integers
+        a = unsigned(state.rf[instruction.rs1])
+        b = unsigned(state.rf[instruction.rs2])
+
+        # Rotate right by the lower 5 bits of rs2
+        state.rf[instruction.rd] = signed32((a >> (b & 0x1F)) | (a << ((32 - (b & 0x1F)) & 0x1F)))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"ror x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+class Rori(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b101     \
+           and instruction.funct7 == 0b0110000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register and the shift amount
+        a = unsigned(state.rf[instruction.rs1])
+        shamt = int(instruction.rs2) # This is actually the immediate value for RORI
+
+        # Rotate right by the immediate
+        state.rf[instruction.rd] = signed32((a >> shamt) | (a << ((32 - shamt) & 0x1F)))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"rori x{instruction.rd}, x{instruction.rs1}, {instruction.rs2}"
+
+class OrcB(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b101     \
+           and instruction.funct7 == 0b0010100 \
+           and instruction.rs2 == 0b00111
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Set every non-zero byte to 0xFF
+        state.rf[instruction.rd] = signed32(int.from_bytes(bytes(0xFF if byte else 0 for byte in a.to_bytes(4, 'little')), 'little'))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"orc.b x{instruction.rd}, x{instruction.rs1}"
+
+class Rev8(InstructionImpl):
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b0010011 \
+           and instruction.funct3 == 0b101     \
+           and instruction.funct7 == 0b0110100 \
+           and instruction.rs2 == 0b11000
+    
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the source register as an unsigned integer
+        a = unsigned(state.rf[instruction.rs1])
+
+        # Reverse the byte order
+        state.rf[instruction.rd] = signed32(int.from_bytes(a.to_bytes(4, 'little'), 'big'))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"rev8 x{instruction.rd}, x{instruction.rs1}"
\ No newline at end of file
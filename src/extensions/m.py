@@ -7,7 +7,7 @@ import numpy as np
 from extension import Extension
 from instruction import Instruction
 from instruction_impl import InstructionImpl
-from nums import u32, i32, i8, u8, i64, u64
+from nums import u32, i32, i8, u8, i64, u64, signed32
 from state import RVState
 
 class M(Extension):
@@ -37,7 +37,7 @@ def muls(a: i32, b: i32) -> i64:
         a (i32): The first integer.
         b (i32): The second integer.
     """
-    return np.multiply(a, b, dtype=i64)
+    return int(a) * int(b)
 
 def mulu(a: u32, b: u32) -> u64:
     """
@@ -46,18 +46,19 @@ def mulu(a: u32, b: u32) -> u64:
         a (u32): The first integer.
         b (u32): The second integer.
     """
-    return np.multiply(a, b, dtype=u64)
+    return (int(a) & 0xFFFFFFFF) * (int(b) & 0xFFFFFFFF)
 
 def div(a: i32 | u32, b: i32 | u32) -> int:
     """
-    Perform division of two integers.
+    Perform division of two integers, rounding towards zero.
     Parameters:
         a (i32 | u32): The dividend.
         b (i32 | u32): The divisor.
     Returns:
         i32 | u32: The result of the division.
     """
-    return np.fix(a / b).astype(int)
+    quotient = abs(int(a)) // abs(int(b))
+    return quotient if (a < 0) == (b < 0) else -quotient
 
 def rem(a: i32 | u32, b: i32 | u32) -> int:
     """
@@ -68,7 +69,7 @@ def rem(a: i32 | u32, b: i32 | u32) -> int:
     Returns:
         i32 | u32: The result of the remainder operation.
     """
-    return a - b * div(a, b)
+    return int(a) - int(b) * div(a, b)
 
 
 class Mul(InstructionImpl):
@@ -84,7 +85,10 @@ class Mul(InstructionImpl):
         rs2 = instruction.rs2
 
         # Perform the multiplication
-        state.rf[rd] = muls(state.rf[rs1], state.rf[rs2])
+        state.rf[rd] = signed32(muls(state.rf[rs1], state.rf[rs2]))
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"mul x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -102,7 +106,10 @@ class Mulh(InstructionImpl):
         rs2 = instruction.rs2
 
         # Perform the multiplication and take the high part
-        state.rf[rd] = muls(state.rf[rs1], state.rf[rs2]) >> 32
+        state.rf[rd] = signed32(muls(state.rf[rs1], state.rf[rs2]) >> 32)
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"mulh x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -120,7 +127,10 @@ class Mulhu(InstructionImpl):
         rs2 = instruction.rs2
 
         # Perform the multiplication and take the high part (unsigned)
-        state.rf[rd] = mulu(state.rf[rs1], state.rf[rs2]) >> u32(32)
+        state.rf[rd] = signed32(mulu(state.rf[rs1], state.rf[rs2]) >> 32)
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"mulhu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -138,7 +148,10 @@ class Mulhsu(InstructionImpl):
         rs2 = instruction.rs2
 
         # Perform the multiplication with signed and unsigned operands
-        state.rf[rd] = muls(state.rf[rs1], u32(state.rf[rs2])) >> 32
+        state.rf[rd] = signed32(muls(state.rf[rs1], int(state.rf[rs2]) & 0xFFFFFFFF) >> 32)
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"mulhsu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -159,7 +172,10 @@ class Div(InstructionImpl):
         if state.rf[rs2] == 0:
             state.rf[rd] = -1  # Handle division by zero by setting the result to -1
         else:
-            state.rf[rd] = div(state.rf[rs1], state.rf[rs2])  # Store the result as a signed integer
+            state.rf[rd] = signed32(div(state.rf[rs1], state.rf[rs2]))  # Store the result as a signed integer
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"div x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -180,7 +196,10 @@ class Divu(InstructionImpl):
         if state.rf[rs2] == 0:
             state.rf[rd] = -1  # Handle division by zero by setting the result to -1
         else:
-            state.rf[rd] = div(u32(state.rf[rs1]), u32(state.rf[rs2]))  # Store the result as an unsigned integer
+            state.rf[rd] = signed32(div(u32(state.rf[rs1]), u32(state.rf[rs2])))  # Store the result as an unsigned integer
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"divu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -201,7 +220,10 @@ class Rem(InstructionImpl):
         if state.rf[rs2] == 0:
             state.rf[rd] = state.rf[rs1]  # Handle division by zero by returning the dividend
         else:
-            state.rf[rd] = rem(state.rf[rs1], state.rf[rs2])  # Store the result as a signed integer
+            state.rf[rd] = signed32(rem(state.rf[rs1], state.rf[rs2]))  # Store the result as a signed integer
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"rem x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
@@ -222,10 +244,14 @@ class Remu(InstructionImpl):
         if state.rf[rs2] == 0:
             state.rf[rd] = state.rf[rs1]  # Handle division by zero by returning the dividend
         else:
-            state.rf[rd] = rem(u32(state.rf[rs1]), u32(state.rf[rs2]))
+            state.rf[rd] = signed32(rem(u32(state.rf[rs1]), u32(state.rf[rs2])))
+
+        # Increment the program counter
+        state.pc += 4
 
     def disassemble(self, instruction: Instruction):
         return f"remu x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
 
-
-    
+# Groups of implementations used by tools that observe execution
+MULTIPLIES = (Mul, Mulh, Mulhu, Mulhsu)
+DIVIDES = (Div, Divu, Rem, Remu)
@@ -6,9 +6,21 @@
 from extension import Extension
 from instruction import Instruction
 from instruction_impl import InstructionImpl
-from nums import u32, i32, i8, u8
+from nums import u32, i32, i8, u8, signed32
 from state import RVState
 
+def access_address(state: RVState, rs1: int, imm: int, size: int) -> int:
+    """
+    Computes the address of a load or store, wrapped to 32 bits like in compiled regions.
+
+    Raises:
+        IndexError: If the access is not within memory.
+    """
+    address = (int(state.rf[rs1]) + int(imm)) & 0xFFFFFFFF
+    if address + size > state.mem.size:
+        raise IndexError(f"Memory access out of bounds at {address:#010x}")
+    return address
+
 class RV32I(Extension):
     """
     RISC-V RV32I base integer instruction set extension.
@@ -81,7 +93,7 @@ class Add(InstructionImpl):
         rs2 = instruction.rs2
 
         # Execute the addition
-        state.rf[rd] = state.rf[rs1] + state.rf[rs2]
+        state.rf[rd] = signed32(int(state.rf[rs1]) + int(state.rf[rs2]))
 
         # Increment the program counter
         state.pc += 4
@@ -101,7 +113,7 @@ class AddI(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Execute the addition with immediate
-        state.rf[rd] = state.rf[rs1] + imm_i
+        state.rf[rd] = signed32(int(state.rf[rs1]) + int(imm_i))
 
         # Increment the program counter
         state.pc += 4
@@ -122,7 +134,7 @@ class Sub(InstructionImpl):
         rs2 = instruction.rs2
 
         # Execute the subtraction
-        state.rf[rd] = state.rf[rs1] - state.rf[rs2]
+        state.rf[rd] = signed32(int(state.rf[rs1]) - int(state.rf[rs2]))
 
         # Increment the program counter
         state.pc += 4
@@ -266,7 +278,7 @@ class Sll(InstructionImpl):
         rs2 = instruction.rs2
 
         # Execute the shift left logical operation
-        state.rf[rd] = state.rf[rs1] << (state.rf[rs2] & 0x1F)
+        state.rf[rd] = signed32(int(state.rf[rs1]) << (int(state.rf[rs2]) & 0x1F))
 
         # Increment the program counter
         state.pc += 4
@@ -308,7 +320,7 @@ class Srl(InstructionImpl):
         rs2 = instruction.rs2
 
         # Execute the shift right logical operation
-        state.rf[rd] = u32(state.rf[rs1]) >> (state.rf[rs2] & 0x1F)
+        state.rf[rd] = signed32((int(state.rf[rs1]) & 0xFFFFFFFF) >> (int(state.rf[rs2]) & 0x1F))
 
         # Increment the program counter
         state.pc += 4
@@ -319,7 +331,8 @@ class Srl(InstructionImpl):
 class SllI(InstructionImpl):
     def match(self, instruction: Instruction) -> bool:
         return instruction.opcode == 0b0010011 \
-           and instruction.funct3 == 0b001
+           and instruction.funct3 == 0b001     \
+           and instruction.funct7 == 0b0000000
     
     def execute(self, state: RVState, instruction: Instruction) -> None:
         # Extract the source register and immediate value
@@ -328,7 +341,7 @@ class SllI(InstructionImpl):
         imm = instruction.rs2 # This is actually the immediate value for SLLI
 
         # Execute the shift left logical operation with immediate
-        state.rf[rd] = state.rf[rs1] << (imm & 0x1F)
+        state.rf[rd] = signed32(int(state.rf[rs1]) << (int(imm) & 0x1F))
 
         # Increment the program counter
         state.pc += 4
@@ -370,13 +383,13 @@ class SrlI(InstructionImpl):
         imm = instruction.rs2 # This is actually the immediate value for SRLI
 
         # Execute the shift right logical operation with immediate
-        state.rf[rd] = u32(state.rf[rs1]) >> (imm & 0x1F)
+        state.rf[rd] = signed32((int(state.rf[rs1]) & 0xFFFFFFFF) >> (int(imm) & 0x1F))
 
         # Increment the program counter
         state.pc += 4
 
     def disassemble(self, instruction: Instruction):
-        return f"srl x{instruction.rd}, x{instruction.rs1}, {instruction.rs2 & 0x1F}"
+        return f"srli x{instruction.rd}, x{instruction.rs1}, {instruction.rs2 & 0x1F}"
     
 class Slt(InstructionImpl):
     def match(self, instruction: Instruction) -> bool:
@@ -602,7 +615,7 @@ class Jal(InstructionImpl):
         imm_j = instruction.imm_j
 
         # Save the return address in the destination register
-        state.rf[rd] = state.pc + 4
+        state.rf[rd] = signed32(int(state.pc) + 4)
 
         # Update the program counter to the target address
         state.pc = u32(i32(state.pc) + imm_j)
@@ -621,11 +634,14 @@ class JalR(InstructionImpl):
         rs1 = instruction.rs1
         imm_i = instruction.imm_i
 
+        # Read the target before writing the return address, since rd may equal rs1
+        target = u32((int(state.rf[rs1]) + int(imm_i)) & 0xFFFFFFFE)
+
         # Save the return address in the destination register
-        state.rf[rd] = state.pc + 4
+        state.rf[rd] = signed32(int(state.pc) + 4)
 
-        # Update the program counter to the address in rs1
-        state.pc = u32(i32(state.rf[rs1]) + imm_i) & ~u32(1)  # Ensure the address is aligned
+        # Update the program counter to the target address
+        state.pc = target
 
     def disassemble(self, instruction: Instruction):
         return f"jalr x{instruction.rd}, x{instruction.rs1}, {instruction.imm_i}"
@@ -637,16 +653,16 @@ class Lui(InstructionImpl):
     def execute(self, state: RVState, instruction: Instruction) -> None:
         # Extract the destination register and immediate value
         rd = instruction.rd
-        imm_u = instruction.imm_u << 12  # Shift the immediate value to the upper 20 bits
+        imm_u = instruction.imm_u  # Already holds the upper 20 bits
 
         # Load the upper immediate into the destination register
-        state.rf[rd] = u32(imm_u)
+        state.rf[rd] = signed32(imm_u)
 
         # Increment the program counter
         state.pc += 4
 
     def disassemble(self, instruction: Instruction):
-        return f"lui x{instruction.rd}, {instruction.imm_u}"
+        return f"lui x{instruction.rd}, {instruction.imm_u >> 12}"
     
 class Auipc(InstructionImpl):
     def match(self, instruction: Instruction) -> bool:
@@ -655,16 +671,16 @@ class Auipc(InstructionImpl):
     def execute(self, state: RVState, instruction: Instruction) -> None:
         # Extract the destination register and immediate value
         rd = instruction.rd
-        imm_u = instruction.imm_u << 12  # Shift the immediate value to the upper 20 bits
+        imm_u = instruction.imm_u  # Already holds the upper 20 bits
 
         # Add the upper immediate to the current program counter
-        state.rf[rd] = u32(state.pc + imm_u)
+        state.rf[rd] = signed32(int(state.pc) + int(imm_u))
 
         # Increment the program counter
         state.pc += 4
 
     def disassemble(self, instruction: Instruction):
-        return f"auipc x{instruction.rd}, {instruction.imm_u}"
+        return f"auipc x{instruction.rd}, {instruction.imm_u >> 12}"
     
 class Lb(InstructionImpl):
     def match(self, instruction: Instruction) -> bool:
@@ -678,7 +694,7 @@ class Lb(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Load the byte from memory and sign-extend it
-        state.rf[rd] = i8(state.mem[state.rf[rs1] + imm_i])
+        state.rf[rd] = i8(state.mem[access_address(state, rs1, imm_i, 1)])
 
         # Increment the program counter
         state.pc += 4
@@ -698,7 +714,7 @@ class Lbu(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Load the byte from memory and zero-extend it
-        state.rf[rd] = u8(state.mem[state.rf[rs1] + imm_i])
+        state.rf[rd] = u8(state.mem[access_address(state, rs1, imm_i, 1)])
 
         # Increment the program counter
         state.pc += 4
@@ -718,7 +734,8 @@ class Lh(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Load the halfword from memory and sign-extend it
-        state.rf[rd] = (i8(state.mem[state.rf[rs1] + imm_i + 1]) << 8) + state.mem[state.rf[rs1] + imm_i]
+        address = access_address(state, rs1, imm_i, 2)
+        state.rf[rd] = (int(i8(state.mem[address + 1])) << 8) | int(state.mem[address])
 
         # Increment the program counter
         state.pc += 4
@@ -738,7 +755,8 @@ class Lhu(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Load the halfword from memory and zero-extend it
-        state.rf[rd] = (u8(state.mem[state.rf[rs1] + imm_i + 1]) << 8) + state.mem[state.rf[rs1] + imm_i]
+        address = access_address(state, rs1, imm_i, 2)
+        state.rf[rd] = (int(state.mem[address + 1]) << 8) | int(state.mem[address])
 
         # Increment the program counter
         state.pc += 4
@@ -758,10 +776,11 @@ class Lw(InstructionImpl):
         imm_i = instruction.imm_i
 
         # Load the word from memory
-        state.rf[rd] = (i8(state.mem[state.rf[rs1] + imm_i + 3]) << 24) + \
-                     (state.mem[state.rf[rs1] + imm_i + 2] << 16) + \
-                     (state.mem[state.rf[rs1] + imm_i + 1] << 8) + \
-                     state.mem[state.rf[rs1] + imm_i]
+        address = access_address(state, rs1, imm_i, 4)
+        state.rf[rd] = (int(i8(state.mem[address + 3])) << 24) | \
+                       (int(state.mem[address + 2]) << 16) | \
+                       (int(state.mem[address + 1]) << 8) | \
+                       int(state.mem[address])
 
         # Increment the program counter
         state.pc += 4
@@ -781,7 +800,9 @@ class Sb(InstructionImpl):
         imm_s = instruction.imm_s
 
         # Store the byte in memory
-        state.mem[state.rf[rs1] + imm_s] = state.rf[rs2] & 0xFF  # Store the least significant byte
+        address = access_address(state, rs1, imm_s, 1)
+        state.mem[address] = state.rf[rs2] & 0xFF  # Store the least significant byte
+        state.mark_dirty(address, 1)
 
         # Increment the program counter
         state.pc += 4
@@ -801,8 +822,10 @@ class Sh(InstructionImpl):
         imm_s = instruction.imm_s
 
         # Store the halfword in memory (little-endian format)
-        state.mem[state.rf[rs1] + imm_s] = (state.rf[rs2] & 0xFF)
-        state.mem[state.rf[rs1] + imm_s + 1] = (state.rf[rs2] >> 8) & 0xFF
+        address = access_address(state, rs1, imm_s, 2)
+        state.mem[address] = (state.rf[rs2] & 0xFF)
+        state.mem[address + 1] = (state.rf[rs2] >> 8) & 0xFF
+        state.mark_dirty(address, 2)
 
         # Increment the program counter
         state.pc += 4
@@ -822,10 +845,12 @@ class Sw(InstructionImpl):
         imm_s = instruction.imm_s
 
         # Store the word in memory (little-endian format)
-        state.mem[state.rf[rs1] + imm_s] = (state.rf[rs2] & 0xFF)
-        state.mem[state.rf[rs1] + imm_s + 1] = (state.rf[rs2] >> 8) & 0xFF
-        state.mem[state.rf[rs1] + imm_s + 2] = (state.rf[rs2] >> 16) & 0xFF
-        state.mem[state.rf[rs1] + imm_s + 3] = (state.rf[rs2] >> 24) & 0xFF
+        address = access_address(state, rs1, imm_s, 4)
+        state.mem[address] = (state.rf[rs2] & 0xFF)
+        state.mem[address + 1] = (state.rf[rs2] >> 8) & 0xFF
+        state.mem[address + 2] = (state.rf[rs2] >> 16) & 0xFF
+        state.mem[address + 3] = (state.rf[rs2] >> 24) & 0xFF
+        state.mark_dirty(address, 4)
 
         # Increment the program counter
         state.pc += 4
@@ -859,4 +884,10 @@ class Ebreak(InstructionImpl):
         state.halt = True
 
     def disassemble(self, instruction: Instruction):
-        return "ebreak"
\ No newline at end of file
+        return "ebreak"
+
+# Groups of implementations used by tools that observe execution
+BRANCHES = (Beq, Bne, Blt, Bge, Bltu, Bgeu)
+JUMPS = (Jal, JalR)
+LOADS = (Lb, Lbu, Lh, Lhu, Lw)
+STORES = (Sb, Sh, Sw)
@@ -0,0 +1,625 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+
+import numpy as np
+from typing import Callable
+from extension import Extension
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import u8, i64, u64, signed32
+from state import RVState
+
+# Major opcodes and funct3 values used by the vector extension
+OP_V     = 0b1010111
+LOAD_FP  = 0b0000111
+STORE_FP = 0b0100111
+
+OPIVV = 0b000
+OPMVV = 0b010
+OPIVI = 0b011
+OPIVX = 0b100
+OPMVX = 0b110
+OPCFG = 0b111
+
+# Element widths encoded in the width field of vector loads and stores
+LOAD_WIDTHS = {0b000: 8, 0b101: 16, 0b110: 32}
+
+# NumPy types for every supported element width
+UNSIGNED = {8: np.uint8, 16: np.uint16, 32: np.uint32}
+SIGNED   = {8: np.int8, 16: np.int16, 32: np.int32}
+
+class VectorState:
+    """
+    Architectural state of the vector unit.
+
+    The vector registers are stored as one flat byte array, so register groups
+    (LMUL > 1) are simply longer views starting at the first register.
+
+    Attributes:
+        vlen (int): Length of a vector register in bits.
+        vlenb (int): Length of a vector register in bytes.
+        vrf (np.ndarray[u8]): The 32 vector registers.
+        vl (int): The current vector length.
+        vtype (int): The current vector type.
+        sew (int): The selected element width in bits.
+        vill (bool): Whether the current vector type is illegal.
+    """
+    vlen:  int
+    vlenb: int
+    vrf:   np.ndarray[u8]
+    vl:    int
+    vtype: int
+    sew:   int
+    vill:  bool
+
+    def __init__(self, vlen: int = 128) -> None:
+        if vlen < 32 or vlen & (vlen - 1):
+            raise ValueError(f"VLEN must be a power of two of at least 32, got {vlen}")
+        self.vlen = vlen
+        self.vlenb = vlen // 8
+        self.vrf = np.zeros(32 * self.vlenb, dtype=u8)
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Resets the vector unit to its initial, illegal configuration.
+        """
+        self.vrf.fill(0)
+        self.vl = 0
+        self.vtype = 1 << 31
+        self.sew = 8
+        self.vill = True
+
+    def set_vtype(self, vtype: int, avl: int | None) -> int:
+        """
+        Sets the vector type and length as done by the vsetvl instructions.
+
+        Parameters:
+            vtype (int): The requested vector type.
+            avl (int | None): The application vector length, or None to request VLMAX.
+        Returns:
+            int: The new vector length.
+        """
+        vsew = (vtype >> 3) & 0b111
+        vlmul = vtype & 0b111
+        sew = 8 << vsew
+        # LMUL as a fraction: 1, 2, 4, 8 and 1/8, 1/4, 1/2
+        lmul_num, lmul_den = (1 << vlmul, 1) if vlmul < 4 else (1, 1 << (8 - vlmul))
+
+        if sew not in UNSIGNED or vlmul == 4 or vtype >> 8:
+            self.vtype = 1 << 31
+            self.vill = True
+            self.vl = 0
+            return 0
+
+        vlmax = self.vlen * lmul_num // (sew * lmul_den)
+        self.vtype = vtype
+        self.vill = False
+        self.sew = sew
+        self.vl = vlmax if avl is None else min(avl, vlmax)
+        return self.vl
+
+    def elements(self, register: int, width: int, count: int, signed: bool = False) -> np.ndarray:
+        """
+        Returns a writable view of the first elements of a register group.
+
+        Parameters:
+            register (int): The first register of the group.
+            width (int): The element width in bits.
+            count (int): The number of elements.
+            signed (bool): Whether to view the elements as signed integers.
+        Returns:
+            np.ndarray: The view of the elements.
+        """
+        start = register * self.vlenb
+        end = start + count * width // 8
+        if end > self.vrf.size:
+            raise NotImplementedError(f"Vector register group v{register} exceeds the register file")
+        return self.vrf[start:end].view((SIGNED if signed else UNSIGNED)[width])
+
+    def mask(self) -> np.ndarray:
+        """
+        Returns the mask register v0 as booleans for the active elements.
+        """
+        return np.unpackbits(self.vrf[:self.vlenb], bitorder="little")[:self.vl].astype(bool)
+
+    def check(self) -> None:
+        if self.vill:
+            raise NotImplementedError("Vector instruction executed with an illegal vector type")
+
+def funct6(instruction: Instruction) -> int:
+    return (int(instruction.instruction_word) >> 26) & 0x3F
+
+def vm_bit(instruction: Instruction) -> int:
+    return (int(instruction.instruction_word) >> 25) & 1
+
+def simm5(instruction: Instruction) -> int:
+    imm = int(instruction.rs1)
+    return imm - 32 if imm & 0x10 else imm
+
+def mask_suffix(instruction: Instruction) -> str:
+    return "" if vm_bit(instruction) else ", v0.t"
+
+def write_elements(vs: VectorState, instruction: Instruction, register: int, result: np.ndarray) -> None:
+    """
+    Writes the first vl elements of a register group, keeping the masked-off elements.
+    """
+    dst = vs.elements(register, vs.sew, vs.vl)
+    if vm_bit(instruction):
+        dst[:] = result
+    else:
+        np.copyto(dst, result, where=vs.mask())
+
+class V(Extension):
+    """
+    RISC-V V extension subset for integer vectors.
+
+    Supports vsetvl(i), unit-stride and strided loads and stores, integer
+    arithmetic, shifts, compares, reductions and masking for element widths
+    of 8, 16 and 32 bits. Every instruction operates on NumPy views of the
+    vector registers and memory, so a whole vector is processed by one
+    NumPy operation.
+    """
+
+    def __init__(self, vlen: int = 128):
+        """
+        Initializes the V extension.
+        Parameters:
+            vlen (int): Length of a vector register in bits. Defaults to 128.
+        """
+        self.vector_state = VectorState(vlen)
+
+    def snapshot(self) -> tuple:
+        vs = self.vector_state
+        return vs.vrf.copy(), vs.vl, vs.vtype, vs.sew, vs.vill
+
+    def restore(self, snapshot: tuple) -> None:
+        vs = self.vector_state
+        vrf, vs.vl, vs.vtype, vs.sew, vs.vill = snapshot
+        vs.vrf[:] = vrf
+
+    def reset(self) -> None:
+        self.vector_state.reset()
+
+    def get_instruction_implementations(self):
+        vs = self.vector_state
+        return [
+            # Configuration instructions
+            Vsetvli(vs),
+            Vsetivli(vs),
+            Vsetvl(vs),
+            # Load and store instructions
+            VLoad(vs),
+            VStore(vs),
+            # Integer arithmetic instructions
+            VBinary(vs, "vadd", 0b000000, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a + b),
+            VBinary(vs, "vsub", 0b000010, (OPIVV, OPIVX), lambda a, b, w: a - b),
+            VBinary(vs, "vrsub", 0b000011, (OPIVX, OPIVI), lambda a, b, w: b - a),
+            VBinary(vs, "vminu", 0b000100, (OPIVV, OPIVX), lambda a, b, w: np.minimum(a, b)),
+            VBinary(vs, "vmin", 0b000101, (OPIVV, OPIVX), lambda a, b, w: np.minimum(a, b), signed=True),
+            VBinary(vs, "vmaxu", 0b000110, (OPIVV, OPIVX), lambda a, b, w: np.maximum(a, b)),
+            VBinary(vs, "vmax", 0b000111, (OPIVV, OPIVX), lambda a, b, w: np.maximum(a, b), signed=True),
+            VBinary(vs, "vmul", 0b100101, (OPMVV, OPMVX), lambda a, b, w: a * b),
+            VBinary(vs, "vmulh", 0b100111, (OPMVV, OPMVX), lambda a, b, w: (a.astype(i64) * b) >> w, signed=True),
+            VBinary(vs, "vmulhu", 0b100100, (OPMVV, OPMVX), lambda a, b, w: (a.astype(u64) * b) >> u64(w)),
+            # Logical instructions
+            VBinary(vs, "vand", 0b001001, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a & b),
+            VBinary(vs, "vor", 0b001010, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a | b),
+            VBinary(vs, "vxor", 0b001011, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a ^ b),
+            # Shift instructions, the shift amount is taken modulo SEW
+            VBinary(vs, "vsll", 0b100101, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a << (b & (w - 1))),
+            VBinary(vs, "vsrl", 0b101000, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a >> (b & (w - 1))),
+            VBinary(vs, "vsra", 0b101001, (OPIVV, OPIVX, OPIVI), lambda a, b, w: a >> (b & (w - 1)), signed=True),
+            # Compare instructions writing a mask
+            VCompare(vs, "vmseq", 0b011000, (OPIVV, OPIVX, OPIVI), np.equal),
+            VCompare(vs, "vmsne", 0b011001, (OPIVV, OPIVX, OPIVI), np.not_equal),
+            VCompare(vs, "vmsltu", 0b011010, (OPIVV, OPIVX), np.less),
+            VCompare(vs, "vmslt", 0b011011, (OPIVV, OPIVX), np.less, signed=True),
+            VCompare(vs, "vmsleu", 0b011100, (OPIVV, OPIVX, OPIVI), np.less_equal),
+            VCompare(vs, "vmsle", 0b011101, (OPIVV, OPIVX, OPIVI), np.less_equal, signed=True),
+            VCompare(vs, "vmsgtu", 0b011110, (OPIVX, OPIVI), np.greater),
+            VCompare(vs, "vmsgt", 0b011111, (OPIVX, OPIVI), np.greater, signed=True),
+            # Reduction instructions
+            VReduction(vs, "vredsum", 0b000000, lambda a: np.add.reduce(a, dtype=u64)),
+            VReduction(vs, "vredand", 0b000001, np.bitwise_and.reduce),
+            VReduction(vs, "vredor", 0b000010, np.bitwise_or.reduce),
+            VReduction(vs, "vredxor", 0b000011, np.bitwise_xor.reduce),
+            VReduction(vs, "vredminu", 0b000100, np.min),
+            VReduction(vs, "vredmin", 0b000101, np.min, signed=True),
+            VReduction(vs, "vredmaxu", 0b000110, np.max),
+            VReduction(vs, "vredmax", 0b000111, np.max, signed=True),
+            # Move instructions
+            VMerge(vs),
+            VMvXS(vs),
+            VMvSX(vs),
+        ]
+
+class Vsetvli(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and instruction.funct3 == OPCFG \
+           and (int(instruction.instruction_word) >> 31) == 0
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        rd = instruction.rd
+        rs1 = instruction.rs1
+        vtype = (int(instruction.instruction_word) >> 20) & 0x7FF
+
+        # rs1 = x0 requests VLMAX, unless rd is x0 too, which keeps vl
+        if rs1 != 0:
+            avl = int(state.rf[rs1]) & 0xFFFFFFFF
+        elif rd != 0:
+            avl = None
+        else:
+            avl = self.vs.vl
+        state.rf[rd] = self.vs.set_vtype(vtype, avl)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"vsetvli x{instruction.rd}, x{instruction.rs1}, {format_vtype((int(instruction.instruction_word) >> 20) & 0x7FF)}"
+
+class Vsetivli(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and instruction.funct3 == OPCFG \
+           and (int(instruction.instruction_word) >> 30) == 0b11
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # The application vector length is the 5-bit immediate in the rs1 field
+        vtype = (int(instruction.instruction_word) >> 20) & 0x3FF
+        state.rf[instruction.rd] = self.vs.set_vtype(vtype, int(instruction.rs1))
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"vsetivli x{instruction.rd}, {instruction.rs1}, {format_vtype((int(instruction.instruction_word) >> 20) & 0x3FF)}"
+
+class Vsetvl(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and instruction.funct3 == OPCFG \
+           and (int(instruction.instruction_word) >> 25) == 0b1000000
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        rd = instruction.rd
+        rs1 = instruction.rs1
+        vtype = int(state.rf[instruction.rs2]) & 0xFFFFFFFF
+
+        if rs1 != 0:
+            avl = int(state.rf[rs1]) & 0xFFFFFFFF
+        elif rd != 0:
+            avl = None
+        else:
+            avl = self.vs.vl
+        state.rf[rd] = self.vs.set_vtype(vtype, avl)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"vsetvl x{instruction.rd}, x{instruction.rs1}, x{instruction.rs2}"
+
+def format_vtype(vtype: int) -> str:
+    lmul = ["m1", "m2", "m4", "m8", "m?", "mf8", "mf4", "mf2"][vtype & 0b111]
+    sew = 8 << ((vtype >> 3) & 0b111)
+    ta = "ta" if vtype & 0x40 else "tu"
+    ma = "ma" if vtype & 0x80 else "mu"
+    return f"e{sew}, {lmul}, {ta}, {ma}"
+
+def element_addresses(state: RVState, instruction: Instruction, vs: VectorState,
+                      width: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the indices of the active elements of a strided or masked memory
+    access and the addresses of their bytes, one row per element.
+    """
+    base = int(state.rf[instruction.rs1]) & 0xFFFFFFFF
+    mop = (int(instruction.instruction_word) >> 26) & 0b11
+    stride = int(state.rf[instruction.rs2]) if mop == 0b10 else width // 8
+    active = np.arange(vs.vl, dtype=i64)
+    if not vm_bit(instruction):
+        active = active[vs.mask()]
+    addresses = base + active * stride
+    if addresses.size and (addresses.min() < 0 or addresses.max() + width // 8 > state.mem.size):
+        raise IndexError(f"Vector memory access out of bounds at {base:#010x}")
+    return active, addresses[:, None] + np.arange(width // 8)
+
+class VLoad(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        word = int(instruction.instruction_word)
+        mop = (word >> 26) & 0b11
+        return instruction.opcode == LOAD_FP \
+           and int(instruction.funct3) in LOAD_WIDTHS \
+           and word >> 28 == 0 \
+           and (mop == 0b10 or (mop == 0b00 and instruction.rs2 == 0))
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        width = LOAD_WIDTHS[int(instruction.funct3)]
+        dst = vs.elements(instruction.rd, width, vs.vl)
+        unit_stride = (int(instruction.instruction_word) >> 26) & 0b11 == 0
+
+        if unit_stride and vm_bit(instruction):
+            # Contiguous unmasked load: a single slice of memory
+            base = int(state.rf[instruction.rs1]) & 0xFFFFFFFF
+            size = vs.vl * width // 8
+            if base + size > state.mem.size:
+                raise IndexError(f"Vector memory access out of bounds at {base:#010x}")
+            dst[:] = state.mem[base:base + size].view(UNSIGNED[width])
+        else:
+            # Gather the bytes of all active elements
+            active, addresses = element_addresses(state, instruction, vs, width)
+            dst[active] = state.mem[addresses].view(UNSIGNED[width]).reshape(-1)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        width = LOAD_WIDTHS[int(instruction.funct3)]
+        if (int(instruction.instruction_word) >> 26) & 0b11 == 0b10:
+            return f"vlse{width}.v v{instruction.rd}, (x{instruction.rs1}), x{instruction.rs2}{mask_suffix(instruction)}"
+        return f"vle{width}.v v{instruction.rd}, (x{instruction.rs1}){mask_suffix(instruction)}"
+
+class VStore(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        word = int(instruction.instruction_word)
+        mop = (word >> 26) & 0b11
+        return instruction.opcode == STORE_FP \
+           and int(instruction.funct3) in LOAD_WIDTHS \
+           and word >> 28 == 0 \
+           and (mop == 0b10 or (mop == 0b00 and instruction.rs2 == 0))
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        width = LOAD_WIDTHS[int(instruction.funct3)]
+        # The register holding the data to store is encoded in the rd field
+        src = vs.elements(instruction.rd, width, vs.vl)
+        unit_stride = (int(instruction.instruction_word) >> 26) & 0b11 == 0
+
+        if unit_stride and vm_bit(instruction):
+            # Contiguous unmasked store: a single slice of memory
+            base = int(state.rf[instruction.rs1]) & 0xFFFFFFFF
+            size = vs.vl * width // 8
+            if base + size > state.mem.size:
+                raise IndexError(f"Vector memory access out of bounds at {base:#010x}")
+            state.mem[base:base + size] = src.view(u8)
+            if size:
+                state.mark_dirty(base, size)
+        else:
+            # Scatter the bytes of all active elements
+            active, addresses = element_addresses(state, instruction, vs, width)
+            state.mem[addresses] = src[active].view(u8).reshape(-1, width // 8)
+            if addresses.size:
+                low, high = int(addresses.min()), int(addresses.max())
+                state.mark_dirty(low, high - low + 1)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        width = LOAD_WIDTHS[int(instruction.funct3)]
+        if (int(instruction.instruction_word) >> 26) & 0b11 == 0b10:
+            return f"vsse{width}.v v{instruction.rd}, (x{instruction.rs1}), x{instruction.rs2}{mask_suffix(instruction)}"
+        return f"vse{width}.v v{instruction.rd}, (x{instruction.rs1}){mask_suffix(instruction)}"
+
+class VectorOp(InstructionImpl):
+    """
+    Base class for OP-V instructions identified by funct6 and a set of operand forms.
+    """
+
+    def __init__(self, vector_state: VectorState, name: str, funct6: int, forms: tuple[int, ...],
+                 signed: bool = False):
+        self.vs = vector_state
+        self.name = name
+        self.funct6 = funct6
+        self.forms = forms
+        self.signed = signed
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and int(instruction.funct3) in self.forms \
+           and funct6(instruction) == self.funct6
+
+    def operands(self, state: RVState, instruction: Instruction) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the vs2 elements and the second operand, which is either the vs1
+        elements, the scalar in rs1 or the immediate, converted to the element type.
+        """
+        vs = self.vs
+        sew = vs.sew
+        a = vs.elements(instruction.rs2, sew, vs.vl, self.signed)
+        form = int(instruction.funct3)
+        if form in (OPIVV, OPMVV):
+            return a, vs.elements(instruction.rs1, sew, vs.vl, self.signed)
+        if form in (OPIVX, OPMVX):
+            scalar = int(state.rf[instruction.rs1])
+        elif self.name in ("vsll", "vsrl", "vsra"):
+            scalar = int(instruction.rs1)
+        else:
+            scalar = simm5(instruction)
+        unsigned = UNSIGNED[sew](scalar & ((1 << sew) - 1))
+        return a, unsigned.view(SIGNED[sew]) if self.signed else unsigned
+
+    def disassemble(self, instruction: Instruction):
+        form = int(instruction.funct3)
+        if form in (OPIVV, OPMVV):
+            return f"{self.name}.vv v{instruction.rd}, v{instruction.rs2}, v{instruction.rs1}{mask_suffix(instruction)}"
+        if form in (OPIVX, OPMVX):
+            return f"{self.name}.vx v{instruction.rd}, v{instruction.rs2}, x{instruction.rs1}{mask_suffix(instruction)}"
+        return f"{self.name}.vi v{instruction.rd}, v{instruction.rs2}, {simm5(instruction)}{mask_suffix(instruction)}"
+
+class VBinary(VectorOp):
+    """
+    Element-wise integer operation writing a vector register group.
+    """
+
+    def __init__(self, vector_state: VectorState, name: str, funct6: int, forms: tuple[int, ...],
+                 operation: Callable[[np.ndarray, np.ndarray, int], np.ndarray], signed: bool = False):
+        super().__init__(vector_state, name, funct6, forms, signed)
+        self.operation = operation
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        a, b = self.operands(state, instruction)
+        result = self.operation(a, b, vs.sew)
+        # Truncate to the element width, reinterpreting signed results
+        result = np.asarray(result).astype(SIGNED[vs.sew] if self.signed else UNSIGNED[vs.sew])
+        write_elements(vs, instruction, instruction.rd, result.view(UNSIGNED[vs.sew]))
+
+        # Increment the program counter
+        state.pc += 4
+
+class VCompare(VectorOp):
+    """
+    Element-wise integer compare writing a mask register.
+    """
+
+    def __init__(self, vector_state: VectorState, name: str, funct6: int, forms: tuple[int, ...],
+                 operation: Callable[[np.ndarray, np.ndarray], np.ndarray], signed: bool = False):
+        super().__init__(vector_state, name, funct6, forms, signed)
+        self.operation = operation
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        a, b = self.operands(state, instruction)
+        result = self.operation(a, b)
+
+        # Mask registers hold one bit per element, masked-off bits are kept
+        start = int(instruction.rd) * vs.vlenb
+        bits = np.unpackbits(vs.vrf[start:start + vs.vlenb], bitorder="little")
+        if vm_bit(instruction):
+            bits[:vs.vl] = result
+        else:
+            np.copyto(bits[:vs.vl], result, where=vs.mask(), casting="unsafe")
+        vs.vrf[start:start + vs.vlenb] = np.packbits(bits, bitorder="little")
+
+        # Increment the program counter
+        state.pc += 4
+
+class VReduction(VectorOp):
+    """
+    Reduction of the active vs2 elements and element 0 of vs1 into element 0 of vd.
+    """
+
+    def __init__(self, vector_state: VectorState, name: str, funct6: int,
+                 operation: Callable[[np.ndarray], np.ndarray], signed: bool = False):
+        super().__init__(vector_state, name, funct6, (OPMVV,), signed)
+        self.operation = operation
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        if vs.vl > 0:
+            a = vs.elements(instruction.rs2, vs.sew, vs.vl, self.signed)
+            if not vm_bit(instruction):
+                a = a[vs.mask()]
+            init = vs.elements(instruction.rs1, vs.sew, 1, self.signed)
+            result = self.operation(np.concatenate([init, a]))
+            dtype = SIGNED[vs.sew] if self.signed else UNSIGNED[vs.sew]
+            vs.elements(instruction.rd, vs.sew, 1, self.signed)[0] = np.asarray(result).astype(dtype)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"{self.name}.vs v{instruction.rd}, v{instruction.rs2}, v{instruction.rs1}{mask_suffix(instruction)}"
+
+class VMerge(VectorOp):
+    """
+    vmerge and its unmasked form vmv.v.{v,x,i}, which copies the second operand.
+    """
+
+    def __init__(self, vector_state: VectorState):
+        super().__init__(vector_state, "vmerge", 0b010111, (OPIVV, OPIVX, OPIVI))
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        vs = self.vs
+        vs.check()
+        _, b = self.operands(state, instruction)
+        dst = vs.elements(instruction.rd, vs.sew, vs.vl)
+        if vm_bit(instruction):
+            dst[:] = b
+        else:
+            # Take the second operand where the mask is set and vs2 elsewhere
+            a = vs.elements(instruction.rs2, vs.sew, vs.vl)
+            dst[:] = np.where(vs.mask(), b, a)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        form = int(instruction.funct3)
+        operand = {OPIVV: f"v{instruction.rs1}", OPIVX: f"x{instruction.rs1}"}.get(form, str(simm5(instruction)))
+        suffix = {OPIVV: "v", OPIVX: "x"}.get(form, "i")
+        if vm_bit(instruction):
+            return f"vmv.v.{suffix} v{instruction.rd}, {operand}"
+        return f"vmerge.v{suffix}m v{instruction.rd}, v{instruction.rs2}, {operand}, v0"
+
+class VMvXS(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and instruction.funct3 == OPMVV \
+           and funct6(instruction) == 0b010000 \
+           and instruction.rs1 == 0
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Copy element 0 of vs2 to rd, sign-extended from SEW bits
+        vs = self.vs
+        vs.check()
+        state.rf[instruction.rd] = signed32(vs.elements(instruction.rs2, vs.sew, 1, signed=True)[0])
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"vmv.x.s x{instruction.rd}, v{instruction.rs2}"
+
+class VMvSX(InstructionImpl):
+    def __init__(self, vector_state: VectorState):
+        self.vs = vector_state
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == OP_V \
+           and instruction.funct3 == OPMVX \
+           and funct6(instruction) == 0b010000 \
+           and instruction.rs2 == 0
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Copy rs1 to element 0 of vd if the vector length is not zero
+        vs = self.vs
+        vs.check()
+        if vs.vl > 0:
+            value = int(state.rf[instruction.rs1]) & ((1 << vs.sew) - 1)
+            vs.elements(instruction.rd, vs.sew, 1)[0] = value
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"vmv.s.x v{instruction.rd}, x{instruction.rs1}"
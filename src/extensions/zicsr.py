@@ -0,0 +1,221 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+
+import time
+from extension import Extension
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import signed32
+from state import RVState
+
+# Addresses of the unprivileged counter CSRs (Zicntr)
+CYCLE    = 0xC00
+TIME     = 0xC01
+INSTRET  = 0xC02
+CYCLEH   = 0xC80
+TIMEH    = 0xC81
+INSTRETH = 0xC82
+
+CSR_NAMES = {
+    CYCLE: "cycle", TIME: "time", INSTRET: "instret",
+    CYCLEH: "cycleh", TIMEH: "timeh", INSTRETH: "instreth",
+}
+
+class Zicsr(Extension):
+    """
+    RISC-V Zicsr extension with the Zicntr counters.
+    This extension implements the CSR access instructions for the read-only
+    cycle, time and instret counters and their upper halves.
+
+    instret is the retired instruction counter of the state, which the VM
+    updates once per executed block. Without a timing model every instruction
+    takes one cycle, so cycle equals instret. time is read from the host
+    monotonic clock.
+    """
+
+    def __init__(self, time_frequency: int = 1_000_000):
+        """
+        Initializes the Zicsr extension.
+        Parameters:
+            time_frequency (int): Frequency of the time counter in Hz. Defaults to 1 MHz.
+        """
+        self.counters = Counters(time_frequency)
+
+    def get_instruction_implementations(self):
+        return [
+            Csrrw(self.counters),
+            Csrrs(self.counters),
+            Csrrc(self.counters),
+            Csrrwi(self.counters),
+            Csrrsi(self.counters),
+            Csrrci(self.counters),
+        ]
+
+class Counters:
+    """
+    Source of the counter CSR values.
+
+    Attributes:
+        time_frequency (int): Frequency of the time counter in Hz.
+        time_origin (int): Host monotonic time in nanoseconds at which the time counter was zero.
+    """
+
+    def __init__(self, time_frequency: int):
+        self.time_frequency = time_frequency
+        self.time_origin = time.monotonic_ns()
+
+    def time(self) -> int:
+        return (time.monotonic_ns() - self.time_origin) * self.time_frequency // 1_000_000_000
+
+    def cycle(self, state: RVState) -> int:
+        return state.instret
+
+    def read(self, state: RVState, csr: int) -> int:
+        """
+        Reads a 64-bit counter and returns the requested 32-bit half.
+
+        Raises:
+            NotImplementedError: If the CSR is not implemented, which makes the instruction illegal.
+        """
+        counter = csr & ~0x080
+        if counter == CYCLE:
+            value = self.cycle(state)
+        elif counter == TIME:
+            value = self.time()
+        elif counter == INSTRET:
+            value = state.instret
+        else:
+            raise NotImplementedError(f"CSR {csr:#05x} is not implemented")
+        return (value >> 32 if csr & 0x080 else value) & 0xFFFFFFFF
+
+def csr_write(csr: int) -> None:
+    """
+    Rejects a write to a CSR, as all implemented counters are read-only.
+    """
+    raise NotImplementedError(f"Write to read-only CSR {CSR_NAMES.get(csr, hex(csr))}")
+
+def csr_name(instruction: Instruction) -> str:
+    csr = int(instruction.funct12)
+    return CSR_NAMES.get(csr, f"{csr:#05x}")
+
+class Csrrw(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b001
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # CSRRW always writes the CSR
+        csr_write(int(instruction.funct12))
+
+    def disassemble(self, instruction: Instruction):
+        return f"csrrw x{instruction.rd}, {csr_name(instruction)}, x{instruction.rs1}"
+
+class Csrrs(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b010
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the CSR, setting bits is only allowed with rs1 = x0
+        csr = int(instruction.funct12)
+        value = self.counters.read(state, csr)
+        if instruction.rs1 != 0:
+            csr_write(csr)
+        state.rf[instruction.rd] = signed32(value)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        if instruction.rs1 == 0:
+            return f"csrr x{instruction.rd}, {csr_name(instruction)}"
+        return f"csrrs x{instruction.rd}, {csr_name(instruction)}, x{instruction.rs1}"
+
+class Csrrc(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b011
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the CSR, clearing bits is only allowed with rs1 = x0
+        csr = int(instruction.funct12)
+        value = self.counters.read(state, csr)
+        if instruction.rs1 != 0:
+            csr_write(csr)
+        state.rf[instruction.rd] = signed32(value)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"csrrc x{instruction.rd}, {csr_name(instruction)}, x{instruction.rs1}"
+
+class Csrrwi(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b101
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # CSRRWI always writes the CSR
+        csr_write(int(instruction.funct12))
+
+    def disassemble(self, instruction: Instruction):
+        return f"csrrwi x{instruction.rd}, {csr_name(instruction)}, {instruction.rs1}"
+
+class Csrrsi(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b110
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the CSR, the immediate in the rs1 field must be zero
+        csr = int(instruction.funct12)
+        value = self.counters.read(state, csr)
+        if instruction.rs1 != 0:
+            csr_write(csr)
+        state.rf[instruction.rd] = signed32(value)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"csrrsi x{instruction.rd}, {csr_name(instruction)}, {instruction.rs1}"
+
+class Csrrci(InstructionImpl):
+    def __init__(self, counters: Counters):
+        self.counters = counters
+
+    def match(self, instruction: Instruction) -> bool:
+        return instruction.opcode == 0b1110011 \
+           and instruction.funct3 == 0b111
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        # Read the CSR, the immediate in the rs1 field must be zero
+        csr = int(instruction.funct12)
+        value = self.counters.read(state, csr)
+        if instruction.rs1 != 0:
+            csr_write(csr)
+        state.rf[instruction.rd] = signed32(value)
+
+        # Increment the program counter
+        state.pc += 4
+
+    def disassemble(self, instruction: Instruction):
+        return f"csrrci x{instruction.rd}, {csr_name(instruction)}, {instruction.rs1}"
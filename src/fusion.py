@@ -0,0 +1,152 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from typing import Callable
+from extensions import rv32i
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import u32, signed32
+from state import RVState
+
+# Signature of the execute method of an instruction or a fused pair
+Execute = Callable[[RVState, Instruction], None]
+
+def lui_addi(address: int, first: Instruction, second: Instruction) -> Execute | None:
+    """
+    lui rd, hi; addi rd, rd, lo: loads a 32-bit constant.
+    """
+    rd = int(first.rd)
+    if int(second.rd) != rd or int(second.rs1) != rd:
+        return None
+    value = signed32(int(first.imm_u) + int(second.imm_i))
+
+    def execute(state: RVState, instruction: Instruction) -> None:
+        state.rf[rd] = value
+        state.pc += 8
+    return execute
+
+def auipc_jalr(address: int, first: Instruction, second: Instruction) -> Execute | None:
+    """
+    auipc rt, hi; jalr rd, lo(rt): calls or jumps to a PC-relative address.
+    """
+    rt, rd = int(first.rd), int(second.rd)
+    if int(second.rs1) != rt:
+        return None
+    base = signed32(address + int(first.imm_u))
+    target = u32((address + int(first.imm_u) + int(second.imm_i)) & 0xFFFFFFFE)
+    link = signed32(address + 8)
+
+    def execute(state: RVState, instruction: Instruction) -> None:
+        state.rf[rt] = base
+        if rd:
+            state.rf[rd] = link
+        state.pc = target
+    return execute
+
+def auipc_lw(address: int, first: Instruction, second: Instruction) -> Execute | None:
+    """
+    auipc rt, hi; lw rd, lo(rt): loads a word from a PC-relative address.
+    """
+    rt, rd = int(first.rd), int(second.rd)
+    if int(second.rs1) != rt or rd == 0:
+        return None
+    base = signed32(address + int(first.imm_u))
+    load = (address + int(first.imm_u) + int(second.imm_i)) & 0xFFFFFFFF
+
+    def execute(state: RVState, instruction: Instruction) -> None:
+        state.rf[rt] = base
+        # Advance to the load first, so that a fault reports its address
+        state.pc += 4
+        if load + 4 > state.mem.size:
+            raise IndexError(f"Memory access out of bounds at {load:#010x}")
+        state.rf[rd] = int.from_bytes(state.mem[load:load + 4].tobytes(), "little", signed=True)
+        state.pc += 4
+    return execute
+
+def slli_add(address: int, first: Instruction, second: Instruction) -> Execute | None:
+    """
+    slli rt, ri, s; add rd, rb, rt: computes the address of an array element.
+    """
+    rt, ri, shift = int(first.rd), int(first.rs1), int(first.imm_i) & 0x1F
+    rd, rs1, rs2 = int(second.rd), int(second.rs1), int(second.rs2)
+    if rd == 0 or rt not in (rs1, rs2):
+        return None
+    other = rs2 if rs1 == rt else rs1
+
+    def execute(state: RVState, instruction: Instruction) -> None:
+        rf = state.rf
+        scaled = signed32(int(rf[ri]) << shift)
+        rf[rt] = scaled
+        rf[rd] = signed32(scaled + int(rf[other]))
+        state.pc += 8
+    return execute
+
+def compare_branch(address: int, first: Instruction, second: Instruction) -> Execute | None:
+    """
+    slt[i][u] rt, ...; beqz/bnez rt, target: compares and branches on the result.
+    """
+    rt = int(first.rd)
+    if {int(second.rs1), int(second.rs2)} != {rt, 0}:
+        return None
+    # bnez branches if the comparison is true, beqz if it is false
+    branch_if = int(second.funct3) == 0b001
+    rs1, rs2, immediate = int(first.rs1), int(first.rs2), int(first.imm_i)
+    unsigned = int(first.funct3) == 0b011
+    taken = u32(address + 4 + int(second.imm_b))
+    fallthrough = u32(address + 8)
+
+    if int(first.opcode) == 0b0110011:
+        if unsigned:
+            def compare(rf) -> bool:
+                return int(rf[rs1]) & 0xFFFFFFFF < int(rf[rs2]) & 0xFFFFFFFF
+        else:
+            def compare(rf) -> bool:
+                return bool(rf[rs1] < rf[rs2])
+    elif unsigned:
+        def compare(rf) -> bool:
+            return int(rf[rs1]) & 0xFFFFFFFF < immediate & 0xFFFFFFFF
+    else:
+        def compare(rf) -> bool:
+            return int(rf[rs1]) < immediate
+
+    def execute(state: RVState, instruction: Instruction) -> None:
+        result = compare(state.rf)
+        state.rf[rt] = result
+        state.pc = taken if result == branch_if else fallthrough
+    return execute
+
+# Fusible pairs: implementations of the first and second instruction, name and builder
+PAIRS = [
+    ((rv32i.Lui,), (rv32i.AddI,), "lui+addi", lui_addi),
+    ((rv32i.Auipc,), (rv32i.JalR,), "auipc+jalr", auipc_jalr),
+    ((rv32i.Auipc,), (rv32i.Lw,), "auipc+lw", auipc_lw),
+    ((rv32i.SllI,), (rv32i.Add,), "slli+add", slli_add),
+    ((rv32i.Slt, rv32i.Sltu, rv32i.SltI, rv32i.SltuI), (rv32i.Beq, rv32i.Bne), "compare+branch", compare_branch),
+]
+
+def fuse(address: int, first_impl: InstructionImpl, first: Instruction,
+         second_impl: InstructionImpl, second: Instruction) -> tuple[str, Execute] | None:
+    """
+    Tries to fuse two adjacent instructions into one operation.
+
+    Only exact implementations are fused: a wrapped implementation is
+    observed by a tool that expects to see every instruction.
+
+    Parameters:
+        address (int): Address of the first instruction.
+        first_impl (InstructionImpl): Implementation of the first instruction.
+        first (Instruction): The first instruction.
+        second_impl (InstructionImpl): Implementation of the second instruction.
+        second (Instruction): The second instruction.
+    Returns:
+        tuple[str, Execute] | None: The name of the idiom and the fused execute function,
+            or None if the pair cannot be fused.
+    """
+    if int(first.rd) == 0:
+        return None
+    for first_kinds, second_kinds, name, build in PAIRS:
+        if type(first_impl) in first_kinds and type(second_impl) in second_kinds:
+            execute = build(address, first, second)
+            return (name, execute) if execute is not None else None
+    return None
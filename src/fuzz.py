@@ -0,0 +1,341 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import os
+import pickle
+import random
+import struct
+import numpy as np
+from extensions.rv32i import BRANCHES, JUMPS
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from nums import u8
+from state import RVState, Snapshot
+from vm import VM
+
+# Implementations whose execution ends a basic block
+CONTROL_TRANSFERS = BRANCHES + JUMPS
+
+# AFL hit count buckets: 0, 1, 2, 3, 4-7, 8-15, 16-31, 32-127, 128-255
+COUNT_CLASS = np.zeros(256, dtype=u8)
+COUNT_CLASS[1] = 1
+COUNT_CLASS[2] = 2
+COUNT_CLASS[3] = 4
+COUNT_CLASS[4:8] = 8
+COUNT_CLASS[8:16] = 16
+COUNT_CLASS[16:32] = 32
+COUNT_CLASS[32:128] = 64
+COUNT_CLASS[128:] = 128
+
+# Values that tend to trigger edge cases in parsers
+INTERESTING_8  = [-128, -1, 0, 1, 16, 32, 64, 100, 127]
+INTERESTING_16 = [-32768, -129, 128, 255, 256, 512, 1000, 1024, 4096, 32767]
+INTERESTING_32 = [-2147483648, -100663046, -32769, 32768, 65535, 65536, 100663045, 2147483647]
+
+class EdgeRecorder(ImplWrapper):
+    """
+    Records the edge taken by a branch or jump in an AFL-style bitmap.
+
+    The edge index is computed from the address of the control transfer
+    and its target, so both taken and fall-through edges are recorded.
+    """
+
+    def __init__(self, impl: InstructionImpl, bitmap: bytearray) -> None:
+        super().__init__(impl)
+        self.bitmap = bitmap
+        self.mask = len(bitmap) - 1
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        src = int(state.pc)
+        self.impl.execute(state, instruction)
+        dst = int(state.pc)
+
+        # Same scheme as AFL: shift the previous location so that A->B and B->A differ
+        index = (((src >> 2) * 0x9E3779B1 >> 1) ^ ((dst >> 2) * 0x85EBCA6B)) & self.mask
+        self.bitmap[index] = (self.bitmap[index] + 1) & 0xFF
+
+class ExecResult:
+    """
+    The result of executing a single fuzzing input.
+
+    Attributes:
+        status (str): "ok" if the guest halted, "timeout" if it hit the step limit, "crash" if it faulted or raised an exception.
+        new_coverage (bool): True if the input reached previously unseen coverage.
+        error (Exception | None): The exception raised by a crashing input.
+    """
+    status:       str
+    new_coverage: bool
+    error:        Exception | None
+
+    def __init__(self, status: str, new_coverage: bool, error: Exception | None = None) -> None:
+        self.status = status
+        self.new_coverage = new_coverage
+        self.error = error
+
+    def __repr__(self) -> str:
+        return f"ExecResult(status={self.status!r}, new_coverage={self.new_coverage}, error={self.error!r})"
+
+class Fuzzer:
+    """
+    In-process coverage-guided fuzzer for guest code.
+
+    The VM is run up to a harness entry point once and snapshotted there.
+    Every input is then written into a guest buffer, the buffer address and
+    length are passed in a0 and a1, and the harness is executed until it halts
+    (via the exit ECALL or EBREAK) or the step limit is reached. Afterwards only
+    the memory pages written during the execution are restored, together with
+    the registers and the state of the extensions.
+
+    Attributes:
+        vm (VM): The VM running the harness.
+        input_address (int): Guest address the input is written to.
+        max_input_size (int): Maximum size of an input in bytes.
+        step_limit (int): Maximum number of steps per execution.
+        trace (np.ndarray[u8]): Edge hit counts of the current execution.
+        virgin (np.ndarray[u8]): Bucket bits not yet seen for every edge.
+        corpus (list[bytes]): Inputs that reached new coverage.
+        crashes (list[tuple[bytes, Exception]]): Inputs that crashed the guest and their errors.
+        timeouts (int): Number of executions that reached the step limit.
+        executions (int): Total number of executions.
+    """
+
+    def __init__(self, vm: VM, entry_pc: int, input_address: int, max_input_size: int = 4096,
+                 step_limit: int = 100_000, map_size: int = 1 << 16, seed: int | None = None) -> None:
+        """
+        Initializes the fuzzer. The program must already be loaded into the VM.
+
+        Parameters:
+            vm (VM): The VM to fuzz.
+            entry_pc (int): Address of the harness entry point.
+            input_address (int): Guest address the input is written to.
+            max_input_size (int): Maximum size of an input in bytes. Defaults to 4096.
+            step_limit (int): Maximum number of steps per execution. Defaults to 100000.
+            map_size (int): Size of the edge coverage bitmap, must be a power of two. Defaults to 65536.
+            seed (int | None): Seed for the mutation engine.
+        """
+        if map_size <= 0 or map_size & (map_size - 1):
+            raise ValueError(f"Map size must be a power of two, got {map_size}")
+        if input_address < 0 or input_address + max_input_size > vm.state.mem.size:
+            raise ValueError(f"Input buffer out of bounds: {input_address} + {max_input_size} exceeds memory size")
+
+        self.vm = vm
+        self.entry_pc = entry_pc
+        self.input_address = input_address
+        self.max_input_size = max_input_size
+        self.step_limit = step_limit
+        self.rng = random.Random(seed)
+
+        self._bitmap = bytearray(map_size)
+        self.trace = np.frombuffer(self._bitmap, dtype=u8)
+        self.virgin = np.full(map_size, 0xFF, dtype=u8)
+
+        self.corpus = []
+        self.crashes = []
+        self.timeouts = 0
+        self.executions = 0
+        self._snapshot: Snapshot | None = None
+        self._extensions: list[object | None] = []
+
+    def start(self, max_steps: int = 10_000_000) -> None:
+        """
+        Runs the VM until it reaches the harness entry point, instruments
+        the control transfer instructions and snapshots the state.
+
+        Parameters:
+            max_steps (int): Maximum number of steps to reach the entry point.
+        Raises:
+            RuntimeError: If the entry point is not reached.
+        """
+        state = self.vm.state
+        steps = 0
+        while state.pc != self.entry_pc:
+            if state.halt or steps >= max_steps:
+                raise RuntimeError(f"Harness entry point {self.entry_pc:#010x} was not reached")
+            self.vm.step()
+            steps += 1
+
+        impls = self.vm.instruction_implementations
+        for i, impl in enumerate(impls):
+            if isinstance(unwrap(impl), CONTROL_TRANSFERS):
+                impls[i] = EdgeRecorder(impl, self._bitmap)
+        self.vm.flush_decode_cache()
+
+        self._snapshot = state.snapshot()
+        self._extensions = self.vm.snapshot_extensions()
+
+    def execute(self, data: bytes) -> ExecResult:
+        """
+        Executes the harness with a single input and restores the snapshot afterwards.
+
+        Parameters:
+            data (bytes): The input.
+        Returns:
+            ExecResult: The result of the execution.
+        """
+        if self._snapshot is None:
+            raise RuntimeError("Fuzzer.start() must be called before executing inputs")
+        data = bytes(data[:self.max_input_size])
+        state = self.vm.state
+
+        # Pass the input to the harness as (a0 = buffer, a1 = length)
+        state.load_memory(self.input_address, data)
+        state.rf[10] = self.input_address
+        state.rf[11] = len(data)
+
+        self.trace.fill(0)
+        error = None
+        try:
+            result = self.vm.run(self.step_limit)
+            error = result.error
+            status = "crash" if error is not None else "ok" if state.halt else "timeout"
+        except Exception as e:
+            status = "crash"
+            error = e
+
+        state.restore(self._snapshot)
+        self.vm.restore_extensions(self._extensions)
+        self.executions += 1
+        return ExecResult(status, self._update_coverage(), error)
+
+    def _update_coverage(self) -> bool:
+        """
+        Merges the trace of the last execution into the virgin map.
+
+        Returns:
+            bool: True if the trace contained unseen edges or hit count buckets.
+        """
+        classified = COUNT_CLASS[self.trace]
+        if not (classified & self.virgin).any():
+            return False
+        self.virgin &= ~classified
+        return True
+
+    def mutate(self, data: bytes) -> bytes:
+        """
+        Applies a random stack of havoc mutations to an input.
+
+        Parameters:
+            data (bytes): The input to mutate.
+        Returns:
+            bytes: The mutated input.
+        """
+        rng = self.rng
+        buf = bytearray(data) or bytearray(1)
+        for _ in range(1 << rng.randint(0, 4)):
+            choice = rng.randrange(9)
+            pos = rng.randrange(len(buf))
+            if choice == 0:
+                # Flip a single bit
+                buf[pos] ^= 1 << rng.randrange(8)
+            elif choice == 1:
+                # Set a random byte
+                buf[pos] = rng.randrange(256)
+            elif choice == 2:
+                # Add or subtract a small value
+                buf[pos] = (buf[pos] + rng.randint(-35, 35)) & 0xFF
+            elif choice == 3:
+                buf[pos] = rng.choice(INTERESTING_8) & 0xFF
+            elif choice == 4 and len(buf) >= 2:
+                pos = rng.randrange(len(buf) - 1)
+                buf[pos:pos + 2] = struct.pack("<h", rng.choice(INTERESTING_8 + INTERESTING_16))
+            elif choice == 5 and len(buf) >= 4:
+                pos = rng.randrange(len(buf) - 3)
+                buf[pos:pos + 4] = struct.pack("<i", rng.choice(INTERESTING_8 + INTERESTING_16 + INTERESTING_32))
+            elif choice == 6 and len(buf) > 1:
+                # Delete a block
+                del buf[pos:pos + rng.randint(1, len(buf) - pos)]
+            elif choice == 7 and len(buf) < self.max_input_size:
+                # Clone a block
+                start = rng.randrange(len(buf))
+                block = buf[start:start + rng.randint(1, 32)]
+                buf[pos:pos] = block
+            elif choice == 8 and self.corpus:
+                # Splice with another corpus entry
+                other = rng.choice(self.corpus)
+                if other:
+                    cut = rng.randrange(len(other))
+                    buf[pos:] = other[cut:]
+            if not buf:
+                buf.append(0)
+        return bytes(buf[:self.max_input_size])
+
+    def fuzz(self, iterations: int, seeds: list[bytes] | None = None) -> None:
+        """
+        Runs the fuzzing loop for a number of executions.
+
+        Parameters:
+            iterations (int): Number of mutated inputs to execute.
+            seeds (list[bytes] | None): Initial inputs, executed before mutation starts.
+        """
+        for seed in seeds or []:
+            self._record(seed, self.execute(seed))
+        if not self.corpus:
+            self.corpus.append(bytes(1))
+
+        for _ in range(iterations):
+            data = self.mutate(self.rng.choice(self.corpus))
+            self._record(data, self.execute(data))
+
+    def _record(self, data: bytes, result: ExecResult) -> None:
+        if result.status == "crash":
+            self.crashes.append((data, result.error))
+        elif result.status == "timeout":
+            self.timeouts += 1
+        if result.new_coverage and result.status != "crash":
+            self.corpus.append(data)
+
+    def fuzz_parallel(self, iterations: int, workers: int | None = None, seeds: list[bytes] | None = None) -> None:
+        """
+        Runs the fuzzing loop in forked worker processes, one per core by default.
+
+        Every worker starts from the snapshotted VM, which the operating system
+        shares copy-on-write, and executes the given number of iterations with
+        its own random seed. The coverage, corpora and crashes of all workers
+        are merged back into this fuzzer.
+
+        Parameters:
+            iterations (int): Number of mutated inputs to execute per worker.
+            workers (int | None): Number of worker processes. Defaults to the number of CPUs.
+            seeds (list[bytes] | None): Initial inputs, executed by every worker.
+        """
+        workers = workers or os.cpu_count() or 1
+        children = []
+        for worker in range(workers):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                # Child: fuzz and send the findings back through the pipe
+                os.close(read_fd)
+                status = 0
+                try:
+                    self.rng.seed(self.rng.random() + worker)
+                    known = len(self.corpus)
+                    self.fuzz(iterations, seeds)
+                    crashes = [(data, repr(error)) for data, error in self.crashes]
+                    payload = pickle.dumps((self.virgin, self.corpus[known:], crashes,
+                                            self.timeouts, self.executions))
+                    with os.fdopen(write_fd, "wb") as f:
+                        f.write(payload)
+                except BaseException:
+                    status = 1
+                finally:
+                    os._exit(status)
+            os.close(write_fd)
+            children.append((pid, read_fd))
+
+        base_executions = self.executions
+        base_timeouts = self.timeouts
+        base_crashes = len(self.crashes)
+        for pid, read_fd in children:
+            with os.fdopen(read_fd, "rb") as f:
+                payload = f.read()
+            os.waitpid(pid, 0)
+            if not payload:
+                continue
+            virgin, corpus, crashes, timeouts, executions = pickle.loads(payload)
+            self.virgin &= virgin
+            self.corpus.extend(data for data in corpus if data not in self.corpus)
+            self.crashes.extend((data, RuntimeError(error)) for data, error in crashes[base_crashes:])
+            self.timeouts += timeouts - base_timeouts
+            self.executions += executions - base_executions
@@ -0,0 +1,311 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import select
+import socket
+import sys
+from engine import HALTED, BUDGET, WATCHPOINT, ACCESS_FAULT, ILLEGAL_INSTRUCTION
+from history import History, BEGIN
+from nums import u32, signed32
+from vm import VM
+from watch import Watcher, READ, WRITE, ACCESS
+
+# Signals reported to GDB
+SIGINT  = 2
+SIGILL  = 4
+SIGTRAP = 5
+SIGSEGV = 11
+
+# Number of instructions between checks for an interrupt from GDB while continuing
+CHUNK = 100_000
+
+# Register names of the org.gnu.gdb.riscv.cpu feature, x0 to x31 followed by pc
+REGISTER_NAMES = [
+    "zero", "ra", "sp", "gp", "tp", "t0", "t1", "t2", "fp", "s1",
+    "a0", "a1", "a2", "a3", "a4", "a5", "a6", "a7",
+    "s2", "s3", "s4", "s5", "s6", "s7", "s8", "s9", "s10", "s11",
+    "t3", "t4", "t5", "t6", "pc",
+]
+PC_REGISTER = 32
+
+TARGET_XML = (
+    '<?xml version="1.0"?><!DOCTYPE target SYSTEM "gdb-target.dtd">'
+    '<target version="1.0"><architecture>riscv:rv32</architecture><feature name="org.gnu.gdb.riscv.cpu">'
+    + "".join(f'<reg name="{name}" bitsize="32" type="{"code_ptr" if name in ("ra", "pc") else "int"}"/>'
+              for name in REGISTER_NAMES)
+    + "</feature></target>"
+)
+
+# Watchpoint kinds by the type of a Z packet, and the stop reason GDB expects for them
+WATCH_KINDS = {"2": WRITE, "3": READ, "4": ACCESS}
+WATCH_REASONS = {WRITE: "watch", READ: "rwatch", ACCESS: "awatch"}
+
+def checksum(data: bytes) -> bytes:
+    return f"{sum(data) & 0xFF:02x}".encode()
+
+def escape(data: bytes) -> bytes:
+    """
+    Escapes the characters of binary data that have a meaning in packets.
+    """
+    for char in b"}#$*":
+        data = data.replace(bytes([char]), bytes([0x7D, char ^ 0x20]))
+    return data
+
+def encode_word(value: int) -> str:
+    return (int(value) & 0xFFFFFFFF).to_bytes(4, "little").hex()
+
+def decode_word(text: str) -> int:
+    return int.from_bytes(bytes.fromhex(text), "little")
+
+class GDBStub:
+    """
+    Lets GDB debug the program of a VM over the GDB Remote Serial Protocol.
+
+    Supports reading and writing registers and memory, single-stepping,
+    continuing with interrupts from GDB, breakpoints (Z0, Z1) and
+    watchpoints (Z2 to Z4). Breakpoints are breakpoints of the VM, so
+    continuing runs with the normal engine until one is reached. The
+    watcher is only attached once GDB sets the first watchpoint. With a
+    history, GDB can also step and continue backwards (bs, bc).
+
+    Attributes:
+        vm (VM): The debugged VM.
+        history (History | None): Records the run for reverse execution.
+        watcher (Watcher | None): The watcher of the VM, created for the first watchpoint.
+        last_stop (str): The last stop reply, sent again when GDB asks for it.
+    """
+    vm:        VM
+    history:   History | None
+    watcher:   Watcher | None
+    last_stop: str
+
+    def __init__(self, vm: VM, history: History | None = None) -> None:
+        self.vm = vm
+        self.history = history
+        self.watcher = None
+        self.last_stop = f"S{SIGTRAP:02x}"
+        self._watchpoints = {}
+        self._connection = None
+        self._buffer = b""
+        self._ack = True
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """
+        Waits for GDB to connect and serves it until it detaches or kills the program.
+
+        Parameters:
+            port (int): The TCP port to listen on.
+            host (str): The address to listen on, only the local host by default.
+        """
+        with socket.create_server((host, port)) as server:
+            print(f"Waiting for GDB on {host}:{server.getsockname()[1]}", file=sys.stderr)
+            connection, _ = server.accept()
+        with connection:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._connection = connection
+            while True:
+                packet = self._receive()
+                if packet is None:
+                    return
+                reply = self.handle(packet)
+                if reply is None:
+                    return
+                self._send(reply)
+
+    def handle(self, packet: str) -> str | None:
+        """
+        Answers one packet.
+
+        Returns:
+            str | None: The reply, or None if the connection should be closed.
+        """
+        command, body = packet[:1], packet[1:]
+        try:
+            if command == "?":
+                return self.last_stop
+            if command == "g":
+                return "".join(encode_word(value) for value in (*self.vm.state.rf, self.vm.state.pc))
+            if command == "G":
+                values = [decode_word(body[i:i + 8]) for i in range(0, len(body), 8)]
+                self.vm.state.rf[1:32] = [signed32(value) for value in values[1:32]]
+                if len(values) > PC_REGISTER:
+                    self.vm.state.pc = u32(values[PC_REGISTER])
+                return "OK"
+            if command == "p":
+                register = int(body, 16)
+                if register == PC_REGISTER:
+                    return encode_word(self.vm.state.pc)
+                return encode_word(self.vm.state.rf[register]) if register < 32 else "E01"
+            if command == "P":
+                register, value = body.split("=")
+                register, value = int(register, 16), decode_word(value)
+                if register == PC_REGISTER:
+                    self.vm.state.pc = u32(value)
+                elif 0 < register < 32:
+                    self.vm.state.rf[register] = signed32(value)
+                return "OK"
+            if command == "m":
+                address, length = (int(field, 16) for field in body.split(","))
+                self.vm.state.check_range(address, length)
+                return self.vm.state.mem[address:address + length].tobytes().hex()
+            if command == "M":
+                location, data = body.split(":")
+                address, _ = (int(field, 16) for field in location.split(","))
+                self.vm.state.load_memory(address, bytes.fromhex(data))
+                return "OK"
+            if command in ("c", "s"):
+                if body:
+                    self.vm.state.pc = u32(int(body, 16))
+                return self.resume(step=command == "s")
+            if command == "b" and body in ("s", "c") and self.history is not None:
+                return self.reverse(step=body == "s")
+            if command in ("Z", "z"):
+                return self.set_point(command == "Z", body)
+            if command == "q":
+                return self.query(body)
+            if packet == "QStartNoAckMode":
+                # Packets are acknowledged when received, so this packet still was
+                self._ack = False
+                return "OK"
+            if command == "H":
+                return "OK"
+            if command in ("k", "D"):
+                if command == "D":
+                    self._send("OK")
+                return None
+        except (ValueError, IndexError):
+            return "E01"
+        # Empty replies tell GDB that a packet is not supported
+        return ""
+
+    def query(self, body: str) -> str:
+        if body.startswith("Supported"):
+            features = "PacketSize=4000;qXfer:features:read+;QStartNoAckMode+"
+            return features + (";ReverseStep+;ReverseContinue+" if self.history is not None else "")
+        if body.startswith("Xfer:features:read:target.xml:"):
+            offset, length = (int(field, 16) for field in body.rsplit(":", 1)[1].split(","))
+            chunk = TARGET_XML[offset:offset + length]
+            return ("m" if offset + length < len(TARGET_XML) else "l") + chunk
+        if body == "Attached":
+            return "1"
+        if body == "fThreadInfo":
+            return "m1"
+        if body == "sThreadInfo":
+            return "l"
+        if body == "C":
+            return "QC1"
+        return ""
+
+    def set_point(self, insert: bool, body: str) -> str:
+        """
+        Inserts or removes a breakpoint or watchpoint.
+        """
+        kind, address, size = body.split(";")[0].split(",")
+        address, size = int(address, 16), int(size, 16)
+        if kind in ("0", "1"):
+            if insert:
+                self.vm.add_breakpoint(address)
+            else:
+                self.vm.remove_breakpoint(address)
+            return "OK"
+        if kind not in WATCH_KINDS:
+            return ""
+        key = (kind, address, size)
+        if insert:
+            if self.watcher is None:
+                self.watcher = Watcher(self.vm)
+            self._watchpoints[key] = self.watcher.watch(address, size, WATCH_KINDS[kind])
+        elif key in self._watchpoints:
+            self.watcher.unwatch(self._watchpoints.pop(key))
+        return "OK"
+
+    def resume(self, step: bool) -> str:
+        """
+        Runs one instruction, or until a breakpoint, watchpoint, halt, fault or
+        interrupt from GDB, and returns the stop reply.
+        """
+        run = self.history.run if self.history is not None else self.vm.run
+        while True:
+            reason = run(1 if step else CHUNK)
+            if reason in (ACCESS_FAULT, ILLEGAL_INSTRUCTION):
+                print(f"{reason.capitalize()}: {reason.error}", file=sys.stderr)
+            if reason == BUDGET and not step:
+                if not self._interrupted():
+                    continue
+                self.last_stop = f"S{SIGINT:02x}"
+            else:
+                self.last_stop = self.stop_reply(reason)
+            break
+        return self.last_stop
+
+    def reverse(self, step: bool) -> str:
+        """
+        Goes back by one instruction, or to the previous breakpoint or
+        watchpoint hit, and returns the stop reply.
+        """
+        reason = self.history.reverse_step() if step else self.history.reverse_continue()
+        self.last_stop = self.stop_reply(reason)
+        return self.last_stop
+
+    def stop_reply(self, reason: str) -> str:
+        """
+        Returns the stop reply for the reason a run ended. A halt reports
+        the low byte of the exit code, which is a0 if the reason is no RunResult.
+        """
+        if reason == HALTED:
+            exit_code = getattr(reason, "exit_code", None)
+            if exit_code is None:
+                exit_code = int(self.vm.state.rf[10])
+            return f"W{exit_code & 0xFF:02x}"
+        if reason == WATCHPOINT:
+            hit = self.watcher.hit
+            return f"T{SIGTRAP:02x}{WATCH_REASONS[hit.watchpoint.kind]}:{hit.address:x};"
+        if reason == BEGIN:
+            return f"T{SIGTRAP:02x}replaylog:begin;"
+        if reason == ACCESS_FAULT:
+            return f"S{SIGSEGV:02x}"
+        if reason == ILLEGAL_INSTRUCTION:
+            return f"S{SIGILL:02x}"
+        return f"S{SIGTRAP:02x}"
+
+    def _interrupted(self) -> bool:
+        """
+        Checks without blocking whether GDB sent an interrupt (Ctrl-C).
+        """
+        readable, _, _ = select.select([self._connection], [], [], 0)
+        if not readable:
+            return False
+        data = self._connection.recv(4096)
+        if not data:
+            raise ConnectionResetError("GDB closed the connection")
+        interrupted = b"\x03" in data
+        self._buffer += data.replace(b"\x03", b"")
+        return interrupted
+
+    def _receive(self) -> str | None:
+        """
+        Receives the next packet and acknowledges it. Returns None when the connection is closed.
+        """
+        while True:
+            # Drop acknowledgements and interrupts while stopped before the packet
+            start = self._buffer.find(b"$")
+            self._buffer = self._buffer[start:] if start >= 0 else b""
+            end = self._buffer.find(b"#")
+            if start >= 0 and end >= 0 and len(self._buffer) >= end + 3:
+                data, received = self._buffer[1:end], self._buffer[end + 1:end + 3]
+                self._buffer = self._buffer[end + 3:]
+                if self._ack:
+                    self._connection.sendall(b"+" if received.lower() == checksum(data) else b"-")
+                return data.decode("latin-1")
+            try:
+                chunk = self._connection.recv(4096)
+            except ConnectionResetError:
+                return None
+            if not chunk:
+                return None
+            self._buffer += chunk
+
+    def _send(self, reply: str) -> None:
+        data = escape(reply.encode("latin-1"))
+        self._connection.sendall(b"$" + data + b"#" + checksum(data))
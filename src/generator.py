@@ -0,0 +1,316 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import numpy as np
+from extension import Extension
+from extensions.rv32i import RV32I
+from extensions.m import M
+from instruction import Instruction
+from instruction_impl import InstructionImpl
+from nums import u8, u32, i64
+
+# Instruction formats the generator can produce, by opcode
+FORMATS = {
+    0b0110011: "R",     # Register-register operations
+    0b0010011: "I",     # Register-immediate operations
+    0b0000011: "L",     # Loads
+    0b0100011: "S",     # Stores
+    0b1100011: "B",     # Branches
+    0b1101111: "J",     # Jumps
+    0b0110111: "U",     # Lui
+    0b0010111: "U",     # Auipc
+}
+
+# Relative frequency of every format in the generated programs
+FORMAT_WEIGHTS = {"R": 4.0, "I": 4.0, "U": 1.0, "L": 2.0, "S": 2.0, "B": 1.0, "J": 0.25}
+
+# Values of funct7 that are tried when probing the encodings
+FUNCT7_VALUES = (0b0000000, 0b0100000, 0b0000001)
+
+# Register that holds the loop counter of every chunk
+COUNTER = 30
+# Register that points into the middle of the data region
+BASE = 31
+# Registers that random instructions may write
+DESTINATIONS = np.arange(1, COUNTER)
+
+# Number of instructions around the body of a chunk: the counter setup before, the decrement and branch after
+PROLOGUE = 1
+EPILOGUE = 2
+
+class Encoding:
+    """
+    The fixed fields of an instruction implementation, found by probing its match() method.
+
+    Attributes:
+        impl (InstructionImpl): The implementation.
+        format (str): The instruction format, a key of FORMAT_WEIGHTS.
+        opcode (int): The opcode.
+        funct3 (int): The funct3 field.
+        funct7 (int): The funct7 field.
+        funct7_fixed (bool): Whether funct7 is part of the encoding, otherwise the bits belong to the immediate.
+    """
+    impl:         InstructionImpl
+    format:       str
+    opcode:       int
+    funct3:       int
+    funct7:       int
+    funct7_fixed: bool
+
+    def __init__(self, impl: InstructionImpl, format: str, opcode: int, funct3: int, funct7: int,
+                 funct7_fixed: bool) -> None:
+        self.impl = impl
+        self.format = format
+        self.opcode = opcode
+        self.funct3 = funct3
+        self.funct7 = funct7
+        self.funct7_fixed = funct7_fixed
+
+    def __repr__(self) -> str:
+        return f"Encoding({type(self.impl).__name__}, {self.format}, opcode={self.opcode:#09b}, funct3={self.funct3})"
+
+def probe_encodings(extensions: list[Extension]) -> list[Encoding]:
+    """
+    Finds the encodings of all implementations of the extensions that have a
+    format the generator supports, by trying every opcode, funct3 and common
+    funct7 value against their match() methods.
+
+    Parameters:
+        extensions (list[Extension]): The extensions to generate instructions for.
+    Returns:
+        list[Encoding]: One encoding per supported implementation.
+    """
+    encodings = []
+    for extension in extensions:
+        for impl in extension.get_instruction_implementations():
+            for opcode, format in FORMATS.items():
+                funct3_values = (0,) if format in ("J", "U") else range(8)
+                found = [(funct3, funct7) for funct3 in funct3_values for funct7 in FUNCT7_VALUES
+                         if impl.match(Instruction(u32(opcode | funct3 << 12 | funct7 << 25)))]
+                if found:
+                    funct3, funct7 = found[0]
+                    fixed = sum(1 for f3, _ in found if f3 == funct3) < len(FUNCT7_VALUES)
+                    encodings.append(Encoding(impl, format, opcode, funct3, funct7, fixed))
+                    break
+    return encodings
+
+def encode_r(opcode, funct3, funct7, rd, rs1, rs2) -> np.ndarray:
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 | funct7 << 25
+
+def encode_i(opcode, funct3, rd, rs1, imm) -> np.ndarray:
+    return opcode | rd << 7 | funct3 << 12 | rs1 << 15 | (imm & 0xFFF) << 20
+
+def encode_s(opcode, funct3, rs1, rs2, imm) -> np.ndarray:
+    return opcode | (imm & 0x1F) << 7 | funct3 << 12 | rs1 << 15 | rs2 << 20 | (imm >> 5 & 0x7F) << 25
+
+def encode_b(opcode, funct3, rs1, rs2, imm) -> np.ndarray:
+    return (opcode | (imm >> 11 & 1) << 7 | (imm >> 1 & 0xF) << 8 | funct3 << 12 | rs1 << 15 | rs2 << 20
+            | (imm >> 5 & 0x3F) << 25 | (imm >> 12 & 1) << 31)
+
+def encode_u(opcode, rd, imm) -> np.ndarray:
+    return opcode | rd << 7 | (imm & 0xFFFFF) << 12
+
+def encode_j(opcode, rd, imm) -> np.ndarray:
+    return (opcode | rd << 7 | (imm >> 12 & 0xFF) << 12 | (imm >> 11 & 1) << 20 | (imm >> 1 & 0x3FF) << 21
+            | (imm >> 20 & 1) << 31)
+
+class Program:
+    """
+    A generated program. The code starts at address 0 and is followed by the data region.
+
+    Attributes:
+        code (np.ndarray[u32]): The instruction words.
+        data_address (int): Address of the data region.
+        data (np.ndarray[u8]): Initial contents of the data region.
+        seed (int | None): The seed the program was generated from.
+    """
+    code:         np.ndarray[u32]
+    data_address: int
+    data:         np.ndarray[u8]
+    seed:         int | None
+
+    def __init__(self, code: np.ndarray[u32], data_address: int, data: np.ndarray[u8], seed: int | None) -> None:
+        self.code = code
+        self.data_address = data_address
+        self.data = data
+        self.seed = seed
+
+    def image(self) -> bytes:
+        """
+        Returns the memory image of the program, to be loaded at address 0.
+        """
+        padding = bytes(self.data_address - self.code.size * 4)
+        return self.code.astype("<u4").tobytes() + padding + self.data.tobytes()
+
+    def save(self, path: str) -> None:
+        """
+        Saves the memory image as a binary file that main.py can run.
+        """
+        with open(path, "wb") as f:
+            f.write(self.image())
+
+class ProgramGenerator:
+    """
+    Generates random, terminating programs for benchmarks and differential testing.
+
+    A program initializes all registers with random values, then runs a
+    sequence of chunks and exits with the exit system call. Every chunk
+    sets a counter, runs a body of random instructions and decrements the
+    counter until it reaches zero, so most chunks run once and some loop:
+
+        addi x30, x0, n
+        body
+        addi x30, x30, -1
+        bne  x30, x0, body
+
+    Branches and jumps in a body only go forward, to at most the decrement
+    of their chunk, so every program terminates. Loads and stores address
+    the data region relative to x31. Neither x30 nor x31 is written by the
+    body. All fields are drawn and packed with NumPy, one array per field.
+
+    Attributes:
+        encodings (list[Encoding]): The instructions to generate.
+        body_length (int): Number of random instructions per chunk.
+        loop_probability (float): Probability that a chunk loops.
+        max_iterations (int): Maximum number of iterations of a looping chunk.
+        data_size (int): Size of the data region in bytes, at most 4096.
+    """
+    encodings:        list[Encoding]
+    body_length:      int
+    loop_probability: float
+    max_iterations:   int
+    data_size:        int
+
+    def __init__(self, extensions: list[Extension] | None = None, body_length: int = 16,
+                 loop_probability: float = 0.25, max_iterations: int = 8, data_size: int = 4096,
+                 weights: dict[str, float] | None = None) -> None:
+        """
+        Initializes the generator.
+
+        Parameters:
+            extensions (list[Extension] | None): The extensions to generate instructions for.
+                Defaults to RV32I and M.
+            body_length (int): Number of random instructions per chunk.
+            loop_probability (float): Probability that a chunk loops.
+            max_iterations (int): Maximum number of iterations of a looping chunk, at most 2047.
+            data_size (int): Size of the data region in bytes, a multiple of 4 up to 4096.
+            weights (dict[str, float] | None): Relative frequency of every format,
+                defaults to FORMAT_WEIGHTS.
+        """
+        if body_length < 1 or body_length > 1000:
+            raise ValueError(f"Body length must be between 1 and 1000, got {body_length}")
+        if not 1 <= max_iterations <= 2047:
+            raise ValueError(f"Maximum iterations must be between 1 and 2047, got {max_iterations}")
+        if data_size % 4 or not 4 <= data_size <= 4096:
+            raise ValueError(f"Data size must be a multiple of 4 up to 4096, got {data_size}")
+        self.encodings = probe_encodings(extensions if extensions is not None else [RV32I(), M()])
+        self.body_length = body_length
+        self.loop_probability = loop_probability
+        self.max_iterations = max_iterations
+        self.data_size = data_size
+
+        # Spread the weight of every format over its instructions
+        weights = weights if weights is not None else FORMAT_WEIGHTS
+        formats = [e.format for e in self.encodings]
+        probabilities = np.array([weights.get(f, 0.0) / formats.count(f) for f in formats])
+        if probabilities.sum() <= 0:
+            raise ValueError("No instruction has a positive weight")
+        self._probabilities = probabilities / probabilities.sum()
+
+        # Field tables indexed by encoding, formats are stored as their index in FORMAT_WEIGHTS
+        codes = list(FORMAT_WEIGHTS)
+        self._codes = {f: codes.index(f) for f in codes}
+        self._format = np.array([codes.index(f) for f in formats], dtype=u8)
+        self._opcode = np.array([e.opcode for e in self.encodings], dtype=i64)
+        self._funct3 = np.array([e.funct3 for e in self.encodings], dtype=i64)
+        self._funct7 = np.array([e.funct7 for e in self.encodings], dtype=i64)
+        self._fixed = np.array([e.funct7_fixed for e in self.encodings])
+
+    def generate(self, n_instructions: int, seed: int | None = None) -> Program:
+        """
+        Generates a program with roughly the given number of static instructions.
+
+        Parameters:
+            n_instructions (int): The number of random instructions to generate.
+            seed (int | None): Seed of the random number generator, for reproducible programs.
+        Returns:
+            Program: The generated program.
+        """
+        rng = np.random.default_rng(seed)
+        length = self.body_length
+        chunks = max(1, -(-n_instructions // length))
+        n = chunks * length
+
+        # Draw the encoding and all fields of every body instruction
+        kind = rng.choice(len(self.encodings), size=n, p=self._probabilities)
+        format, code = self._format[kind], self._codes
+        opcode, funct3, funct7 = self._opcode[kind], self._funct3[kind], self._funct7[kind]
+        rd = rng.choice(DESTINATIONS, size=n).astype(i64)
+        rs1 = rng.integers(0, 32, size=n, dtype=i64)
+        rs2 = rng.integers(0, 32, size=n, dtype=i64)
+        imm = rng.integers(-2048, 2048, size=n, dtype=i64)
+        body = np.zeros(n, dtype=i64)
+
+        # Register-register and register-immediate operations, shifts keep their funct7
+        mask = format == code["R"]
+        body[mask] = encode_r(opcode[mask], funct3[mask], funct7[mask], rd[mask], rs1[mask], rs2[mask])
+        mask = format == code["I"]
+        shift = self._fixed[kind] & mask
+        imm[shift] = funct7[shift] << 5 | (imm[shift] & 0x1F)
+        body[mask] = encode_i(opcode[mask], funct3[mask], rd[mask], rs1[mask], imm[mask])
+
+        # Loads and stores use naturally aligned offsets from the base register
+        size = 1 << (funct3 & 0b11)
+        offset = rng.integers(-self.data_size // 2, self.data_size // 2, size=n, dtype=i64) & -size
+        mask = format == code["L"]
+        body[mask] = encode_i(opcode[mask], funct3[mask], rd[mask], BASE, offset[mask])
+        mask = format == code["S"]
+        body[mask] = encode_s(opcode[mask], funct3[mask], BASE, rs2[mask], offset[mask])
+
+        # Upper immediates
+        mask = format == code["U"]
+        upper = rng.integers(0, 1 << 20, size=n, dtype=i64)
+        body[mask] = encode_u(opcode[mask], rd[mask], upper[mask])
+
+        # Branches and jumps skip forward to at most the epilogue of their chunk
+        position = np.arange(n, dtype=i64) % length
+        skip = 4 * (1 + (rng.random(n) * (length - position)).astype(i64))
+        mask = format == code["B"]
+        body[mask] = encode_b(opcode[mask], funct3[mask], rs1[mask], rs2[mask], skip[mask])
+        mask = format == code["J"]
+        body[mask] = encode_j(opcode[mask], rd[mask], skip[mask])
+
+        # Wrap every body into a counted loop, most of which run once
+        stride = PROLOGUE + length + EPILOGUE
+        iterations = np.where(rng.random(chunks) < self.loop_probability,
+                              rng.integers(2, self.max_iterations + 1, size=chunks), 1)
+        chunked = np.empty((chunks, stride), dtype=i64)
+        chunked[:, 0] = encode_i(0b0010011, 0, COUNTER, 0, iterations)
+        chunked[:, PROLOGUE:PROLOGUE + length] = body.reshape(chunks, length)
+        chunked[:, -2] = encode_i(0b0010011, 0, COUNTER, COUNTER, -1)
+        chunked[:, -1] = encode_b(0b1100011, 0b001, COUNTER, 0, -4 * (length + 1))
+
+        # Set up the registers, run the chunks and exit
+        exit_ = [encode_i(0b0010011, 0, 17, 0, 10), 0b1110011]
+        code_size = 4 * (2 * (DESTINATIONS.size + 1) + chunked.size + len(exit_))
+        data_address = (code_size + 0xFFF) & ~0xFFF
+        setup = self._setup_registers(rng, data_address + self.data_size // 2)
+        code = np.concatenate([setup, chunked.ravel(), exit_]).astype(u32)
+        data = rng.integers(0, 256, size=self.data_size, dtype=u8)
+        return Program(code, data_address, data, seed)
+
+    @staticmethod
+    def _setup_registers(rng: np.random.Generator, base: int) -> np.ndarray:
+        """
+        Loads random values into the destination registers and the data
+        address into the base register, each with a lui and an addi.
+        """
+        values = np.append(rng.integers(0, 1 << 32, size=DESTINATIONS.size, dtype=i64), base)
+        registers = np.append(DESTINATIONS, BASE).astype(i64)
+        low = (values & 0xFFF) - ((values & 0x800) << 1)
+        high = ((values - low) >> 12) & 0xFFFFF
+        setup = np.empty((registers.size, 2), dtype=i64)
+        setup[:, 0] = encode_u(0b0110111, registers, high)
+        setup[:, 1] = encode_i(0b0010011, 0, registers, registers, low)
+        return setup.ravel()
@@ -0,0 +1,315 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import io
+from bisect import bisect_right
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+from engine import LockstepEngine, HALTED, BUDGET, BREAKPOINT
+from instruction_impl import unwrap
+from nums import i32, u32
+from vm import VM
+
+# Reason returned by reverse execution that reached the oldest checkpoint
+BEGIN = "begin"
+
+# Default number of instructions between checkpoints
+CHECKPOINT_INTERVAL = 100_000
+
+# Default number of checkpoints kept before the oldest ones are merged
+CHECKPOINT_CAPACITY = 64
+
+class Checkpoint:
+    """
+    The state of a VM at a retired instruction count.
+
+    Only the memory pages written since the previous checkpoint are stored.
+    The oldest checkpoint of a history stores all pages that hold data.
+
+    Attributes:
+        instret (int): Number of retired instructions.
+        pc (u32): Program counter.
+        rf (np.ndarray[i32]): Copy of the register file.
+        halt (bool): Halt flag.
+        pages (np.ndarray): Indices of the stored pages, in ascending order.
+        contents (np.ndarray[u8]): Contents of the stored pages, one row per page.
+        extensions (list): The state of the extensions of the VM, from VM.snapshot_extensions().
+    """
+    instret:    int
+    pc:         u32
+    rf:         np.ndarray[i32]
+    halt:       bool
+    pages:      np.ndarray
+    contents:   np.ndarray
+    extensions: list
+
+    def __init__(self, instret: int, pc: u32, rf: np.ndarray[i32], halt: bool,
+                 pages: np.ndarray, contents: np.ndarray, extensions: list) -> None:
+        self.instret = instret
+        self.pc = pc
+        self.rf = rf
+        self.halt = halt
+        self.pages = pages
+        self.contents = contents
+        self.extensions = extensions
+
+    def merge(self, older: "Checkpoint") -> None:
+        """
+        Adds the pages of the preceding checkpoint that this one does not store,
+        so that it can replace it as the oldest checkpoint.
+        """
+        keep = ~np.isin(older.pages, self.pages)
+        pages = np.concatenate((older.pages[keep], self.pages))
+        order = np.argsort(pages, kind="stable")
+        self.pages = pages[order]
+        self.contents = np.concatenate((older.contents[keep], self.contents))[order]
+
+    def __repr__(self) -> str:
+        return f"Checkpoint(instret={self.instret}, pc={int(self.pc):#010x}, pages={self.pages.size})"
+
+@contextmanager
+def silenced(vm: VM):
+    """
+    Discards the output of the instructions that print, like ECALL, while
+    instructions run again that already printed.
+    """
+    impls = [unwrap(impl) for impl in vm.instruction_implementations]
+    impls = [impl for impl in impls if hasattr(impl, "output_stream")]
+    streams = [impl.output_stream for impl in impls]
+    for impl in impls:
+        impl.output_stream = io.StringIO()
+    try:
+        yield
+    finally:
+        for impl, stream in zip(impls, streams):
+            impl.output_stream = stream
+
+class History:
+    """
+    Records checkpoints of a VM while it runs, so that any earlier state
+    can be reached again: reverse-step, reverse-continue and the state at
+    a retired instruction count.
+
+    Runs through run() take a checkpoint every interval instructions, with
+    the registers, the state of the extensions and the pages marked as
+    dirty since the previous one.
+    At most capacity checkpoints are kept; the oldest is then merged into
+    the next one. To reach an earlier state, the latest checkpoint before
+    it is restored and the VM runs forward from there, so a query costs at
+    most one interval of execution. Checkpoints after the restored one are
+    discarded and taken again on the way forward.
+
+    Replaying assumes that the program is deterministic. Instructions
+    before the farthest point the VM ran to do not print their output
+    again, but intercepts and idle handlers run again, and changes by the
+    host, like a debugger writing registers, are forgotten when seeking to
+    a state before them. Every checkpoint clears the dirty page flags of
+    the state, like RVState.snapshot().
+
+    Attributes:
+        vm (VM): The recorded VM.
+        interval (int): Number of instructions between checkpoints.
+        capacity (int): Maximum number of checkpoints.
+        checkpoints (deque[Checkpoint]): The checkpoints, oldest first.
+    """
+    vm:          VM
+    interval:    int
+    capacity:    int
+    checkpoints: deque[Checkpoint]
+
+    def __init__(self, vm: VM, interval: int = CHECKPOINT_INTERVAL, capacity: int = CHECKPOINT_CAPACITY) -> None:
+        """
+        Initializes the history and takes its first checkpoint.
+
+        Raises:
+            ValueError: If interval or capacity is not positive, or the VM runs the lockstep engine,
+                which synchronizes its shadow with the pages flagged as dirty, while the history
+                clears the flags at checkpoints and restores pages without flagging them.
+        """
+        if interval <= 0 or capacity <= 0:
+            raise ValueError(f"Interval and capacity must be positive, got {interval} and {capacity}")
+        if isinstance(vm.engine, LockstepEngine):
+            raise ValueError("The history cannot record the lockstep engine")
+        self.vm = vm
+        self.interval = interval
+        self.capacity = capacity
+        self.checkpoints = deque()
+        self._frontier = vm.state.instret
+        self.checkpoint()
+
+    def checkpoint(self) -> Checkpoint:
+        """
+        Takes a checkpoint of the current state.
+
+        Returns:
+            Checkpoint: The new checkpoint.
+        """
+        state = self.vm.state
+        pages = np.flatnonzero(state.dirty) if self.checkpoints else state.nonzero_pages()
+        checkpoint = Checkpoint(state.instret, state.pc, state.rf.copy(), state.halt, pages, state.copy_pages(pages),
+                                self.vm.snapshot_extensions())
+        state.dirty.fill(False)
+        if self.checkpoints and self.checkpoints[-1].instret == state.instret:
+            # Replace a checkpoint at the same instruction, e.g. after the host changed the state
+            checkpoint.merge(self.checkpoints.pop())
+
+        self.checkpoints.append(checkpoint)
+        if len(self.checkpoints) > self.capacity:
+            oldest = self.checkpoints.popleft()
+            self.checkpoints[0].merge(oldest)
+        self._next = state.instret + self.interval
+        return checkpoint
+
+    def run(self, n_steps: int = -1) -> str:
+        """
+        Runs the VM like VM.run() and takes checkpoints on the way.
+
+        Parameters:
+            n_steps (int): Number of steps to execute. If -1, runs until the VM halts or stops.
+        Returns:
+            str: The reason the run ended, as returned by VM.run().
+        """
+        state = self.vm.state
+        remaining = n_steps
+        while True:
+            if state.instret >= self._next:
+                self.checkpoint()
+            steps = self._next - state.instret
+            if remaining >= 0:
+                steps = min(steps, remaining)
+            instret = state.instret
+            if instret < self._frontier:
+                # The instructions up to the frontier already printed their output
+                steps = min(steps, self._frontier - instret)
+                with silenced(self.vm):
+                    reason = self.vm.run(steps)
+            else:
+                reason = self.vm.run(steps)
+            self._frontier = max(self._frontier, state.instret)
+            if remaining >= 0:
+                remaining -= state.instret - instret
+            if reason != BUDGET or remaining == 0:
+                return reason
+
+    def seek(self, instret: int) -> None:
+        """
+        Brings the VM to the state after the given number of retired instructions,
+        ignoring breakpoints and watchpoints on the way.
+
+        Parameters:
+            instret (int): The retired instruction count. Later counts run the VM forward.
+        Raises:
+            ValueError: If the count is before the oldest checkpoint.
+        """
+        oldest = self.checkpoints[0].instret
+        if instret < oldest:
+            raise ValueError(f"Instruction {instret} is before the oldest checkpoint at {oldest}")
+        state = self.vm.state
+        if instret >= state.instret:
+            self._replay(instret)
+            return
+        self._restore(bisect_right([checkpoint.instret for checkpoint in self.checkpoints], instret) - 1)
+        self._replay(instret)
+
+    def reverse_step(self) -> str:
+        """
+        Goes back by one instruction.
+
+        Returns:
+            str: BUDGET, or BEGIN if the VM is already at the oldest checkpoint.
+        """
+        instret = self.vm.state.instret
+        if instret <= self.checkpoints[0].instret:
+            return BEGIN
+        self.seek(instret - 1)
+        return BUDGET
+
+    def reverse_continue(self) -> str:
+        """
+        Goes back to the latest earlier state at which a run stopped,
+        e.g. at a breakpoint or after a watched access.
+
+        Every checkpoint interval before the current state is replayed
+        until one with a stop is found, then the VM seeks to the last stop.
+
+        Returns:
+            str: The reason of the stop, or BEGIN if no earlier run stopped
+                and the VM is at the oldest checkpoint.
+        """
+        end = self.vm.state.instret
+        for index in range(len(self.checkpoints) - 1, -1, -1):
+            if self.checkpoints[index].instret >= end:
+                continue
+            start = self.checkpoints[index].instret
+            self._restore(index)
+            stops = self._stops(end)
+            if stops:
+                instret, reason = stops[-1]
+                self.seek(instret)
+                return reason
+            end = start
+        self._restore(0)
+        return BEGIN
+
+    def _stops(self, end: int) -> list[tuple[int, str]]:
+        """
+        Runs forward to the given instruction count and returns the retired
+        instruction counts and reasons of all stops before it.
+        """
+        vm = self.vm
+        state = vm.state
+        stops = []
+        # A run steps over a breakpoint it starts at, so check the restored pc first
+        if vm.breakpoints and int(state.pc) in vm.breakpoints and not state.halt:
+            stops.append((state.instret, BREAKPOINT))
+        while state.instret < end and not state.halt:
+            instret = state.instret
+            reason = self.run(end - state.instret)
+            if state.instret == instret:
+                # A fault does not retire the instruction, so the replay cannot go on
+                break
+            if reason not in (BUDGET, HALTED) and state.instret < end:
+                stops.append((state.instret, reason))
+        return stops
+
+    def _replay(self, instret: int) -> None:
+        """
+        Runs forward to the given instruction count, through breakpoints and watchpoints.
+        """
+        state = self.vm.state
+        while state.instret < instret and not state.halt:
+            retired = state.instret
+            self.run(instret - state.instret)
+            if state.instret == retired:
+                break
+
+    def _restore(self, index: int) -> None:
+        """
+        Restores the checkpoint at an index and discards the checkpoints after it.
+        """
+        state = self.vm.state
+        checkpoint = self.checkpoints[index]
+
+        # Pages written after the checkpoint get the content of the latest checkpoint before them
+        later = [self.checkpoints.pop().pages for _ in range(len(self.checkpoints) - index - 1)]
+        missing = np.unique(np.concatenate([np.flatnonzero(state.dirty), *later]))
+        for i in range(index, -1, -1):
+            if not missing.size:
+                break
+            stored = self.checkpoints[i]
+            slots = np.minimum(np.searchsorted(stored.pages, missing), max(stored.pages.size - 1, 0))
+            found = stored.pages[slots] == missing if stored.pages.size else np.zeros(missing.size, dtype=bool)
+            state.write_pages(missing[found], stored.contents[slots[found]])
+            missing = missing[~found]
+        # Pages that no checkpoint stores were empty
+        state.write_pages(missing)
+        state.dirty.fill(False)
+
+        state.rf[:] = checkpoint.rf
+        state.pc = checkpoint.pc
+        state.halt = checkpoint.halt
+        state.instret = checkpoint.instret
+        self.vm.restore_extensions(checkpoint.extensions)
+        self._next = checkpoint.instret + self.interval
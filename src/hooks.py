@@ -0,0 +1,227 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from typing import Callable, TYPE_CHECKING
+import numpy as np
+from extensions import rv32i
+from extensions.ecall import Ecall
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from state import RVState
+from watch import SIZES
+
+if TYPE_CHECKING:
+    from vm import VM
+
+# Events that hooks can be registered for
+READ   = "read"     # A load read memory
+WRITE  = "write"    # A store wrote memory
+BRANCH = "branch"   # A conditional branch was executed, taken or not
+JUMP   = "jump"     # JAL or JALR transferred control
+ECALL  = "ecall"    # A system call was executed
+HALT   = "halt"     # A run ended because the guest halted
+
+# Record type of the events of every kind. Values are the accessed bytes, zero-extended.
+MEMORY_EVENT   = np.dtype([("pc", "<u4"), ("address", "<u4"), ("size", "u1"), ("value", "<u4")])
+TRANSFER_EVENT = np.dtype([("pc", "<u4"), ("target", "<u4"), ("taken", "?")])
+ECALL_EVENT    = np.dtype([("pc", "<u4"), ("number", "<i4"), ("a0", "<i4")])
+HALT_EVENT     = np.dtype([("pc", "<u4"), ("instret", "<u8"), ("a0", "<i4")])  # pc after the halting instruction
+EVENTS = {
+    READ: MEMORY_EVENT, WRITE: MEMORY_EVENT, BRANCH: TRANSFER_EVENT,
+    JUMP: TRANSFER_EVENT, ECALL: ECALL_EVENT, HALT: HALT_EVENT,
+}
+
+class Hook:
+    """
+    A callback registered for one kind of event.
+
+    Events are collected in a NumPy record array of batch_size entries,
+    which is passed to the callback whenever it is full and at the end of
+    every run. A batch size of 1 calls the callback for every event.
+
+    Attributes:
+        event (str): The kind of event, e.g. READ.
+        callback (Callable[[np.ndarray], None]): Receives the events as a record array of EVENTS[event].
+        batch_size (int): Maximum number of events per call.
+    """
+    event:      str
+    callback:   Callable[[np.ndarray], None]
+    batch_size: int
+
+    def __init__(self, event: str, callback: Callable[[np.ndarray], None], batch_size: int = 1) -> None:
+        self.event = event
+        self.callback = callback
+        self.batch_size = batch_size
+        self._buffer = np.zeros(batch_size, dtype=EVENTS[event])
+        self._position = 0
+
+    def record(self, values: tuple) -> None:
+        """
+        Appends an event to the batch.
+        """
+        position = self._position
+        self._buffer[position] = values
+        self._position = position + 1
+        if position + 1 == self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Passes the collected events to the callback.
+        """
+        if self._position:
+            events = self._buffer[:self._position].copy()
+            self._position = 0
+            self.callback(events)
+
+    def __repr__(self) -> str:
+        return f"Hook(event={self.event!r}, callback={self.callback!r}, batch_size={self.batch_size})"
+
+class HookedLoad(ImplWrapper):
+    """
+    Reports the address and the loaded bytes of a load.
+    """
+
+    def __init__(self, impl: InstructionImpl, hooks: list[Hook], size: int) -> None:
+        super().__init__(impl)
+        self.hooks = hooks
+        self.size = size
+        self.mask = (1 << 8 * size) - 1
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        address = (int(state.rf[instruction.rs1]) + int(instruction.imm_i)) & 0xFFFFFFFF
+        self.impl.execute(state, instruction)
+        self.report((pc, address, self.size, int(state.rf[instruction.rd]) & self.mask))
+
+    def report(self, event: tuple) -> None:
+        """
+        Passes an event to the hooks, also called by compiled regions.
+        """
+        for hook in self.hooks:
+            hook.record(event)
+
+class HookedStore(HookedLoad):
+    """
+    Reports the address and the stored bytes of a store.
+    """
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        address = (int(state.rf[instruction.rs1]) + int(instruction.imm_s)) & 0xFFFFFFFF
+        event = (pc, address, self.size, int(state.rf[instruction.rs2]) & self.mask)
+        self.impl.execute(state, instruction)
+        self.report(event)
+
+class HookedTransfer(ImplWrapper):
+    """
+    Reports the target of a branch or jump and whether it was taken.
+    """
+
+    def __init__(self, impl: InstructionImpl, hooks: list[Hook]) -> None:
+        super().__init__(impl)
+        self.hooks = hooks
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        self.impl.execute(state, instruction)
+        target = int(state.pc)
+        self.report((pc, target, target != pc + 4))
+
+    def report(self, event: tuple) -> None:
+        """
+        Passes an event to the hooks, also called by compiled regions.
+        """
+        for hook in self.hooks:
+            hook.record(event)
+
+class HookedEcall(HookedTransfer):
+    """
+    Reports the number and the first argument a system call was made with.
+    """
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        event = (int(state.pc), int(state.rf[17]), int(state.rf[10]))
+        self.impl.execute(state, instruction)
+        self.report(event)
+
+class Hooks:
+    """
+    The hooks of a VM, created by VM.add_hook().
+
+    An instruction is only wrapped while a hook is registered for one of
+    its events, and the wrappers are removed with the last hook of the
+    event, so that runs without hooks execute unchanged. Hooked loads,
+    stores, branches and jumps are still compiled into regions, which pass
+    their events to the report method of the wrapper. Only the scalar
+    loads and stores of RV32I are reported as memory events.
+
+    Attributes:
+        vm (VM): The VM whose instructions are hooked.
+        hooks (dict[str, list[Hook]]): The registered hooks by event.
+    """
+    vm:    "VM"
+    hooks: dict[str, list[Hook]]
+
+    def __init__(self, vm: "VM") -> None:
+        self.vm = vm
+        self.hooks = {event: [] for event in EVENTS}
+
+    def add(self, hook: Hook) -> None:
+        hooks = self.hooks[hook.event]
+        hooks.append(hook)
+        if len(hooks) == 1 and hook.event != HALT:
+            self._wrap(hook.event)
+
+    def remove(self, hook: Hook) -> None:
+        hook.flush()
+        hooks = self.hooks[hook.event]
+        hooks.remove(hook)
+        if not hooks and hook.event != HALT:
+            self._unwrap(hook.event)
+
+    def empty(self) -> bool:
+        return not any(self.hooks.values())
+
+    def end_run(self, halted: bool) -> None:
+        """
+        Reports a halt and passes the collected events of all hooks to their callbacks.
+
+        Parameters:
+            halted (bool): Whether the guest halted during the run.
+        """
+        state = self.vm.state
+        if halted:
+            event = (int(state.pc), state.instret, int(state.rf[10]))
+            for hook in self.hooks[HALT]:
+                hook.record(event)
+        for hooks in self.hooks.values():
+            for hook in hooks:
+                hook.flush()
+
+    def _wrap(self, event: str) -> None:
+        impls = self.vm.instruction_implementations
+        hooks = self.hooks[event]
+        for i, impl in enumerate(impls):
+            kind = type(unwrap(impl))
+            if event == READ and issubclass(kind, rv32i.LOADS):
+                impls[i] = HookedLoad(impl, hooks, SIZES[kind])
+            elif event == WRITE and issubclass(kind, rv32i.STORES):
+                impls[i] = HookedStore(impl, hooks, SIZES[kind])
+            elif event == BRANCH and issubclass(kind, rv32i.BRANCHES) \
+                    or event == JUMP and issubclass(kind, rv32i.JUMPS):
+                impls[i] = HookedTransfer(impl, hooks)
+            elif event == ECALL and issubclass(kind, Ecall):
+                impls[i] = HookedEcall(impl, hooks)
+        self.vm.flush_decode_cache()
+
+    def _unwrap(self, event: str) -> None:
+        # Wrappers of this event are identified by the hook list they share.
+        # A wrapper that another tool wrapped again stays, but reports to an empty list.
+        impls = self.vm.instruction_implementations
+        hooks = self.hooks[event]
+        for i, impl in enumerate(impls):
+            if isinstance(impl, (HookedLoad, HookedTransfer)) and impl.hooks is hooks:
+                impls[i] = impl.impl
+        self.vm.flush_decode_cache()
@@ -0,0 +1,268 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import json
+import time
+from typing import TextIO
+import numpy as np
+from engine import Stop, RunResult, HALTED, BUDGET, BREAKPOINT, TIMEOUT, ACCESS_FAULT
+from instruction import Instruction
+from instruction_impl import unwrap
+from nums import u32
+from vm import VM, WATCHDOG_INTERVAL
+
+# Phases of executing one instruction, in order
+FETCH       = "fetch"        # Reading the instruction word from memory
+DECODE      = "decode"       # Creating the Instruction
+MATCH       = "match"        # Finding the implementation with VM.match_impl()
+FIELDS      = "fields"       # Computing the fields of the Instruction while matching and executing
+EXECUTE     = "execute"      # The execute method of the implementation, without the fields
+WRITEBACK   = "writeback"    # Clearing x0 and counting the instruction
+DISASSEMBLE = "disassemble"  # VM.dump_next_instruction() when tracing, including its fields
+PHASES = (FETCH, DECODE, MATCH, FIELDS, EXECUTE, WRITEBACK, DISASSEMBLE)
+
+class ImplProfile:
+    """
+    The host time spent in one instruction implementation class.
+
+    Attributes:
+        name (str): Name of the class.
+        count (int): Number of executed instructions.
+        execute_ns (int): Nanoseconds in execute(), without the fields of the instruction.
+        fields_ns (int): Nanoseconds computing fields of the instruction during execute().
+    """
+    name:       str
+    count:      int
+    execute_ns: int
+    fields_ns:  int
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.count = 0
+        self.execute_ns = 0
+        self.fields_ns = 0
+
+    @property
+    def total_ns(self) -> int:
+        return self.execute_ns + self.fields_ns
+
+    def __repr__(self) -> str:
+        return f"ImplProfile(name={self.name!r}, count={self.count}, total_ns={self.total_ns})"
+
+class HostProfiler:
+    """
+    Measures where the host spends its time while interpreting a program.
+
+    The profiler executes one instruction at a time like VM.step() and
+    reads a nanosecond timer between its phases: fetch, decode, match,
+    execute and writeback. The properties of Instruction are replaced by
+    timed ones while profiling, so that the time spent computing fields is
+    reported separately from the phase that needed them. Execution time is
+    also attributed to every InstructionImpl class.
+
+    The timers add their own overhead, so a profiled run takes about twice
+    as long as with the reference engine. The shares of the phases and
+    classes are what matters. The block engine avoids fetch, decode and match for
+    all but the first execution of an instruction, so this profile shows
+    the cost of the per-instruction path.
+
+    Attributes:
+        vm (VM): The profiled VM.
+        trace (TextIO | None): If set, every instruction is disassembled to it before it executes.
+        phases (dict[str, int]): Nanoseconds per phase.
+        impls (dict[str, ImplProfile]): Time per implementation class.
+        fields (dict[str, int]): Nanoseconds per Instruction property.
+        instructions (int): Number of profiled instructions.
+    """
+    vm:           VM
+    trace:        TextIO | None
+    phases:       dict[str, int]
+    impls:        dict[str, ImplProfile]
+    fields:       dict[str, int]
+    instructions: int
+
+    def __init__(self, vm: VM, trace: TextIO | None = None) -> None:
+        self.vm = vm
+        self.trace = trace
+        self.phases = dict.fromkeys(PHASES, 0)
+        self.impls = {}
+        self.fields = {}
+        self.instructions = 0
+        self._fields_ns = 0
+
+    def run(self, n_steps: int = -1, timeout: float | None = None) -> RunResult:
+        """
+        Runs the VM like VM.run() and profiles every instruction.
+        Guest faults end the run like in VM.run(), the instructions before them stay profiled.
+
+        Parameters:
+            n_steps (int): Number of steps to execute. If -1, runs until halted.
+            timeout (float | None): Maximum wall-clock duration of the run in seconds, None for no limit.
+        Returns:
+            RunResult: The result of the run, like VM.run().
+        """
+        vm = self.vm
+        instret = vm.state.instret
+        started = time.perf_counter()
+        deadline = None if timeout is None else time.perf_counter_ns() + int(timeout * 1e9)
+        error = None
+        try:
+            originals = self._time_fields()
+            try:
+                reason = self._run(n_steps, deadline)
+            finally:
+                for name, prop in originals.items():
+                    setattr(Instruction, name, prop)
+        except Stop as stop:
+            vm.state.rf[0] = 0
+            reason = stop.reason
+        except IndexError as e:
+            reason, error = ACCESS_FAULT, e
+        except (ValueError, NotImplementedError) as e:
+            reason, error = vm._fault(e), e
+        return vm._result(reason, instret, started, error)
+
+    def _run(self, n_steps: int, deadline: int | None) -> str:
+        vm = self.vm
+        state = vm.state
+        phases = self.phases
+        clock = time.perf_counter_ns
+        remaining = n_steps
+        while not state.halt and remaining != 0:
+            if deadline is not None and self.instructions % WATCHDOG_INTERVAL == 0 and clock() >= deadline:
+                return TIMEOUT
+            pc = state.pc
+            if vm.breakpoints and int(pc) in vm.breakpoints:
+                raise Stop(BREAKPOINT)
+            if vm.intercepts and int(pc) in vm.intercepts:
+                start = clock()
+                vm.step()
+                self._count("intercept", clock() - start, 0)
+                remaining -= 1
+                continue
+            if self.trace is not None:
+                start = clock()
+                print(vm.dump_next_instruction(), file=self.trace)
+                phases[DISASSEMBLE] += clock() - start
+
+            fields = self._fields_ns
+            start = clock()
+            word = np.frombuffer(state.mem[pc:pc + 4], dtype=u32)[0]
+            fetched = clock()
+            instruction = Instruction(word)
+            decoded = clock()
+            impl = vm.match_impl(instruction)
+            matched = clock()
+            match_fields = self._fields_ns - fields
+            if impl is None:
+                raise ValueError(f"No matching instruction implementation for {instruction}")
+
+            fields = self._fields_ns
+            stop = None
+            executed = clock()
+            try:
+                impl.execute(state, instruction)
+            except Stop as e:
+                stop = e
+            written = clock()
+            execute_fields = self._fields_ns - fields
+            state.rf[0] = 0
+            state.instret += 1
+            remaining -= 1
+            end = clock()
+
+            phases[FETCH] += fetched - start
+            phases[DECODE] += decoded - fetched
+            phases[MATCH] += matched - decoded - match_fields
+            phases[EXECUTE] += written - executed - execute_fields
+            phases[FIELDS] += match_fields + execute_fields
+            phases[WRITEBACK] += end - written
+            self._count(type(unwrap(impl)).__name__, written - executed - execute_fields, execute_fields)
+            if stop is not None:
+                raise stop
+        return HALTED if state.halt else BUDGET
+
+    def _count(self, name: str, execute_ns: int, fields_ns: int) -> None:
+        profile = self.impls.get(name)
+        if profile is None:
+            profile = self.impls[name] = ImplProfile(name)
+        profile.count += 1
+        profile.execute_ns += execute_ns
+        profile.fields_ns += fields_ns
+        self.instructions += 1
+
+    def _time_fields(self) -> dict[str, property]:
+        """
+        Replaces the properties of Instruction with timed ones and returns the originals.
+        """
+        originals = {name: value for name, value in vars(Instruction).items() if isinstance(value, property)}
+        clock = time.perf_counter_ns
+        for name, prop in originals.items():
+            self.fields.setdefault(name, 0)
+
+            def timed(instruction: Instruction, name: str = name, getter=prop.fget):
+                start = clock()
+                value = getter(instruction)
+                elapsed = clock() - start
+                self._fields_ns += elapsed
+                self.fields[name] += elapsed
+                return value
+            setattr(Instruction, name, property(timed))
+        return originals
+
+    def report(self) -> dict:
+        """
+        Summarizes the profile.
+
+        Returns:
+            dict: The number of instructions, the total nanoseconds, the phases and the
+                implementation classes sorted by time in descending order, and the time
+                per Instruction property.
+        """
+        total = sum(self.phases.values())
+        intercepted = self.impls.get("intercept")
+        if intercepted is not None:
+            total += intercepted.total_ns
+
+        def share(ns: int) -> float:
+            return ns / total if total else 0.0
+
+        phases = [{"phase": phase, "ns": ns, "share": share(ns)} for phase, ns in self.phases.items()]
+        impls = [{"name": p.name, "count": p.count, "execute_ns": p.execute_ns, "fields_ns": p.fields_ns,
+                  "ns_per_instruction": p.total_ns / p.count, "share": share(p.total_ns)}
+                 for p in self.impls.values()]
+        return {
+            "instructions": self.instructions,
+            "total_ns": total,
+            "phases": sorted(phases, key=lambda p: p["ns"], reverse=True),
+            "impls": sorted(impls, key=lambda p: p["execute_ns"] + p["fields_ns"], reverse=True),
+            "fields": dict(sorted(self.fields.items(), key=lambda item: item[1], reverse=True)),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.report(), indent=2)
+
+    def table(self, limit: int = 20) -> str:
+        """
+        Formats the phases and the most expensive implementation classes as a table.
+
+        Parameters:
+            limit (int): Maximum number of implementation classes.
+        """
+        report = self.report()
+        instructions = max(report["instructions"], 1)
+        lines = [f"Host time: {report['total_ns'] / 1e6:.1f} ms for {report['instructions']} instructions "
+                 f"({report['total_ns'] / instructions:.0f} ns per instruction)",
+                 f"{'phase':<16}{'ms':>10}{'ns/instr':>10}{'share':>8}"]
+        for phase in report["phases"]:
+            if not phase["ns"]:
+                continue
+            lines.append(f"{phase['phase']:<16}{phase['ns'] / 1e6:>10.1f}{phase['ns'] / instructions:>10.0f}"
+                         f"{phase['share'] * 100:>7.1f}%")
+        lines.append(f"{'implementation':<16}{'count':>10}{'ns/instr':>10}{'share':>8}{'fields':>8}")
+        for impl in report["impls"][:limit]:
+            total = impl["execute_ns"] + impl["fields_ns"]
+            lines.append(f"{impl['name']:<16}{impl['count']:>10}{impl['ns_per_instruction']:>10.0f}"
+                         f"{impl['share'] * 100:>7.1f}%{impl['fields_ns'] / total * 100 if total else 0:>7.1f}%")
+        return "\n".join(lines) + "\n"
@@ -48,4 +48,37 @@ class InstructionImpl(ABC):
         Returns:
             str: The disassembled instruction as a string.
         """
-        pass
\ No newline at end of file
+        pass
+
+class ImplWrapper(InstructionImpl):
+    """
+    Wraps another instruction implementation and forwards all calls to it.
+
+    Subclasses override execute() to observe or extend the wrapped
+    implementation without modifying it. Wrappers are only installed
+    when a feature needs them, so unobserved execution stays unchanged.
+
+    Attributes:
+        impl (InstructionImpl): The wrapped instruction implementation.
+    """
+
+    def __init__(self, impl: InstructionImpl) -> None:
+        self.impl = impl
+
+    def match(self, instruction: Instruction) -> bool:
+        return self.impl.match(instruction)
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        self.impl.execute(state, instruction)
+
+    def disassemble(self, instruction: Instruction) -> str:
+        return self.impl.disassemble(instruction)
+
+def unwrap(impl: InstructionImpl) -> InstructionImpl:
+    """
+    Returns the innermost implementation of a chain of wrappers,
+    so that tools can classify instructions that another tool already wraps.
+    """
+    while isinstance(impl, ImplWrapper):
+        impl = impl.impl
+    return impl
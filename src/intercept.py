@@ -0,0 +1,332 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import numpy as np
+from abc import ABC, abstractmethod
+from elf import Symbol
+from nums import u32, signed32
+from state import RVState, PAGE_SHIFT, PAGE_SIZE
+from vm import VM
+
+# Argument and return registers of the RISC-V calling convention
+RA = 1
+SP = 2
+A0, A1, A2 = 10, 11, 12
+
+def _arg(state: RVState, register: int) -> int:
+    """
+    Returns an argument register as an unsigned 32-bit integer.
+    """
+    return int(state.rf[register]) & 0xFFFFFFFF
+
+def _find_byte(state: RVState, address: int, value: int, limit: int | None = None) -> int:
+    """
+    Finds the first occurrence of a byte value starting at an address.
+
+    The memory is searched in chunks of doubling size, so short strings
+    do not scan large parts of memory.
+
+    Returns:
+        int: The offset of the byte from the address, or the limit if it was not found.
+    """
+    end = state.mem.size if limit is None else min(state.mem.size, address + limit)
+    chunk = 64
+    start = address
+    while start < end:
+        stop = min(start + chunk, end)
+        offset = state.mem[start:stop].tobytes().find(value)
+        if offset >= 0:
+            return start + offset - address
+        start = stop
+        chunk *= 2
+    if limit is None:
+        raise IndexError(f"Memory access out of bounds: no terminator found after {address:#010x}")
+    return end - address
+
+class HostRoutine(ABC):
+    """
+    Host implementation of a guest library routine.
+
+    Attributes:
+        name (str): The name of the routine, e.g. "memcpy".
+        compare_sign (bool): Whether only the sign of the return value is defined,
+            as for memcmp and strcmp. Used by the verification mode.
+    """
+    name: str
+    compare_sign: bool = False
+
+    @abstractmethod
+    def run(self, state: RVState) -> int:
+        """
+        Runs the routine on the arguments in the state.
+
+        Parameters:
+            state (RVState): The state holding the arguments and memory.
+        Returns:
+            int: The return value of the routine.
+        Raises:
+            IndexError: If the routine would access memory out of bounds.
+        """
+        pass
+
+class Memcpy(HostRoutine):
+    name = "memcpy"
+
+    def run(self, state: RVState) -> int:
+        dst, src, n = _arg(state, A0), _arg(state, A1), _arg(state, A2)
+        if n:
+            state.check_range(dst, n)
+            state.check_range(src, n)
+            # NumPy buffers overlapping slices, so this also implements memmove
+            state.mem[dst:dst + n] = state.mem[src:src + n]
+            state.mark_dirty(dst, n)
+        return dst
+
+class Memmove(Memcpy):
+    name = "memmove"
+
+class Memset(HostRoutine):
+    name = "memset"
+
+    def run(self, state: RVState) -> int:
+        dst, value, n = _arg(state, A0), _arg(state, A1), _arg(state, A2)
+        if n:
+            state.check_range(dst, n)
+            state.mem[dst:dst + n] = value & 0xFF
+            state.mark_dirty(dst, n)
+        return dst
+
+class Memcmp(HostRoutine):
+    name = "memcmp"
+    compare_sign = True
+
+    def run(self, state: RVState) -> int:
+        a, b, n = _arg(state, A0), _arg(state, A1), _arg(state, A2)
+        state.check_range(a, n)
+        state.check_range(b, n)
+        differ = np.flatnonzero(state.mem[a:a + n] != state.mem[b:b + n])
+        if differ.size == 0:
+            return 0
+        i = int(differ[0])
+        return int(state.mem[a + i]) - int(state.mem[b + i])
+
+class Strlen(HostRoutine):
+    name = "strlen"
+
+    def run(self, state: RVState) -> int:
+        return _find_byte(state, _arg(state, A0), 0)
+
+class Strnlen(HostRoutine):
+    name = "strnlen"
+
+    def run(self, state: RVState) -> int:
+        return _find_byte(state, _arg(state, A0), 0, _arg(state, A1))
+
+class Strcmp(HostRoutine):
+    name = "strcmp"
+    compare_sign = True
+
+    def run(self, state: RVState) -> int:
+        a, b = _arg(state, A0), _arg(state, A1)
+        # Only the shorter string and its terminator have to be compared
+        n = min(_find_byte(state, a, 0), _find_byte(state, b, 0)) + 1
+        differ = np.flatnonzero(state.mem[a:a + n] != state.mem[b:b + n])
+        if differ.size == 0:
+            return 0
+        i = int(differ[0])
+        return int(state.mem[a + i]) - int(state.mem[b + i])
+
+class Strcpy(HostRoutine):
+    name = "strcpy"
+
+    def run(self, state: RVState) -> int:
+        dst, src = _arg(state, A0), _arg(state, A1)
+        n = _find_byte(state, src, 0) + 1
+        state.check_range(dst, n)
+        state.mem[dst:dst + n] = state.mem[src:src + n]
+        state.mark_dirty(dst, n)
+        return dst
+
+# All routines that can be intercepted by name
+HOST_ROUTINES = {routine.name: routine for routine in [
+    Memcpy(), Memmove(), Memset(), Memcmp(), Strlen(), Strnlen(), Strcmp(), Strcpy(),
+]}
+
+class InterceptMismatch:
+    """
+    A difference between a host routine and the emulated guest routine,
+    found in verification mode.
+
+    Attributes:
+        name (str): The name of the routine.
+        address (int): The entry address of the guest routine.
+        args (tuple[int, int, int]): The values of a0, a1 and a2 at the call.
+        host_result (int): The return value of the host routine.
+        guest_result (int): The return value of the emulated guest routine.
+        memory_equal (bool): Whether both left the same memory contents, outside of the stack frame
+            of the guest routine.
+    """
+    name:         str
+    address:      int
+    args:         tuple[int, int, int]
+    host_result:  int
+    guest_result: int
+    memory_equal: bool
+
+    def __init__(self, name: str, address: int, args: tuple[int, int, int], host_result: int,
+                 guest_result: int, memory_equal: bool) -> None:
+        self.name = name
+        self.address = address
+        self.args = args
+        self.host_result = host_result
+        self.guest_result = guest_result
+        self.memory_equal = memory_equal
+
+    def __repr__(self) -> str:
+        return (f"InterceptMismatch(name={self.name!r}, address={self.address:#010x}, args={self.args}, "
+                f"host_result={self.host_result}, guest_result={self.guest_result}, "
+                f"memory_equal={self.memory_equal})")
+
+class Interceptor:
+    """
+    Registry of guest library routines that are replaced by host routines.
+
+    Routines are opt-in: only the entries passed to hook() are intercepted.
+    When the program counter reaches a hooked entry, the host routine runs on
+    the arguments in a0-a2, its result is written to a0 and execution returns
+    through ra, as if the guest routine had run.
+
+    In verification mode every call is additionally emulated instruction by
+    instruction, and differences in the return value or the written memory
+    are collected in mismatches.
+
+    Attributes:
+        vm (VM): The VM whose routines are intercepted.
+        symbols (list[Symbol]): Symbols used to resolve routine names to addresses.
+        verify (bool): Whether to compare every call against full emulation.
+        max_verify_steps (int): Step limit for emulating a routine in verification mode.
+        calls (dict[str, int]): Number of intercepted calls per routine.
+        mismatches (list[InterceptMismatch]): Differences found in verification mode.
+    """
+
+    def __init__(self, vm: VM, symbols: list[Symbol] | None = None, verify: bool = False,
+                 max_verify_steps: int = 10_000_000) -> None:
+        self.vm = vm
+        self.symbols = symbols or []
+        self.verify = verify
+        self.max_verify_steps = max_verify_steps
+        self.calls = {}
+        self.mismatches = []
+        self._hooked = {}
+
+    def resolve(self, target: int | str) -> int:
+        """
+        Resolves a symbol name or address to an address.
+
+        Raises:
+            KeyError: If no symbol with the name exists.
+        """
+        if isinstance(target, str):
+            for symbol in self.symbols:
+                if symbol.name == target:
+                    return symbol.address
+            raise KeyError(f"Symbol '{target}' not found")
+        return int(target)
+
+    def hook(self, target: int | str, routine: str | HostRoutine | None = None) -> None:
+        """
+        Intercepts a guest routine.
+
+        Parameters:
+            target (int | str): The entry address or symbol name of the guest routine.
+            routine (str | HostRoutine | None): The host routine to run, by name or as an object.
+                Defaults to the routine named like the target symbol.
+        """
+        if routine is None:
+            if not isinstance(target, str):
+                raise ValueError("A routine must be given when hooking an address")
+            routine = target
+        if isinstance(routine, str):
+            if routine not in HOST_ROUTINES:
+                raise KeyError(f"No host routine named '{routine}'")
+            routine = HOST_ROUTINES[routine]
+
+        address = self.resolve(target)
+        self._hooked[address] = routine
+        self.calls.setdefault(routine.name, 0)
+        self.vm.add_intercept(address, lambda state: self._call(address, routine))
+
+    def unhook(self, target: int | str) -> None:
+        """
+        Removes the interception of a guest routine.
+        """
+        address = self.resolve(target)
+        self._hooked.pop(address, None)
+        self.vm.remove_intercept(address)
+
+    def _call(self, address: int, routine: HostRoutine) -> None:
+        state = self.vm.state
+        self.calls[routine.name] += 1
+        if self.verify:
+            self._verify(address, routine)
+
+        state.rf[A0] = signed32(routine.run(state))
+        state.pc = u32(_arg(state, RA) & ~1)
+
+    def _verify(self, address: int, routine: HostRoutine) -> None:
+        """
+        Emulates the guest routine, compares it to the host routine and undoes
+        its effects, so that the host routine runs on the original state.
+
+        All pages either routine writes are compared, except for the stack
+        frame of the guest routine below the stack pointer of the call. The
+        state is restored from a snapshot, and the dirty page flags it clears
+        are merged back afterwards, also if a routine faults.
+        """
+        state = self.vm.state
+        args = (_arg(state, A0), _arg(state, A1), _arg(state, A2))
+        return_address, stack_pointer = _arg(state, RA) & ~1, _arg(state, SP)
+        dirty = state.dirty.copy()
+        snapshot = state.snapshot()
+
+        # Emulate the guest routine without any intercepts until it returns
+        intercepts = dict(self.vm.intercepts)
+        self.vm.intercepts.clear()
+        try:
+            frame = stack_pointer
+            self.vm.step()
+            steps = 1
+            while int(state.pc) != return_address or _arg(state, SP) != stack_pointer:
+                if state.halt or steps >= self.max_verify_steps:
+                    raise RuntimeError(f"Guest routine {routine.name} at {address:#010x} did not return")
+                frame = min(frame, _arg(state, SP))
+                self.vm.step()
+                steps += 1
+            guest_result = _arg(state, A0)
+            guest_pages = np.flatnonzero(state.dirty)
+            guest_written = state.copy_pages(guest_pages)
+
+            # Undo the guest routine and run the host routine on the original state
+            state.restore(snapshot)
+            host_result = routine.run(state) & 0xFFFFFFFF
+            pages = np.union1d(guest_pages, np.flatnonzero(state.dirty))
+            host_memory = state.copy_pages(pages)
+        finally:
+            self.vm.intercepts.update(intercepts)
+            state.restore(snapshot)
+            state.dirty |= dirty
+        guest_memory = state.copy_pages(pages)
+        guest_memory[np.searchsorted(pages, guest_pages)] = guest_written
+
+        addresses = (pages[:, None] << PAGE_SHIFT) + np.arange(PAGE_SIZE)
+        differ = (host_memory != guest_memory) & ((addresses < frame) | (addresses >= stack_pointer))
+
+        if routine.compare_sign:
+            same_result = np.sign(signed32(host_result)) == np.sign(signed32(guest_result))
+        else:
+            same_result = host_result == guest_result
+        memory_equal = not differ.any()
+        if not same_result or not memory_equal:
+            self.mismatches.append(InterceptMismatch(routine.name, address, args, host_result,
+                                                     guest_result, memory_equal))
@@ -2,12 +2,19 @@
 #
 # This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
 # It is released under the GNU General Public License v3.0.
+import time
+
+# Measure the startup time from before the imports to the first guest instruction
+STARTED = time.perf_counter()
+
 import argparse
 
 from extensions.ecall import ECALL
-from vm import VM
-from extensions.rv32i import RV32I
-from extensions.m import M
+from vm import VM, ENGINES
+from engine import LockstepEngine, Stop, HALTED, EBREAK, WATCHPOINT
+from elf import is_elf, load_elf, read_symbols, code_segments
+from registry import load_extensions, DEFAULT_ISA
+from nums import u32
 import struct
 import sys
 
@@ -39,19 +46,96 @@ def main():
     # Hex flag
     parser.add_argument("-x", "--hex", action="store_true",
                         help="interpret the program as a hex file instead of a binary file")
+    # Assembly flag
+    parser.add_argument("-a", "--assembly", action="store_true",
+                        help="assemble the program from RISC-V assembly source instead of loading a binary file")
     # Memory size argument
     parser.add_argument("-m", "--mem-size", type=int, default=1024 * 1024 * 1024,
                         help="size of the memory in bytes (default: 1 GiB)")
     # Disassemble flag
     parser.add_argument("-d", "--disassemble", action="store_true",
                         help="print executed instructions in disassembled form")
+    # Listing flag
+    parser.add_argument("-l", "--listing", action="store_true",
+                        help="print a static disassembly of the whole program with labels instead of executing it")
+    # Intercept argument
+    parser.add_argument("-i", "--intercept", type=str, default="",
+                        help="comma-separated ELF symbols of library routines to run on the host, e.g. memcpy,strlen")
+    # Watchpoint argument
+    parser.add_argument("-w", "--watch", type=str, default="",
+                        help="comma-separated addresses or symbols of words to watch, each optionally followed by "
+                             ":read, :write or :access (default: write); stops at the first hit")
+    # Cache simulation flag
+    parser.add_argument("-c", "--cache", action="store_true",
+                        help="simulate an L1I/L1D/L2 cache hierarchy and print a report to stderr")
+    # Timing model flag
+    parser.add_argument("-t", "--timing", action="store_true",
+                        help="estimate cycles with an in-order pipeline model and print a report to stderr")
+    # Execution engine
+    parser.add_argument("-e", "--engine", choices=list(ENGINES), default="block",
+                        help="execution engine; lockstep checks the block engine against the reference engine")
+    # Instruction fusion flags
+    parser.add_argument("--no-fusion", action="store_true",
+                        help="execute common instruction pairs separately instead of fusing them")
+    parser.add_argument("-s", "--stats", action="store_true",
+                        help="print the retired instructions and fused instruction pairs to stderr")
+    # Host profiling argument
+    parser.add_argument("--profile-host", type=str, nargs="?", const="", default=None, metavar="JSON",
+                        help="execute one instruction at a time and print the host time per phase and instruction "
+                             "implementation to stderr, optionally also writing a JSON report to the given path")
+    # ISA string
+    parser.add_argument("-march", "--march", type=str, default=DEFAULT_ISA,
+                        help=f"ISA string naming the extensions to load, e.g. rv32i or rv32im_zicsr (default: {DEFAULT_ISA})")
+    # GDB stub argument
+    parser.add_argument("-g", "--gdb", type=int, default=None, metavar="PORT",
+                        help="wait for GDB to connect on this local TCP port instead of running the program")
+    # Budget arguments
+    parser.add_argument("-n", "--steps", type=int, default=-1,
+                        help="stop after this many instructions (default: run until halted)")
+    parser.add_argument("--timeout", type=float, default=None, metavar="SECONDS",
+                        help="stop after this many seconds of wall-clock time (default: no limit)")
+    # Record and replay arguments
+    parser.add_argument("--record", type=str, default="", metavar="LOG",
+                        help="record the results of system calls and time reads to a binary log")
+    parser.add_argument("--replay", type=str, default="", metavar="LOG",
+                        help="feed the inputs of a recorded log back to the program instead of reading them from the host")
+    parser.add_argument("--no-output", action="store_true",
+                        help="with --replay, skip the output of system calls and only apply their recorded results")
+    # Server flag
+    parser.add_argument("--connect", type=str, default="",
+                        help="run the program on the rvpy server listening on this Unix socket")
 
     args = parser.parse_args()
 
+    # Send the program to a server instead of running it in this process
+    if args.connect:
+        from server import submit
+        try:
+            if args.hex:
+                image, format = load_hex(args.program), "binary"
+            else:
+                with open(args.program, 'rb') as f:
+                    image, format = f.read(), "assembly" if args.assembly else "binary"
+            result = submit(args.connect, image, format, steps=args.steps, timeout=args.timeout)
+        except (OSError, RuntimeError) as e:
+            print(f"Error: {e}")
+            return
+        if args.stats:
+            print(f"Instructions: {result['instret']}", file=sys.stderr)
+        if result["status"] not in (HALTED, EBREAK):
+            print(f"Stopped: {result['status']} at pc {result['pc']:#010x} after {result['instret']} instructions"
+                  + (f": {result['fault']}" if "fault" in result else ""), file=sys.stderr)
+            sys.exit(1)
+        return
+
     # Try to load the program file
     try:
         if args.hex:
             program_data = load_hex(args.program)
+        elif args.assembly:
+            from asm import assemble
+            with open(args.program, 'r') as f:
+                program_data = assemble(f.read())
         else:
             with open(args.program, 'rb') as f:
                 program_data = f.read()
@@ -62,22 +146,174 @@ def main():
         print(f"Error loading program file: {e}")
         return
     
-    # Initialize the VM with the specified memory size and load all extensions
-    vm = VM(mem_size=args.mem_size, extensions=[
-        RV32I(),                            # Load the base RISC-V 32I instruction set
-        M(),                                # Load the M extension for integer multiplication and division
+    # Load the extensions named by the ISA string, only their modules are imported
+    try:
+        extensions = load_extensions(args.march)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    # Initialize the VM with the specified memory size and load the extensions
+    vm = VM(mem_size=args.mem_size, engine=args.engine, extensions=[
+        *extensions,
         ECALL(output_stream=sys.stdout)     # Use sys.stdout for output
     ])
+    vm.fusion = not args.no_fusion
+
+    symbols = None
+    if args.assembly:
+        # Load the assembled image and start at its entry point
+        vm.state.pc = u32(program_data.load(vm.state))
+        symbols = program_data.symbol_table()
+    elif is_elf(program_data):
+        # Load the ELF segments and start at the entry point
+        vm.state.pc = load_elf(vm.state, program_data)
+        symbols = read_symbols(program_data)
+    else:
+        # Load the program into memory at address 0 and set the program counter to 0
+        vm.state.load_memory(0, program_data)
+        vm.state.pc = 0
+
+    # Disassemble the code of the program without executing it
+    if args.listing:
+        from disasm import Disassembler
+        if args.assembly:
+            segments = [(program_data.text_address, program_data.image[:program_data.text_size])]
+        elif is_elf(program_data):
+            segments = code_segments(program_data)
+        else:
+            segments = [(0, program_data)]
+        disassembler = Disassembler(vm.instruction_implementations)
+        for address, code in segments:
+            sys.stdout.write(disassembler.listing(code, address, symbols))
+        return
+
+    # Replace the requested library routines with host implementations
+    if args.intercept:
+        if symbols is None:
+            print("Error: --intercept requires an ELF or assembly program with symbols.")
+            return
+        from intercept import Interceptor
+        interceptor = Interceptor(vm, symbols)
+        try:
+            for name in args.intercept.split(","):
+                interceptor.hook(name.strip())
+        except KeyError as e:
+            print(f"Error: {e.args[0]}")
+            return
+
+    # Stop when a watched word is accessed
+    watcher = None
+    if args.watch:
+        from watch import Watcher
+        watcher = Watcher(vm)
+        addresses = {symbol.name: symbol.address for symbol in symbols or []}
+        try:
+            for item in args.watch.split(","):
+                location, _, kind = item.strip().partition(":")
+                address = addresses[location] if location in addresses else int(location, 0)
+                watcher.watch(address, 4, kind or "write")
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
 
-    # Load the program into memory at address 0 and set the program counter to 0
-    vm.state.load_memory(0, program_data)
-    vm.state.pc = 0
+    # Record the inputs of the program, or replay recorded ones
+    recorder = replayer = None
+    if args.record:
+        from replay import InputRecorder
+        recorder = InputRecorder(vm, args.record)
+    elif args.replay:
+        from replay import InputReplayer
+        try:
+            replayer = InputReplayer(vm, args.replay, output=not args.no_output)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return
 
-    # Execute the program until halted
-    while not vm.state.halt:
-        if args.disassemble:
+    # Trace all memory accesses through the cache model
+    tracer = None
+    if args.cache:
+        from cache import CacheTracer
+        tracer = CacheTracer(vm)
+    # Estimate cycles with the pipeline model
+    timing = None
+    if args.timing:
+        from timing import TimingModel
+        timing = TimingModel(vm)
+    startup = time.perf_counter() - STARTED
+
+    # Execute the program until halted or a budget is used up
+    result = None
+    if args.gdb is not None:
+        from gdbstub import GDBStub
+        from history import History
+        # Record the run for reverse execution, unless the engine synchronizes a shadow through the dirty page flags
+        history = History(vm) if not isinstance(vm.engine, LockstepEngine) else None
+        GDBStub(vm, history).serve(args.gdb)
+    elif args.profile_host is not None:
+        from hostprofile import HostProfiler
+        profiler = HostProfiler(vm, trace=sys.stdout if args.disassemble else None)
+        try:
+            result = profiler.run(args.steps, args.timeout)
+        finally:
+            sys.stderr.write(profiler.table())
+            if args.profile_host:
+                with open(args.profile_host, "w") as f:
+                    f.write(profiler.to_json())
+    elif args.disassemble:
+        while not vm.state.halt:
             print(vm.dump_next_instruction())
-        vm.step()
+            try:
+                vm.step()
+            except Stop:
+                break
+    else:
+        try:
+            result = vm.run(args.steps, args.timeout)
+        except RuntimeError as e:
+            # A replay that takes another path than the recorded run
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        finally:
+            if recorder is not None:
+                recorder.detach()
+    if replayer is not None and not replayer.finished:
+        print(f"Replay used {replayer.position} of {len(replayer.inputs)} recorded inputs", file=sys.stderr)
+
+    if watcher is not None and watcher.hit is not None:
+        print(f"Stopped at {watcher.hit}", file=sys.stderr)
+    if tracer is not None:
+        print_cache_report(tracer.report(symbols))
+    if timing is not None:
+        report = timing.report()
+        print(f"Cycles: {report['cycles']}  Instructions: {report['instructions']}  CPI: {report['cpi']:.3f}  "
+              f"Mispredicts: {report['mispredicts']}/{report['branches']}  Stalls: {report['stalls']}", file=sys.stderr)
+    if isinstance(vm.engine, LockstepEngine):
+        if vm.engine.divergence is not None:
+            print(f"Engines diverged: {vm.engine.divergence}", file=sys.stderr)
+        else:
+            print(f"Engines agree on {vm.engine.blocks} blocks", file=sys.stderr)
+    if args.stats:
+        fusions = ", ".join(f"{name}: {count}" for name, count in sorted(vm.fusions.items())) or "none"
+        print(f"Startup: {startup * 1000:.1f} ms  Instructions: {int(vm.state.instret)}  Fused pairs: {fusions}",
+              file=sys.stderr)
+    if result is not None and result.reason not in (HALTED, EBREAK, WATCHPOINT):
+        print(f"Stopped: {result.reason} at pc {int(vm.state.pc):#010x} after {result.instret} instructions"
+              + (f": {result.error}" if result.error is not None else ""), file=sys.stderr)
+        sys.exit(1)
+
+def print_cache_report(report: dict) -> None:
+    """
+    Prints a cache simulation report to stderr.
+    """
+    for level in ("l1i", "l1d", "l2"):
+        stats = report[level]
+        print(f"{level.upper():4} {stats['accesses']:>12} accesses {stats['misses']:>10} misses "
+              f"{stats['hit_rate'] * 100:6.2f}% hit rate", file=sys.stderr)
+    print(f"Estimated stall cycles: {report['stall_cycles']}", file=sys.stderr)
+    for function in report["functions"][:20]:
+        print(f"  {function['stall_cycles']:>12} cycles {function['l1_misses']:>10} L1 misses  {function['name']}",
+              file=sys.stderr)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -11,4 +11,11 @@ i64 = np.int64
 u32 = np.uint32
 i32 = np.int32
 u8  = np.uint8
-i8  = np.int8
\ No newline at end of file
+i8  = np.int8
+
+def signed32(value: int) -> int:
+    """
+    Wraps an integer to the range of a signed 32-bit integer, so it can be
+    stored in the register file without overflowing.
+    """
+    return ((int(value) + 0x80000000) & 0xFFFFFFFF) - 0x80000000
@@ -0,0 +1,526 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from typing import Callable
+import numpy as np
+from extensions import rv32i
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper
+from nums import u32
+from state import RVState, PAGE_SHIFT
+
+# Budget passed to a region when the run is unlimited
+UNLIMITED = 1 << 62
+
+MASK = 0xFFFFFFFF
+SIGN = 0x80000000
+
+def _div(a: int, b: int) -> int:
+    if b == 0:
+        return MASK
+    a, b = (a ^ SIGN) - SIGN, (b ^ SIGN) - SIGN
+    quotient = abs(a) // abs(b)
+    return (quotient if (a < 0) == (b < 0) else -quotient) & MASK
+
+def _rem(a: int, b: int) -> int:
+    if b == 0:
+        return a
+    sa, sb = (a ^ SIGN) - SIGN, (b ^ SIGN) - SIGN
+    return (sa - sb * ((_div(a, b) ^ SIGN) - SIGN)) & MASK
+
+def _out_of_bounds(address: int) -> IndexError:
+    return IndexError(f"Memory access out of bounds at {address:#010x}")
+
+# Expressions of the register-register operations, with {a} and {b} as the unsigned operands
+BINARY = {
+    rv32i.Add:  "({a} + {b}) & MASK",
+    rv32i.Sub:  "({a} - {b}) & MASK",
+    rv32i.Xor:  "{a} ^ {b}",
+    rv32i.Or:   "{a} | {b}",
+    rv32i.And:  "{a} & {b}",
+    rv32i.Sll:  "({a} << ({b} & 31)) & MASK",
+    rv32i.Srl:  "{a} >> ({b} & 31)",
+    rv32i.Sra:  "((({a} ^ SIGN) - SIGN) >> ({b} & 31)) & MASK",
+    rv32i.Slt:  "int(({a} ^ SIGN) < ({b} ^ SIGN))",
+    rv32i.Sltu: "int({a} < {b})",
+}
+
+# Expressions of the M operations, keyed by class name so that the M module is
+# only imported when the M extension is loaded
+M_BINARY = {
+    "Mul":    "({a} * {b}) & MASK",
+    "Mulh":   "(((({a} ^ SIGN) - SIGN) * (({b} ^ SIGN) - SIGN)) >> 32) & MASK",
+    "Mulhu":  "({a} * {b}) >> 32",
+    "Mulhsu": "(((({a} ^ SIGN) - SIGN) * {b}) >> 32) & MASK",
+    "Div":    "_div({a}, {b})",
+    "Divu":   "({a} // {b} if {b} else MASK)",
+    "Rem":    "_rem({a}, {b})",
+    "Remu":   "({a} % {b} if {b} else {a})",
+}
+
+def binary_expression(kind: type) -> str | None:
+    """
+    Returns the expression of a register-register operation.
+
+    Parameters:
+        kind (type): The implementation class.
+    Returns:
+        str | None: The expression, or None if the class is not a compiled register-register operation.
+    """
+    if kind.__module__ == "extensions.m":
+        return M_BINARY.get(kind.__name__)
+    return BINARY.get(kind)
+
+# Expressions of the register-immediate operations on {a}, with {i} as the sign-extended
+# immediate, {u} as its unsigned value, {s} as the shift amount and {x} as its biased signed value
+IMMEDIATE = {
+    rv32i.AddI:  "({a} + {i}) & MASK",
+    rv32i.XorI:  "{a} ^ {u}",
+    rv32i.OrI:   "{a} | {u}",
+    rv32i.AndI:  "{a} & {u}",
+    rv32i.SllI:  "({a} << {s}) & MASK",
+    rv32i.SrlI:  "{a} >> {s}",
+    rv32i.SraI:  "((({a} ^ SIGN) - SIGN) >> {s}) & MASK",
+    rv32i.SltI:  "int(({a} ^ SIGN) < {x})",
+    rv32i.SltuI: "int({a} < {u})",
+}
+
+# Conditions of the branches
+BRANCH = {
+    rv32i.Beq:  "{a} == {b}",
+    rv32i.Bne:  "{a} != {b}",
+    rv32i.Blt:  "({a} ^ SIGN) < ({b} ^ SIGN)",
+    rv32i.Bge:  "({a} ^ SIGN) >= ({b} ^ SIGN)",
+    rv32i.Bltu: "{a} < {b}",
+    rv32i.Bgeu: "{a} >= {b}",
+}
+
+# Width and value expression of the loads, with v as the loaded unsigned value
+LOAD = {
+    rv32i.Lb:  (1, "((v ^ 0x80) - 0x80) & MASK"),
+    rv32i.Lbu: (1, "v"),
+    rv32i.Lh:  (2, "((v ^ 0x8000) - 0x8000) & MASK"),
+    rv32i.Lhu: (2, "v"),
+    rv32i.Lw:  (4, "v"),
+}
+
+# Width of the stores
+STORE = {rv32i.Sb: 1, rv32i.Sh: 2, rv32i.Sw: 4}
+
+class Region:
+    """
+    A hot loop compiled into a single Python function.
+
+    The function keeps the guest registers used by the loop in local
+    variables and only writes them back to the register file when it leaves
+    the region, and around instructions it cannot compile, such as ECALL,
+    which are executed by their implementation.
+
+    Attributes:
+        start (int): Address of the loop header, the only entry of the region.
+        end (int): Address after the last instruction of the region.
+        source (str): The generated Python source.
+        function (Callable[[RVState, int], int]): Runs the region with an instruction
+            budget and returns the number of executed instructions.
+    """
+    start:    int
+    end:      int
+    source:   str
+    function: Callable[[RVState, int], int]
+
+    def __init__(self, start: int, end: int, source: str, function: Callable[[RVState, int], int]) -> None:
+        self.start = start
+        self.end = end
+        self.source = source
+        self.function = function
+
+class RegionCompiler:
+    """
+    Translates the instructions between a loop header and its back edge into Python source.
+
+    The region is split into blocks at branch targets and after control
+    transfers. Each block checks the budget once, so a region never executes
+    more instructions than the run allows and always stops at a block boundary.
+    If marked is set, the executed instructions of every block are passed to
+    mark(start, end, next_pc) the first time the block continues at its
+    fall-through or taken successor in a call of the region.
+    """
+
+    def __init__(self, start: int, end: int, instructions: list[Instruction],
+                 impls: list[InstructionImpl | None], state: RVState,
+                 guarded: dict[int, ImplWrapper] | None = None,
+                 reported: dict[int, ImplWrapper] | None = None, marked: bool = False) -> None:
+        self.start = start
+        self.end = end
+        self.instructions = instructions
+        self.impls = impls
+        self.state = state
+        self.guarded = guarded or {}
+        self.reported = reported or {}
+        self.marked = marked
+        self.lines = []
+        self.offsets = {}
+        self.callouts = {}
+        self.guards = {}
+        self.reports = {}
+
+    def address(self, index: int) -> int:
+        return self.start + 4 * index
+
+    def leaders(self) -> list[int]:
+        """
+        Returns the indices of the instructions that start a block.
+        """
+        leaders = {0}
+        for index, (instruction, impl) in enumerate(zip(self.instructions, self.impls)):
+            kind = type(impl)
+            if kind in BRANCH or kind is rv32i.Jal:
+                offset = int(instruction.imm_b if kind in BRANCH else instruction.imm_j)
+                target = self.address(index) + offset
+                if self.start <= target < self.end:
+                    leaders.add((target - self.start) >> 2)
+                leaders.add(index + 1)
+            elif kind is rv32i.JalR or impl is None:
+                leaders.add(index + 1)
+        return sorted(leader for leader in leaders if leader < len(self.instructions))
+
+    def registers(self) -> tuple[list[int], list[int]]:
+        """
+        Returns the registers read or written by the region and those written by it.
+        """
+        used, written = set(), set()
+        for instruction, impl in zip(self.instructions, self.impls):
+            if impl is None:
+                continue
+            used.update((int(instruction.rs1), int(instruction.rs2)))
+            if type(impl) not in STORE and type(impl) not in BRANCH:
+                written.add(int(instruction.rd))
+            if self.is_callout(impl):
+                # Called implementations may read and write any register
+                used.update(range(32))
+                written.update(range(32))
+        used.discard(0)
+        written.discard(0)
+        return sorted(used | written), sorted(written)
+
+    def is_callout(self, impl: InstructionImpl) -> bool:
+        return not is_compiled(type(impl))
+
+    def emit(self, indent: int, line: str) -> None:
+        self.lines.append("    " * indent + line)
+
+    def compile(self) -> str:
+        """
+        Generates the source of the region function.
+        """
+        used, written = self.registers()
+        write_back = f"rf[{written}] = [{', '.join(f'(x{r} ^ SIGN) - SIGN' for r in written)}]" if written else "pass"
+        reload = "; ".join(f"x{r} = r[{r}] & MASK" for r in used)
+
+        self.emit(0, "def region(state, limit):")
+        self.emit(1, "rf = state.rf")
+        self.emit(1, "dirty = state.dirty")
+        self.emit(1, "code = state.code")
+        self.emit(1, "base = state.instret")
+        self.emit(1, "r = rf.tolist()")
+        if used:
+            self.emit(1, reload)
+        self.emit(1, "count = 0")
+        self.emit(1, f"pc = at = {self.start}")
+
+        leaders = self.leaders()
+        bounds = leaders + [len(self.instructions)]
+        if self.marked:
+            # Whether a block was marked with the fall-through or the taken successor in this call
+            flags = [f"seen_{self.address(first):x}" for first in leaders]
+            flags += [f"seen_{self.address(first):x}_taken" for first, last in zip(bounds, bounds[1:])
+                      if type(self.impls[last - 1]) in BRANCH]
+            self.emit(1, " = ".join(flags) + " = False")
+        self.emit(1, "try:")
+        self.emit(2, "while True:")
+        for first, last in zip(bounds, bounds[1:]):
+            self.block(first, last, reload, write_back)
+
+        starts = ", ".join(str(self.address(leader)) for leader in leaders)
+        self.emit(3, f"if pc not in ({starts},):")
+        self.emit(4, "break")
+        self.emit(1, "except Stop:")
+        # A called implementation completed and stopped the run, the state is already synchronized
+        self.emit(2, "state.instret += 1")
+        self.mark(2, "at - 4 * OFFSETS[at]", "at + 4", "int(state.pc)")
+        self.emit(2, "raise")
+        self.emit(1, "except BaseException:")
+        self.mark(2, "at - 4 * OFFSETS[at]", "at", "at")
+        self.emit(2, write_back)
+        self.emit(2, "state.pc = u32(at)")
+        self.emit(2, "state.instret = base + count + OFFSETS[at]")
+        self.emit(2, "raise")
+        self.emit(1, write_back)
+        self.emit(1, "state.pc = u32(pc)")
+        self.emit(1, "state.instret = base + count")
+        self.emit(1, "return count")
+        return "\n".join(self.lines) + "\n"
+
+    def block(self, first: int, last: int, reload: str, write_back: str) -> None:
+        """
+        Generates the code of the block of instructions first to last - 1.
+        """
+        start = self.address(first)
+        length = last - first
+        self.emit(3, f"if pc == {start}:")
+        self.emit(4, f"if count + {length} > limit:")
+        self.emit(5, "break")
+
+        next_pc = None
+        for index in range(first, last):
+            address = self.address(index)
+            self.offsets[address] = index - first
+            instruction, impl = self.instructions[index], self.impls[index]
+            if impl is None:
+                # Leave the region before an unknown instruction, the interpreter reports it
+                self.emit(4, f"count += {index - first}")
+                self.emit(4, f"pc = {address}")
+                self.mark(4, start, address, "pc")
+                self.emit(4, "break")
+                return
+            next_pc = self.instruction(instruction, impl, address, index - first, reload, write_back)
+
+        end = self.address(last)
+        self.emit(4, f"count += {length}")
+        self.emit(4, f"pc = {next_pc if next_pc is not None else end}")
+        if self.marked:
+            seen = f"seen_{start:x}"
+            if type(self.impls[last - 1]) in BRANCH:
+                self.emit(4, f"if pc != {end}:")
+                self.emit(5, f"if not {seen}_taken:")
+                self.emit(6, f"{seen}_taken = True")
+                self.mark(6, start, end, "pc")
+                self.emit(4, f"elif not {seen}:")
+            else:
+                self.emit(4, f"if not {seen}:")
+            self.emit(5, f"{seen} = True")
+            self.mark(5, start, end, "pc")
+
+    def instruction(self, instruction: Instruction, impl: InstructionImpl, address: int, offset: int,
+                    reload: str, write_back: str) -> str | None:
+        """
+        Generates the code of a single instruction.
+
+        Returns:
+            str | None: An expression of the next program counter if the instruction
+                transfers control, otherwise None.
+        """
+        kind = type(impl)
+        rd, rs1, rs2 = int(instruction.rd), int(instruction.rs1), int(instruction.rs2)
+        a = f"x{rs1}" if rs1 else "0"
+        b = f"x{rs2}" if rs2 else "0"
+
+        binary = binary_expression(kind)
+        if binary is not None:
+            if rd:
+                self.emit(4, f"x{rd} = " + binary.format(a=a, b=b))
+        elif kind in IMMEDIATE:
+            immediate = int(instruction.imm_i)
+            if rd:
+                self.emit(4, f"x{rd} = " + IMMEDIATE[kind].format(a=a, i=immediate, u=immediate & MASK,
+                                                                  s=immediate & 31, x=(immediate & MASK) ^ SIGN))
+        elif kind is rv32i.Lui:
+            if rd:
+                self.emit(4, f"x{rd} = {int(instruction.imm_u)}")
+        elif kind is rv32i.Auipc:
+            if rd:
+                self.emit(4, f"x{rd} = {(address + int(instruction.imm_u)) & MASK}")
+        elif kind is rv32i.Fence:
+            pass
+        elif kind in LOAD:
+            size, value = LOAD[kind]
+            self.emit(4, f"at = {address}")
+            self.emit(4, f"t = ({a} + {int(instruction.imm_i)}) & MASK")
+            self.emit(4, f"if t > {self.state.mem.size - size}:")
+            self.emit(5, "raise _out_of_bounds(t)")
+            indent = self.guard(instruction, address, offset, size, reload, write_back)
+            if rd or address in self.reported:
+                read = "mem[t]" if size == 1 else f"int.from_bytes(mem[t:t + {size}], 'little')"
+                self.emit(indent, f"v = {read}")
+                if rd:
+                    self.emit(indent, f"x{rd} = {value}")
+                self.report(address, f"({address}, t, {size}, v)", indent)
+            elif indent > 4:
+                self.emit(indent, "pass")
+        elif kind in STORE:
+            size = STORE[kind]
+            self.emit(4, f"at = {address}")
+            self.emit(4, f"t = ({a} + {int(instruction.imm_s)}) & MASK")
+            self.emit(4, f"if t > {self.state.mem.size - size}:")
+            self.emit(5, "raise _out_of_bounds(t)")
+            indent = self.guard(instruction, address, offset, size, reload, write_back)
+            if size == 1:
+                self.emit(indent, f"mem[t] = {b} & 0xFF")
+            else:
+                self.emit(indent, f"mem[t:t + {size}] = ({b} & {(1 << 8 * size) - 1}).to_bytes({size}, 'little')")
+            self.report(address, f"({address}, t, {size}, {b} & {(1 << 8 * size) - 1})", indent)
+            self.emit(indent, "p = t >> PAGE_SHIFT")
+            self.emit(indent, "dirty[p] = True")
+            if size > 1:
+                self.emit(indent, f"dirty[(t + {size - 1}) >> PAGE_SHIFT] = True")
+            # Leave the region when the loop writes to decoded code
+            self.emit(indent, f"if (code[p] or code[(t + {size - 1}) >> PAGE_SHIFT]) and state.touches_code(t, {size}):")
+            self.emit(indent + 1, "state.code_modified = True")
+            self.emit(indent + 1, f"count += {offset + 1}")
+            self.emit(indent + 1, f"pc = {address + 4}")
+            self.mark(indent + 1, address - 4 * offset, address + 4, "pc")
+            self.emit(indent + 1, "break")
+        elif kind in BRANCH:
+            target = (address + int(instruction.imm_b)) & MASK
+            condition = BRANCH[kind].format(a=a, b=b)
+            if address in self.reported:
+                self.emit(4, f"t = {target} if {condition} else {address + 4}")
+                self.report(address, f"({address}, t, t != {address + 4})", 4)
+                return "t"
+            return f"{target} if {condition} else {address + 4}"
+        elif kind is rv32i.Jal:
+            if rd:
+                self.emit(4, f"x{rd} = {address + 4}")
+            target = (address + int(instruction.imm_j)) & MASK
+            self.report(address, f"({address}, {target}, {target != address + 4})", 4)
+            return str(target)
+        elif kind is rv32i.JalR:
+            self.emit(4, f"t = ({a} + {int(instruction.imm_i)}) & {MASK & ~1}")
+            if rd:
+                self.emit(4, f"x{rd} = {address + 4}")
+            self.report(address, f"({address}, t, t != {address + 4})", 4)
+            return "t"
+        else:
+            self.callout(instruction, impl, address, offset, reload, write_back)
+        return None
+
+    def callout(self, instruction: Instruction, impl: InstructionImpl, address: int, offset: int,
+                reload: str, write_back: str, indent: int = 4) -> None:
+        """
+        Generates a call to the implementation of an instruction that is not compiled.
+        The registers and counters are synchronized with the state around the call.
+        """
+        name = f"execute_{address:x}"
+        self.callouts[name] = (impl.execute, instruction)
+        self.emit(indent, f"at = {address}")
+        self.emit(indent, write_back)
+        self.emit(indent, f"state.pc = u32({address})")
+        self.emit(indent, f"state.instret = base + count + {offset}")
+        self.emit(indent, f"{name}(state, instruction_{address:x})")
+        self.emit(indent, "rf[0] = 0")
+        self.emit(indent, "r = rf.tolist()")
+        self.emit(indent, reload)
+        self.emit(indent, f"if state.halt or int(state.pc) != {address + 4}:")
+        self.emit(indent + 1, f"count += {offset + 1}")
+        self.emit(indent + 1, "pc = int(state.pc)")
+        self.mark(indent + 1, address - 4 * offset, address + 4, "pc")
+        self.emit(indent + 1, "break")
+
+    def guard(self, instruction: Instruction, address: int, offset: int, size: int,
+              reload: str, write_back: str) -> int:
+        """
+        Generates the test of a guarded access, which calls the wrapper of the
+        instruction if the access touches a flagged page of the wrapper.
+
+        Returns:
+            int: Indentation of the compiled access, which runs if the test fails.
+        """
+        wrapper = self.guarded.get(address)
+        if wrapper is None:
+            return 4
+        name = f"guard_{address:x}"
+        self.guards[name] = wrapper.guard_pages
+        self.emit(4, f"if {name}[t >> PAGE_SHIFT] or {name}[((t + {size - 1}) & MASK) >> PAGE_SHIFT]:")
+        self.callout(instruction, wrapper, address, offset, reload, write_back, indent=5)
+        self.emit(4, "else:")
+        return 5
+
+    def report(self, address: int, event: str, indent: int) -> None:
+        """
+        Generates the call that passes the event of an instruction to the report method of its wrapper.
+        """
+        wrapper = self.reported.get(address)
+        if wrapper is None:
+            return
+        name = f"report_{address:x}"
+        self.reports[name] = wrapper.report
+        self.emit(indent, f"{name}({event})")
+
+    def mark(self, indent: int, start: int | str, end: int | str, next_pc: int | str) -> None:
+        """
+        Generates the call that marks the instructions from start to end as executed, if the region is marked.
+        """
+        if self.marked:
+            self.emit(indent, f"mark({start}, {end}, {next_pc})")
+
+def is_compiled(kind: type) -> bool:
+    """
+    Checks whether regions compile an implementation class, instead of calling its execute method.
+    """
+    return (binary_expression(kind) is not None or kind in IMMEDIATE or kind in BRANCH or kind in LOAD
+            or kind in STORE or kind in (rv32i.Jal, rv32i.JalR, rv32i.Lui, rv32i.Auipc, rv32i.Fence))
+
+def compile_region(start: int, end: int, state: RVState,
+                   match_impl: Callable[[Instruction], InstructionImpl | None],
+                   mark: Callable[[int, int, int], None] | None = None) -> Region | None:
+    """
+    Compiles the loop between a header and the end of its back edge.
+
+    Parameters:
+        start (int): Address of the loop header.
+        end (int): Address after the instruction that jumps back to the header.
+        state (RVState): The state the region will run on.
+        match_impl (Callable): Finds the implementation of an instruction.
+        mark (Callable | None): Receives the executed instructions of the blocks of the region,
+            like CoverageCollector.mark().
+    Returns:
+        Region | None: The compiled region, or None if the loop cannot be compiled
+            because some of its instructions are observed by a tool.
+
+    A wrapper of a load or store is compiled if it has a guard_pages attribute,
+    one flag per page of the address space: the access is compiled behind a
+    test of the flags of its pages, and the wrapper is only called if one is set.
+    A wrapper of a load, store, branch or jump is compiled if it has a report
+    method, which is called after the instruction with the tuple
+    (pc, address, size, value) for accesses, the accessed bytes zero-extended,
+    or (pc, target, taken) for control transfers. Any other wrapper of an
+    instruction that is not compiled, like ECALL, is called like the instruction.
+    """
+    from engine import Stop
+
+    instructions, impls, guarded, reported = [], [], {}, {}
+    for address in range(start, end, 4):
+        word = np.frombuffer(state.mem[address:address + 4], dtype=u32)[0]
+        instruction = Instruction(word)
+        impl = match_impl(instruction)
+        if isinstance(impl, ImplWrapper):
+            kind = type(impl.impl)
+            access = kind in LOAD or kind in STORE
+            if getattr(impl, "guard_pages", None) is not None and access:
+                guarded[address] = impl
+                impl = impl.impl
+            elif getattr(impl, "report", None) is not None \
+                    and (access or kind in BRANCH or kind in (rv32i.Jal, rv32i.JalR)):
+                reported[address] = impl
+                impl = impl.impl
+            elif is_compiled(kind):
+                return None
+            # Other wrappers are called like the instruction, with the state synchronized around the call
+        instructions.append(instruction)
+        impls.append(impl)
+
+    compiler = RegionCompiler(start, end, instructions, impls, state, guarded, reported, mark is not None)
+    source = compiler.compile()
+    namespace = {
+        "MASK": MASK, "SIGN": SIGN, "PAGE_SHIFT": PAGE_SHIFT, "u32": u32, "Stop": Stop,
+        "_div": _div, "_rem": _rem, "_out_of_bounds": _out_of_bounds,
+        "mem": memoryview(state.mem), "OFFSETS": compiler.offsets, "mark": mark,
+    }
+    namespace.update(compiler.guards)
+    namespace.update(compiler.reports)
+    for name, (execute, instruction) in compiler.callouts.items():
+        namespace[name] = execute
+        namespace["instruction_" + name.split("_")[1]] = instruction
+    exec(compile(source, f"<region {start:#010x}>", "exec"), namespace)
+    return Region(start, end, source, namespace["region"])
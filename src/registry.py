@@ -0,0 +1,90 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from importlib import import_module
+from extension import Extension
+
+# Built-in extensions by their name in an ISA string: module and class.
+# Modules are only imported when an ISA string names them.
+EXTENSIONS = {
+    "i":     ("extensions.rv32i", "RV32I"),
+    "m":     ("extensions.m", "M"),
+    "v":     ("extensions.v", "V"),
+    "zicsr": ("extensions.zicsr", "Zicsr"),
+    "zba":   ("extensions.b", "Zba"),
+    "zbb":   ("extensions.b", "Zbb"),
+}
+
+# Entry point group through which installed packages can provide further extensions
+ENTRY_POINT_GROUP = "rvpy.extensions"
+
+# ISA of the VM if none is given
+DEFAULT_ISA = "rv32im"
+
+def parse_isa(isa: str) -> list[str]:
+    """
+    Splits an ISA string like "rv32im_zicsr" into the names of its extensions.
+
+    Single-letter extensions follow the base ISA directly. Multi-letter
+    extensions start with z, s or x and are separated by underscores.
+
+    Parameters:
+        isa (str): The ISA string, in any case.
+    Returns:
+        list[str]: The lowercase extension names, starting with the base ISA "i".
+    Raises:
+        ValueError: If the string does not describe an RV32I based ISA or names an extension twice.
+    """
+    rest = isa.lower()
+    if not rest.startswith("rv32i"):
+        raise ValueError(f"ISA string '{isa}' must start with rv32i")
+    rest = rest[len("rv32i"):]
+
+    names = ["i"]
+    while rest:
+        if rest[0] == "_":
+            rest = rest[1:]
+            continue
+        if rest[0] in "zsx":
+            name, _, rest = rest.partition("_")
+        else:
+            name, rest = rest[0], rest[1:]
+        if name in names:
+            raise ValueError(f"ISA string '{isa}' names extension '{name}' twice")
+        names.append(name)
+    return names
+
+def extension_class(name: str) -> type[Extension]:
+    """
+    Finds the class of an extension by its name in an ISA string, importing
+    its module. Names that are not built in are looked up in the entry points
+    of the group ENTRY_POINT_GROUP.
+
+    Raises:
+        ValueError: If no extension has the name.
+    """
+    if name in EXTENSIONS:
+        module, cls = EXTENSIONS[name]
+        return getattr(import_module(module), cls)
+
+    # Only scan the installed packages for names that are not built in
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        if entry_point.name == name:
+            return entry_point.load()
+    raise ValueError(f"Unknown extension '{name}', expected one of {', '.join(EXTENSIONS)} "
+                     f"or an entry point of {ENTRY_POINT_GROUP}")
+
+def load_extensions(isa: str = DEFAULT_ISA) -> list[Extension]:
+    """
+    Creates the extensions of an ISA string with their default parameters.
+
+    Parameters:
+        isa (str): The ISA string, e.g. "rv32im_zicsr".
+    Returns:
+        list[Extension]: One instance of every named extension, in order.
+    Raises:
+        ValueError: If the string is malformed or names an unknown extension.
+    """
+    return [extension_class(name)() for name in parse_isa(isa)]
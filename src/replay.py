@@ -0,0 +1,258 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import numpy as np
+from extensions.ecall import Ecall
+from extensions.zicsr import Counters
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from nums import signed32
+from state import RVState
+from vm import VM
+
+# Kinds of recorded inputs
+ECALL_RESULT = 0  # a0 after a system call that returned
+ECALL_EXIT   = 1  # a0 after a system call that halted the guest
+TIME_READ    = 2  # The value of the time counter read by a CSR instruction
+
+# Record type of the log: the retired instruction count before the input was read, its kind and its value
+INPUT = np.dtype([("instret", "<u8"), ("kind", "u1"), ("value", "<u8")])
+
+# First bytes of a log file, followed by its records
+MAGIC = b"RVINPUT1"
+
+class RecordedEcall(ImplWrapper):
+    """
+    Records the result of every system call.
+    """
+
+    def __init__(self, impl: InstructionImpl, recorder: "InputRecorder") -> None:
+        super().__init__(impl)
+        self.recorder = recorder
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        instret = state.instret
+        self.impl.execute(state, instruction)
+        self.recorder.record(instret, ECALL_EXIT if state.halt else ECALL_RESULT, int(state.rf[10]) & 0xFFFFFFFF)
+
+class ReplayedEcall(ImplWrapper):
+    """
+    Applies the recorded result of a system call instead of making it.
+    """
+
+    def __init__(self, impl: InstructionImpl, replayer: "InputReplayer") -> None:
+        super().__init__(impl)
+        self.replayer = replayer
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        replayer = self.replayer
+        if replayer.finished:
+            # Past the end of the log, e.g. at the system call the recorded run faulted at
+            self.impl.execute(state, instruction)
+            return
+        kind, value = replayer.next(state.instret, (ECALL_RESULT, ECALL_EXIT))
+        if replayer.output:
+            self.impl.execute(state, instruction)
+        else:
+            state.pc += 4
+        state.rf[10] = signed32(value)
+        state.halt = kind == ECALL_EXIT
+
+class InputRecorder:
+    """
+    Records the inputs a VM receives from the host to a binary log,
+    so that the run can be repeated exactly with InputReplayer.
+
+    The recorded inputs are the results of system calls and the reads of
+    the time counter. Every other instruction only depends on the state, so
+    a replay that starts from the same state reaches the same states. Each
+    input is one record of INPUT, 17 bytes, with the retired instruction
+    count at which it was read. The records are buffered and appended to
+    the log whenever batch_size are collected, and by detach().
+
+    Only forward runs can be recorded: instructions that run again, e.g.
+    while History seeks, are recorded again.
+
+    Attributes:
+        vm (VM): The recorded VM.
+        path (str): Path of the log.
+        batch_size (int): Number of records written at once.
+        count (int): Number of recorded inputs.
+    """
+    vm:         VM
+    path:       str
+    batch_size: int
+    count:      int
+
+    def __init__(self, vm: VM, path: str, batch_size: int = 4096) -> None:
+        """
+        Creates the log and instruments the VM.
+        """
+        self.vm = vm
+        self.path = path
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer = np.zeros(batch_size, dtype=INPUT)
+        self._position = 0
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+
+        impls = vm.instruction_implementations
+        self._original = list(impls)
+        for i, impl in enumerate(impls):
+            if isinstance(unwrap(impl), Ecall):
+                impls[i] = RecordedEcall(impl, self)
+        self._counters = clocks(vm)
+        for counters in self._counters:
+            counters.time = self._recording_clock(counters.time)
+        vm.flush_decode_cache()
+
+    def _recording_clock(self, clock):
+        state = self.vm.state
+
+        def time() -> int:
+            value = clock()
+            self.record(state.instret, TIME_READ, value)
+            return value
+        return time
+
+    def record(self, instret: int, kind: int, value: int) -> None:
+        """
+        Appends an input to the log.
+        """
+        position = self._position
+        self._buffer[position] = (instret, kind, value)
+        self._position = position + 1
+        self.count += 1
+        if position + 1 == self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Writes the buffered records to the log.
+        """
+        if self._position:
+            self._file.write(self._buffer[:self._position].tobytes())
+            self._file.flush()
+            self._position = 0
+
+    def detach(self) -> None:
+        """
+        Writes the remaining records, closes the log and removes the instrumentation from the VM.
+        """
+        self.flush()
+        self._file.close()
+        for counters in self._counters:
+            del counters.time
+        self.vm.instruction_implementations[:] = self._original
+        self.vm.flush_decode_cache()
+
+    def __repr__(self) -> str:
+        return f"InputRecorder(path={self.path!r}, count={self.count})"
+
+class InputReplayer:
+    """
+    Feeds the inputs of a log written by InputRecorder back to a VM,
+    without making system calls or reading the host clock.
+
+    The VM must start from the state the recording started from. Every
+    input is checked against the retired instruction count it was recorded
+    at, so a replay that takes another path fails instead of silently
+    reading the wrong inputs. Once the log is used up, system calls and
+    the clock reach the host again.
+
+    With output disabled, system calls are not executed at all, so replays
+    skip formatting and writing the output of the program and only apply
+    the recorded results.
+
+    Attributes:
+        vm (VM): The replaying VM.
+        inputs (np.ndarray): The records of the log.
+        position (int): Index of the next input.
+        output (bool): Whether system calls still write their output.
+    """
+    vm:       VM
+    inputs:   np.ndarray
+    position: int
+    output:   bool
+
+    def __init__(self, vm: VM, path: str, output: bool = True) -> None:
+        """
+        Loads a log and instruments the VM.
+
+        Raises:
+            ValueError: If the file is not a log written by InputRecorder.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(MAGIC) or (len(data) - len(MAGIC)) % INPUT.itemsize:
+            raise ValueError(f"'{path}' is not an input log")
+        self.vm = vm
+        self.inputs = np.frombuffer(data, dtype=INPUT, offset=len(MAGIC))
+        self.position = 0
+        self.output = output
+
+        impls = vm.instruction_implementations
+        self._original = list(impls)
+        for i, impl in enumerate(impls):
+            if isinstance(unwrap(impl), Ecall):
+                impls[i] = ReplayedEcall(impl, self)
+        self._counters = clocks(vm)
+        for counters in self._counters:
+            counters.time = self._replaying_clock(counters.time)
+        vm.flush_decode_cache()
+
+    def _replaying_clock(self, clock):
+        state = self.vm.state
+
+        def time() -> int:
+            if self.finished:
+                return clock()
+            return self.next(state.instret, (TIME_READ,))[1]
+        return time
+
+    @property
+    def finished(self) -> bool:
+        return self.position == len(self.inputs)
+
+    def next(self, instret: int, kinds: tuple[int, ...]) -> tuple[int, int]:
+        """
+        Returns the kind and value of the next input.
+
+        Parameters:
+            instret (int): The retired instruction count at which the input is read.
+            kinds (tuple[int, ...]): The kinds of input the instruction reads.
+        Raises:
+            RuntimeError: If the next input was recorded at another instruction or is of another kind.
+        """
+        record = self.inputs[self.position]
+        kind = int(record["kind"])
+        if int(record["instret"]) != instret or kind not in kinds:
+            raise RuntimeError(f"Replay diverged at instruction {instret}: input {self.position} "
+                               f"was recorded at instruction {int(record['instret'])} with kind {kind}")
+        self.position += 1
+        return kind, int(record["value"])
+
+    def detach(self) -> None:
+        """
+        Removes the instrumentation from the VM.
+        """
+        for counters in self._counters:
+            del counters.time
+        self.vm.instruction_implementations[:] = self._original
+        self.vm.flush_decode_cache()
+
+    def __repr__(self) -> str:
+        return f"InputReplayer(position={self.position}, inputs={len(self.inputs)}, output={self.output})"
+
+def clocks(vm: VM) -> list[Counters]:
+    """
+    Returns the counters of the CSR instructions of a VM, whose time is read from the host.
+    """
+    counters = []
+    for impl in vm.instruction_implementations:
+        source = getattr(unwrap(impl), "counters", None)
+        if isinstance(source, Counters) and not any(source is c for c in counters):
+            counters.append(source)
+    return counters
@@ -0,0 +1,442 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, TextIO
+
+from vm import VM, ENGINES
+from extensions.ecall import ECALL
+from registry import load_extensions, DEFAULT_ISA
+from elf import is_elf, load_elf
+from asm import assemble, REGISTERS
+from nums import u32, signed32
+from state import RVState, Snapshot
+
+# Image formats accepted by the server; binary images may also be ELF files
+FORMATS = ("binary", "assembly")
+
+class StreamOutput(io.TextIOBase):
+    """
+    Output stream of a pooled VM that sends every completed line of ECALL
+    output to the client of the current job as an {"output": ...} message.
+
+    Attributes:
+        target (BinaryIO | None): The connection of the current job, None between jobs.
+    """
+    target: BinaryIO | None
+
+    def __init__(self) -> None:
+        self.target = None
+        self._buffer = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self._buffer += text
+        if "\n" in self._buffer:
+            lines, self._buffer = self._buffer.rsplit("\n", 1)
+            self._send(lines + "\n")
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._send(self._buffer)
+            self._buffer = ""
+
+    def _send(self, text: str) -> None:
+        if self.target is not None:
+            send(self.target, {"output": text})
+
+class Image:
+    """
+    A program image loaded into memory once, kept as a snapshot of the state
+    right before its first instruction.
+
+    Attributes:
+        key (str): Hash of the format and contents of the image.
+        snapshot (Snapshot): The loaded state, with the program counter at the entry point.
+    """
+    key:      str
+    snapshot: Snapshot
+
+    def __init__(self, key: str, snapshot: Snapshot) -> None:
+        self.key = key
+        self.snapshot = snapshot
+
+    @staticmethod
+    def hash(data: bytes, format: str) -> str:
+        return hashlib.sha256(format.encode() + b"\0" + data).hexdigest()
+
+    @staticmethod
+    def load(data: bytes, format: str, mem_size: int) -> "Image":
+        """
+        Loads an image into an empty state and takes a snapshot of it.
+
+        Parameters:
+            data (bytes): The program: a raw binary, an ELF file or assembly source.
+            format (str): One of FORMATS.
+            mem_size (int): Memory size of the VMs that run the image.
+        Returns:
+            Image: The loaded image.
+        Raises:
+            ValueError: If the format is unknown or the image cannot be loaded.
+        """
+        state = RVState(mem_size)
+        if format == "assembly":
+            state.pc = u32(assemble(data.decode()).load(state))
+        elif format != "binary":
+            raise ValueError(f"Unknown image format '{format}', expected one of {', '.join(FORMATS)}")
+        elif is_elf(data):
+            state.pc = u32(load_elf(state, data))
+        else:
+            state.load_memory(0, data)
+        return Image(Image.hash(data, format), state.snapshot())
+
+class ImageCache:
+    """
+    Keeps the most recently used images, so that identical images are only
+    assembled and loaded once across requests.
+
+    Attributes:
+        capacity (int): Maximum number of cached images.
+        hits (int): Number of requests served from the cache.
+        misses (int): Number of images that had to be loaded.
+    """
+    capacity: int
+    hits:     int
+    misses:   int
+
+    def __init__(self, capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, data: bytes, format: str, mem_size: int) -> Image:
+        """
+        Returns the cached image for the data, loading it on a miss.
+        """
+        key = Image.hash(data, format)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                self.hits += 1
+                return image
+        # Load outside of the lock, other jobs keep running meanwhile
+        image = Image.load(data, format, mem_size)
+        with self._lock:
+            self.misses += 1
+            self._images[key] = image
+            while len(self._images) > self.capacity:
+                self._images.popitem(last=False)
+        return image
+
+class PooledVM:
+    """
+    A VM of the pool together with the image it currently holds.
+
+    Between jobs the VM is reset to the snapshot of its image, and the
+    state of its extensions, like the vector registers, is reset. Restoring
+    only copies back the pages written by the job, and since the code pages
+    are not written, the decoded blocks and compiled loops stay valid for
+    the next job with the same image.
+
+    Attributes:
+        vm (VM): The VM.
+        output (StreamOutput): The output stream of the ECALL extension of the VM.
+        image (Image | None): The image in memory, None while the memory is empty.
+    """
+    vm:     VM
+    output: StreamOutput
+    image:  Image | None
+
+    def __init__(self, mem_size: int, engine: str, isa: str) -> None:
+        self.output = StreamOutput()
+        self.vm = VM(mem_size=mem_size, engine=engine, extensions=[
+            *load_extensions(isa),
+            ECALL(output_stream=self.output),
+        ])
+        self.image = None
+
+    def load(self, image: Image) -> None:
+        """
+        Replaces the memory contents with an image. Only the pages of the
+        previous image and the pages written since are cleared.
+        """
+        state = self.vm.state
+        if self.image is not None:
+            state.dirty[self.image.snapshot.page_slots >= 0] = True
+        state.dirty[image.snapshot.page_slots >= 0] = True
+        state.restore(image.snapshot)
+        self.vm.flush_decode_cache()
+        self.image = image
+
+    def reset(self) -> None:
+        """
+        Resets the VM and its extensions to the start of its image.
+        """
+        self.output.flush()
+        self.output.target = None
+        self.vm.reset_extensions()
+        if self.image is not None:
+            self.vm.state.restore(self.image.snapshot)
+
+class VMPool:
+    """
+    A fixed number of pre-built VMs, handed out to one job at a time.
+    A VM that already holds the requested image is preferred.
+
+    Attributes:
+        mem_size (int): Memory size of every VM.
+        idle (list[PooledVM]): The VMs that are not running a job.
+    """
+    mem_size: int
+    idle:     list[PooledVM]
+
+    def __init__(self, size: int, mem_size: int = 1024 * 1024 * 1024, engine: str = "block",
+                 isa: str = DEFAULT_ISA) -> None:
+        if size <= 0:
+            raise ValueError(f"Pool size must be positive, got {size}")
+        self.mem_size = mem_size
+        self.idle = [PooledVM(mem_size, engine, isa) for _ in range(size)]
+        self._available = threading.Condition()
+
+    @contextmanager
+    def checkout(self, key: str) -> Iterator[PooledVM]:
+        """
+        Takes a VM from the pool, waiting until one is idle, and returns
+        it reset to the start of its image after the job.
+
+        Parameters:
+            key (str): Key of the image the job runs.
+        """
+        with self._available:
+            self._available.wait_for(lambda: self.idle)
+            warm = [entry for entry in self.idle if entry.image is not None and entry.image.key == key]
+            entry = warm[0] if warm else self.idle[0]
+            self.idle.remove(entry)
+        try:
+            yield entry
+        finally:
+            entry.reset()
+            with self._available:
+                self.idle.append(entry)
+                self._available.notify()
+
+def send(stream: BinaryIO, message: dict) -> None:
+    """
+    Sends a message as one line of JSON.
+    """
+    stream.write(json.dumps(message).encode() + b"\n")
+    stream.flush()
+
+def parse_register(name: str) -> int:
+    if name not in REGISTERS or REGISTERS[name] == 0:
+        raise ValueError(f"Unknown or read-only register '{name}'")
+    return REGISTERS[name]
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Runs jobs on a pool of VMs for clients connected to a Unix socket.
+
+    Every request is one line of JSON:
+        {"image": <base64>, "format": "binary" | "assembly",
+         "registers": {"a0": 1, ...}, "memory": [[<address>, <base64>], ...], "steps": <n>,
+         "timeout": <seconds>}
+    Only image is required; steps defaults to running until the program halts,
+    and timeout to no limit.
+    The server answers with any number of {"output": <text>} messages while
+    the program runs, followed by one of:
+        {"status": <reason>, "pc": <pc>, "instret": <n>, "elapsed": <seconds>,
+         "registers": [<x0>, ..., <x31>]}
+    with a reason of engine, like "halted", "budget", "timeout" or "access fault".
+    Halted programs also report "exit_code", the value of a0, and faults report "fault", the message.
+        {"error": <message>}
+    A connection may send any number of requests, one after the other.
+
+    Attributes:
+        pool (VMPool): The VMs that run the jobs.
+        images (ImageCache): The loaded images.
+    """
+    daemon_threads = True
+    pool:   VMPool
+    images: ImageCache
+
+    def __init__(self, path: str, pool: VMPool, images: ImageCache | None = None) -> None:
+        self.pool = pool
+        self.images = images if images is not None else ImageCache()
+        super().__init__(path, JobHandler)
+
+    def execute(self, request: dict, stream: BinaryIO) -> dict:
+        """
+        Runs one job and returns its exit state. Output is sent to the stream while the job runs.
+        """
+        data = base64.b64decode(request["image"])
+        image = self.images.get(data, request.get("format", "binary"), self.pool.mem_size)
+        with self.pool.checkout(image.key) as entry:
+            if entry.image is not image:
+                entry.load(image)
+            vm, state = entry.vm, entry.vm.state
+            for name, value in request.get("registers", {}).items():
+                state.rf[parse_register(name)] = signed32(int(value))
+            for address, contents in request.get("memory", []):
+                state.load_memory(int(address), base64.b64decode(contents))
+
+            entry.output.target = stream
+            timeout = request.get("timeout")
+            result = vm.run(int(request.get("steps", -1)), None if timeout is None else float(timeout))
+            entry.output.flush()
+            reply = {"status": result.reason, "pc": int(state.pc), "instret": int(state.instret),
+                     "elapsed": result.elapsed, "registers": [int(r) for r in state.rf]}
+            if result.exit_code is not None:
+                reply["exit_code"] = result.exit_code
+            if result.error is not None:
+                reply["fault"] = str(result.error)
+            return reply
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the requests of one connection.
+    """
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                result = self.server.execute(json.loads(line), self.wfile)
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            send(self.wfile, result)
+
+def submit(path: str, image: bytes, format: str = "binary", registers: dict[str, int] | None = None,
+           memory: list[tuple[int, bytes]] | None = None, steps: int = -1,
+           timeout: float | None = None, output: TextIO = sys.stdout) -> dict:
+    """
+    Runs a job on a server and writes its output to a stream.
+
+    Parameters:
+        path (str): Path of the Unix socket of the server.
+        image (bytes): The program: a raw binary, an ELF file or assembly source.
+        format (str): One of FORMATS.
+        registers (dict[str, int] | None): Initial register values by name, e.g. {"a0": 1}.
+        memory (list[tuple[int, bytes]] | None): Data to load at addresses before running.
+        steps (int): Number of steps to execute. If negative, runs until halted.
+        timeout (float | None): Maximum wall-clock duration of the run in seconds, None for no limit.
+        output (TextIO): The stream for the ECALL output.
+    Returns:
+        dict: The exit state sent by the server.
+    Raises:
+        RuntimeError: If the server reports an error.
+    """
+    request = {
+        "image": base64.b64encode(image).decode(),
+        "format": format,
+        "registers": registers or {},
+        "memory": [[address, base64.b64encode(data).decode()] for address, data in memory or []],
+        "steps": steps,
+        "timeout": timeout,
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        stream = connection.makefile("rwb")
+        send(stream, request)
+        for line in stream:
+            message = json.loads(line)
+            if "output" in message:
+                output.write(message["output"])
+            elif "error" in message:
+                raise RuntimeError(message["error"])
+            else:
+                return message
+    raise RuntimeError("Connection closed by the server")
+
+def serve(server: Server, workers: int) -> None:
+    """
+    Serves connections from a number of processes that share the listening socket.
+
+    The VMs run Python code, so the threads of one process only give concurrency,
+    not parallelism. The workers are forked after the pool is built, every worker
+    owns a copy of the pool and the image cache, and the kernel hands every
+    connection to one of them. The calling process is one of the workers and
+    terminates the others when it stops serving.
+
+    Parameters:
+        server (Server): The server, already listening.
+        workers (int): Number of worker processes.
+    Raises:
+        ValueError: If the number of workers is not positive.
+    """
+    if workers <= 0:
+        raise ValueError(f"Number of workers must be positive, got {workers}")
+    children = []
+    for _ in range(workers - 1):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        children.append(pid)
+    try:
+        server.serve_forever()
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+
+def main():
+    parser = argparse.ArgumentParser(description="rvpy server: runs RISC-V programs for clients of a Unix socket.")
+    parser.add_argument("socket", type=str, help="path of the Unix socket to listen on")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes running jobs in parallel (default: number of CPUs)")
+    parser.add_argument("-n", "--pool-size", type=int, default=1,
+                        help="number of pre-built VMs of every worker, more than one only lets the jobs "
+                             "of a worker take turns (default: 1)")
+    parser.add_argument("-m", "--mem-size", type=int, default=1024 * 1024 * 1024,
+                        help="size of the memory of every VM in bytes (default: 1 GiB)")
+    parser.add_argument("-e", "--engine", choices=list(ENGINES), default="block",
+                        help="execution engine of the VMs")
+    parser.add_argument("-march", "--march", type=str, default=DEFAULT_ISA,
+                        help=f"ISA string naming the extensions of the VMs (default: {DEFAULT_ISA})")
+    parser.add_argument("--cache-size", type=int, default=64,
+                        help="number of loaded images to keep (default: 64)")
+    args = parser.parse_args()
+
+    # Remove the socket file left behind by a previous server
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    pool = VMPool(args.pool_size, args.mem_size, args.engine, args.march)
+    with Server(args.socket, pool, ImageCache(args.cache_size)) as server:
+        print(f"Listening on {args.socket} with {args.workers} workers of {args.pool_size} VMs", file=sys.stderr)
+        try:
+            serve(server, args.workers)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(args.socket)
+
+if __name__ == "__main__":
+    main()
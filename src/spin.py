@@ -0,0 +1,187 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from math import gcd
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper
+
+# Opcodes of instructions that only read memory and write rd
+OP_OPCODE     = 0b0110011
+OP_IMM_OPCODE = 0b0010011
+LOAD_OPCODE   = 0b0000011
+LUI_OPCODE    = 0b0110111
+AUIPC_OPCODE  = 0b0010111
+BRANCH_OPCODE = 0b1100011
+JAL_OPCODE    = 0b1101111
+PURE_OPCODES  = {OP_OPCODE, OP_IMM_OPCODE, LOAD_OPCODE, LUI_OPCODE, AUIPC_OPCODE}
+
+# Branch funct3 values
+BEQ, BNE, BLT, BGE, BLTU, BGEU = 0b000, 0b001, 0b100, 0b101, 0b110, 0b111
+
+# Number of iterations that may fail the fixed point check before a loop is given up
+MAX_CHECKS = 4
+
+def sources(instruction: Instruction) -> tuple[int, ...]:
+    """
+    Returns the registers read by a pure or branch instruction.
+    """
+    opcode = int(instruction.opcode)
+    if opcode in (OP_OPCODE, BRANCH_OPCODE):
+        return int(instruction.rs1), int(instruction.rs2)
+    if opcode in (OP_IMM_OPCODE, LOAD_OPCODE):
+        return int(instruction.rs1),
+    return ()
+
+class SpinLoop:
+    """
+    A block that jumps back to its own start and neither stores to memory nor
+    touches state outside the register file.
+
+    Since memory can only change through the guest's own stores or the host,
+    an iteration that leaves every register unchanged will repeat forever: the
+    loop is idle. If exactly one counter register changes, by the immediate of
+    its addi, and the branch compares it against a register the loop does not
+    write, the number of iterations until the loop exits can be computed.
+
+    Attributes:
+        start (int): Address of the loop.
+        length (int): Number of instructions per iteration.
+        exit (int): Address after the loop.
+        counter (int | None): The counter register of a counted loop.
+        step (int): The value added to the counter per iteration.
+        other (int): The register the counter is compared against.
+        funct3 (int): The funct3 field of the closing branch.
+        counter_first (bool): Whether the counter is rs1 of the branch.
+        checks (int): Remaining iterations that may fail the fixed point check.
+    """
+    start:         int
+    length:        int
+    exit:          int
+    counter:       int | None
+    step:          int
+    other:         int
+    funct3:        int
+    counter_first: bool
+    checks:        int
+
+    def __init__(self, start: int, length: int) -> None:
+        self.start = start
+        self.length = length
+        self.exit = start + 4 * length
+        self.counter = None
+        self.step = 0
+        self.other = 0
+        self.funct3 = 0
+        self.counter_first = False
+        self.checks = MAX_CHECKS
+
+    @staticmethod
+    def analyze(start: int, instructions: list[Instruction], impls: list[InstructionImpl]) -> "SpinLoop | None":
+        """
+        Checks whether a decoded block is a loop that can be fast-forwarded.
+
+        Parameters:
+            start (int): Address of the block.
+            instructions (list[Instruction]): The instructions of the block.
+            impls (list[InstructionImpl]): Their implementations.
+        Returns:
+            SpinLoop | None: The loop, or None if the block is not a candidate.
+        """
+        last = instructions[-1]
+        opcode = int(last.opcode)
+        offset = -4 * (len(instructions) - 1)
+        if opcode == BRANCH_OPCODE:
+            if int(last.imm_b) != offset:
+                return None
+        elif opcode == JAL_OPCODE:
+            if int(last.imm_j) != offset:
+                return None
+        else:
+            return None
+
+        # Observed implementations must see every iteration
+        if any(isinstance(impl, ImplWrapper) for impl in impls):
+            return None
+        body = instructions[:-1]
+        if any(int(instruction.opcode) not in PURE_OPCODES for instruction in body):
+            return None
+
+        loop = SpinLoop(start, len(instructions))
+        if opcode != BRANCH_OPCODE or int(last.funct3) == BEQ:
+            return loop
+
+        # Find the counter: the only instruction touching it is addi rc, rc, step
+        written = [int(instruction.rd) for instruction in body]
+        for rc, other in ((int(last.rs1), int(last.rs2)), (int(last.rs2), int(last.rs1))):
+            if rc == 0 or rc == other or other in written:
+                continue
+            updates = [instruction for instruction in body if int(instruction.rd) == rc]
+            if len(updates) != 1:
+                continue
+            update = updates[0]
+            if int(update.opcode) != OP_IMM_OPCODE or int(update.funct3) != 0 \
+               or int(update.rs1) != rc or int(update.imm_i) == 0:
+                continue
+            if any(rc in sources(instruction) for instruction in body if instruction is not update):
+                continue
+            loop.counter = rc
+            loop.step = int(update.imm_i)
+            loop.other = other
+            loop.funct3 = int(last.funct3)
+            loop.counter_first = rc == int(last.rs1)
+            break
+        return loop
+
+    def exit_iterations(self, counter: int, other: int) -> int | None:
+        """
+        Computes how many more iterations run until the closing branch falls through.
+
+        Parameters:
+            counter (int): The value of the counter at the start of the loop.
+            other (int): The value of the register it is compared against.
+        Returns:
+            int | None: The number of iterations, or None if the loop does not exit
+                without the counter wrapping around.
+        """
+        k = self.step
+        if self.funct3 == BNE:
+            # Solve counter + j * k = other (mod 2^32) for the smallest j >= 1
+            modulus = 1 << 32
+            g = gcd(k % modulus, modulus)
+            difference = (other - counter) % modulus
+            if difference % g:
+                return None
+            period = modulus // g
+            j = (difference // g) * pow((k % modulus) // g, -1, period) % period
+            return j or period
+
+        if self.funct3 in (BLT, BGE):
+            low, high = -(1 << 31), (1 << 31) - 1
+            counter = ((counter + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+            other = ((other + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+        else:
+            low, high = 0, 0xFFFFFFFF
+            counter &= 0xFFFFFFFF
+            other &= 0xFFFFFFFF
+
+        # Normalize the loop condition to "counter <op> other"
+        less = self.funct3 in (BLT, BLTU)
+        if self.counter_first:
+            condition = "<" if less else ">="
+        else:
+            condition = ">" if less else "<="
+
+        if condition == "<" and k > 0:
+            j = -((counter - other) // k)
+        elif condition == "<=" and k > 0:
+            j = (other - counter) // k + 1
+        elif condition == ">" and k < 0:
+            j = -((other - counter) // -k)
+        elif condition == ">=" and k < 0:
+            j = (counter - other) // -k + 1
+        else:
+            return None
+        if j < 1 or not low <= counter + j * k <= high:
+            return None
+        return j
@@ -5,6 +5,56 @@
 import numpy as np
 from nums import u8, u32, i32
 
+# Memory is tracked in pages of 4 KiB for dirty-page bookkeeping
+PAGE_SHIFT = 12
+PAGE_SIZE  = 1 << PAGE_SHIFT
+
+def as_bytes(data) -> np.ndarray[u8]:
+    """
+    Returns the bytes of a buffer-protocol object as a u8 array without copying.
+    Only non-contiguous NumPy arrays are copied.
+
+    Raises:
+        TypeError: If the object does not support the buffer protocol.
+    """
+    if isinstance(data, np.ndarray):
+        return np.ascontiguousarray(data).reshape(-1).view(u8)
+    try:
+        return np.frombuffer(memoryview(data).cast("B"), dtype=u8)
+    except TypeError:
+        raise TypeError(f"Expected a bytes-like object, got {type(data)}") from None
+
+class Snapshot:
+    """
+    A snapshot of an RVState taken by RVState.snapshot().
+
+    Only the registers and the non-zero memory pages are stored, so taking a
+    snapshot of a mostly empty memory is cheap.
+
+    Attributes:
+        rf (np.ndarray[i32]): Copy of the register file.
+        pc (u32): Program counter.
+        halt (bool): Halt flag.
+        instret (int): Number of retired instructions.
+        page_slots (np.ndarray[i32]): Index into pages for every memory page, -1 if the page was all zeros.
+        pages (np.ndarray[u8]): Contents of the non-zero pages, one row per page.
+    """
+    rf:         np.ndarray[i32]
+    pc:         u32
+    halt:       bool
+    instret:    int
+    page_slots: np.ndarray[i32]
+    pages:      np.ndarray[u8]
+
+    def __init__(self, rf: np.ndarray[i32], pc: u32, halt: bool, instret: int,
+                 page_slots: np.ndarray[i32], pages: np.ndarray[u8]) -> None:
+        self.rf = rf
+        self.pc = pc
+        self.halt = halt
+        self.instret = instret
+        self.page_slots = page_slots
+        self.pages = pages
+
 class RVState:
     """
     Represents the state of a RISC-V processor.
@@ -14,11 +64,21 @@ class RVState:
         rf (np.ndarray[i32]): Register file containing 32 registers.
         pc (u32): Program counter.
         halt (bool): Flag indicating whether the processor is halted.
+        instret (int): Number of retired instructions.
+        dirty (np.ndarray[bool]): One flag per memory page, set when the page is written.
+        code (np.ndarray[bool]): One flag per memory page, set while the page holds decoded instructions.
+        code_words (set[int]): Word indices (address >> 2) of all decoded instructions.
+        code_modified (bool): Set when a decoded instruction is overwritten.
     """
-    mem:  np.ndarray[u8]  # Memory
-    rf:   np.ndarray[i32] # Register file
-    pc:   u32             # Program counter
-    halt: bool            # Halt flag
+    mem:           np.ndarray[u8]   # Memory
+    rf:            np.ndarray[i32]  # Register file
+    pc:            u32              # Program counter
+    halt:          bool             # Halt flag
+    instret:       int              # Retired instruction counter
+    dirty:         np.ndarray[bool] # Dirty page flags
+    code:          np.ndarray[bool] # Code page flags
+    code_words:    set[int]         # Decoded instruction words
+    code_modified: bool             # Code write flag
 
     def __init__(self, mem_size: int = 1024 * 1024 * 1024) -> None:
         """
@@ -27,36 +87,207 @@ class RVState:
         Parameters:
             mem_size (int): Size of the memory in bytes. Defaults to 1 GiB.
         """
-        self.mem = np.zeros(mem_size, dtype=u8)
+        # Allocate whole pages so that memory can be viewed as a page table
+        n_pages = (mem_size + PAGE_SIZE - 1) >> PAGE_SHIFT
+        self._backing = np.zeros(n_pages * PAGE_SIZE, dtype=u8)
+        self._pages = self._backing.reshape(n_pages, PAGE_SIZE)
+        self.mem = self._backing[:mem_size]
+        self.dirty = np.zeros(n_pages, dtype=bool)
+        self.code = np.zeros(n_pages, dtype=bool)
+        self.code_words = set()
+        self.code_modified = False
         self.rf = np.zeros(32, dtype=i32)
         self.pc = u32(0)
         self.halt = False
+        self.instret = 0
     
     def reset(self) -> None:
         """
         Resets the RVState to its initial state.
 
         This method clears the memory, resets the register file, sets the program counter to 0,
-        and clears the halt flag.
+        and clears the halt flag and the retired instruction counter.
         """
         self.mem.fill(0)
+        self.dirty.fill(False)
+        self.code_modified = True
         self.rf.fill(0)
         self.pc = u32(0)
         self.halt = False
+        self.instret = 0
+
+    def mark_dirty(self, address: int, size: int = 1) -> None:
+        """
+        Marks the pages covering a memory range as dirty.
+        Must be called by everything that writes to memory.
+
+        Parameters:
+            address (int): The starting address of the write.
+            size (int): The number of bytes written.
+        """
+        first = int(address) >> PAGE_SHIFT
+        last = (int(address) + size - 1) >> PAGE_SHIFT
+        if first == last:
+            self.dirty[first] = True
+            if self.code[first] and self.touches_code(address, size):
+                self.code_modified = True
+        else:
+            self.dirty[first:last + 1] = True
+            if self.code[first:last + 1].any() and self.touches_code(address, size):
+                self.code_modified = True
+
+    def touches_code(self, address: int, size: int) -> bool:
+        """
+        Checks whether a memory range overlaps a decoded instruction.
+        Data that shares a page with code does not invalidate the decoded code.
+        """
+        if size > 4 * len(self.code_words):
+            return any(address <= 4 * word < address + size for word in self.code_words)
+        words = range(int(address) >> 2, ((int(address) + size - 1) >> 2) + 1)
+        return any(word in self.code_words for word in words)
+
+    def snapshot(self) -> Snapshot:
+        """
+        Takes a snapshot of the current state and clears the dirty page flags,
+        so that restore() only has to copy back the pages written afterwards.
+
+        Returns:
+            Snapshot: The snapshot of the current state.
+        """
+        nonzero = np.flatnonzero(self._pages.any(axis=1))
+        page_slots = np.full(self.dirty.size, -1, dtype=i32)
+        page_slots[nonzero] = np.arange(nonzero.size, dtype=i32)
+        self.dirty.fill(False)
+        return Snapshot(self.rf.copy(), self.pc, self.halt, self.instret, page_slots, self._pages[nonzero])
+
+    def clone(self) -> "RVState":
+        """
+        Creates an independent copy of the state.
+        Only the non-zero memory pages are copied, like in snapshot().
+
+        Returns:
+            RVState: The copy, with the same dirty page flags.
+        """
+        copy = RVState(self.mem.size)
+        nonzero = np.flatnonzero(self._pages.any(axis=1))
+        copy._pages[nonzero] = self._pages[nonzero]
+        copy.dirty[:] = self.dirty
+        copy.rf[:] = self.rf
+        copy.pc = self.pc
+        copy.halt = self.halt
+        copy.instret = self.instret
+        return copy
 
-    def load_memory(self, address: int, data: bytes) -> None:
+    def restore(self, snapshot: Snapshot) -> None:
+        """
+        Restores a snapshot taken with snapshot().
+        Only the pages marked as dirty since the snapshot are copied back.
+
+        Parameters:
+            snapshot (Snapshot): The snapshot to restore.
+        """
+        self.rf[:] = snapshot.rf
+        self.pc = snapshot.pc
+        self.halt = snapshot.halt
+        self.instret = snapshot.instret
+
+        # Zero all dirty pages, then copy back those that held data
+        dirty = np.flatnonzero(self.dirty)
+        if dirty.size:
+            if self.code[dirty].any():
+                self.code_modified = True
+            self._pages[dirty] = 0
+            slots = snapshot.page_slots[dirty]
+            saved = slots >= 0
+            self._pages[dirty[saved]] = snapshot.pages[slots[saved]]
+            self.dirty.fill(False)
+
+    def nonzero_pages(self) -> np.ndarray:
+        """
+        Returns the indices of all memory pages that hold data, in ascending order.
+        """
+        return np.flatnonzero(self._pages.any(axis=1))
+
+    def copy_pages(self, pages: np.ndarray) -> np.ndarray[u8]:
+        """
+        Returns a copy of memory pages, one row per page.
+
+        Parameters:
+            pages (np.ndarray): Indices of the pages.
+        """
+        return self._pages[pages]
+
+    def write_pages(self, pages: np.ndarray, contents: np.ndarray[u8] | None = None) -> None:
+        """
+        Overwrites whole memory pages, e.g. with copies from copy_pages().
+        The dirty page flags are left to the caller.
+
+        Parameters:
+            pages (np.ndarray): Indices of the pages.
+            contents (np.ndarray[u8] | None): One row per page, or None to zero the pages.
+        """
+        if not len(pages):
+            return
+        if self.code[pages].any():
+            self.code_modified = True
+        self._pages[pages] = 0 if contents is None else contents
+
+    def load_memory(self, address: int, data) -> None:
         """
         Loads data into memory at a specified address.
 
+        The data is copied straight into memory, without an intermediate copy.
+
         Parameters:
             address (int): The starting address in memory.
-            data (np.ndarray[u8]): The data to load into memory.
+            data: The data to load: bytes, bytearray, memoryview, mmap, a NumPy array
+                or any other object that supports the buffer protocol.
+        """
+        source = as_bytes(data)
+        self.check_range(address, source.size)
+        self.mem[address:address + source.size] = source
+        if source.size:
+            self.mark_dirty(address, source.size)
+
+    def view(self, address: int, dtype, shape: int | tuple[int, ...], writable: bool = True) -> np.ndarray:
+        """
+        Returns a NumPy array that shares its data with guest memory.
+
+        Multi-byte types without a byte order are little-endian like the guest.
+        Writes through a view are not tracked, so a writable view marks its
+        pages as dirty when it is created. A host that writes instructions
+        through a view after the VM executed them must call
+        flush_decode_cache() of the VM.
+
+        Parameters:
+            address (int): Address of the first element.
+            dtype: Type of the elements, e.g. np.int32 or "<f4".
+            shape (int | tuple[int, ...]): Shape of the array.
+            writable (bool): Whether the host may write through the view.
+        Returns:
+            np.ndarray: The view.
+        """
+        dtype = np.dtype(dtype)
+        if dtype.byteorder == "=":
+            dtype = dtype.newbyteorder("<")
+        shape = (shape,) if isinstance(shape, int) else tuple(shape)
+        size = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+        self.check_range(address, size)
+
+        view = self.mem[address:address + size].view(dtype).reshape(shape)
+        if writable:
+            if size:
+                self.mark_dirty(address, size)
+        else:
+            view.flags.writeable = False
+        return view
+
+    def check_range(self, address: int, size: int) -> None:
+        """
+        Raises an IndexError if a memory range is not within memory.
         """
-        if not isinstance(data, bytes):
-            raise TypeError(f"Expected bytes, got {type(data)}")
-        if address < 0 or address + len(data) > self.mem.size:
-            raise IndexError(f"Memory access out of bounds: {address} + {len(data)} > {self.mem.size}")
-        self.mem[address:address + len(data)] = np.frombuffer(data, dtype=u8)
+        if address < 0 or address + size > self.mem.size:
+            raise IndexError(f"Memory access out of bounds: {address} + {size} > {self.mem.size}")
 
     def __getitem__(self, address: int) -> u8:
         """
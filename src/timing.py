@@ -0,0 +1,319 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from extensions.m import MULTIPLIES, DIVIDES
+from extensions.rv32i import BRANCHES, LOADS, STORES, Jal, JalR, Lui, Auipc
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from state import RVState
+from vm import VM
+
+# Opcodes of the formats that read rs2
+READS_RS2 = {0b0110011, 0b0100011, 0b1100011}
+
+class TimingConfig:
+    """
+    Parameters of a single-issue in-order core.
+
+    Attributes:
+        load_latency (int): Cycles until a loaded value can be used. 2 gives a one cycle load-use stall.
+        mul_latency (int): Cycles until the result of a multiplication can be used.
+        div_latency (int): Cycles until the result of a division or remainder can be used.
+        taken_branch_penalty (int): Bubble cycles after a correctly predicted taken branch or a jump.
+        mispredict_penalty (int): Cycles lost on a mispredicted branch or indirect jump.
+        predictor (str): Branch predictor, "bimodal", "gshare" or "static" (backward taken, forward not taken).
+        predictor_bits (int): log2 of the number of predictor counters.
+        history_bits (int): Length of the global history for gshare.
+    """
+    load_latency:         int
+    mul_latency:          int
+    div_latency:          int
+    taken_branch_penalty: int
+    mispredict_penalty:   int
+    predictor:            str
+    predictor_bits:       int
+    history_bits:         int
+
+    def __init__(self, load_latency: int = 2, mul_latency: int = 3, div_latency: int = 34,
+                 taken_branch_penalty: int = 1, mispredict_penalty: int = 3, predictor: str = "bimodal",
+                 predictor_bits: int = 10, history_bits: int = 8) -> None:
+        if predictor not in ("bimodal", "gshare", "static"):
+            raise ValueError(f"Unknown branch predictor '{predictor}'")
+        self.load_latency = load_latency
+        self.mul_latency = mul_latency
+        self.div_latency = div_latency
+        self.taken_branch_penalty = taken_branch_penalty
+        self.mispredict_penalty = mispredict_penalty
+        self.predictor = predictor
+        self.predictor_bits = predictor_bits
+        self.history_bits = history_bits
+
+class BranchPredictor:
+    """
+    Static predictor: backward branches are predicted taken, forward branches not taken.
+    """
+
+    def predict(self, pc: int, backward: bool) -> bool:
+        return backward
+
+    def update(self, pc: int, taken: bool) -> None:
+        pass
+
+class BimodalPredictor(BranchPredictor):
+    """
+    Table of 2-bit saturating counters indexed by the branch address.
+    """
+
+    def __init__(self, bits: int) -> None:
+        self.mask = (1 << bits) - 1
+        # Start weakly not taken
+        self.counters = bytearray([1]) * (1 << bits)
+
+    def index(self, pc: int) -> int:
+        return (pc >> 2) & self.mask
+
+    def predict(self, pc: int, backward: bool) -> bool:
+        return self.counters[self.index(pc)] >= 2
+
+    def update(self, pc: int, taken: bool) -> None:
+        i = self.index(pc)
+        counter = self.counters[i]
+        if taken:
+            if counter < 3:
+                self.counters[i] = counter + 1
+        elif counter > 0:
+            self.counters[i] = counter - 1
+
+class GsharePredictor(BimodalPredictor):
+    """
+    Table of 2-bit saturating counters indexed by the branch address XOR the global history.
+    """
+
+    def __init__(self, bits: int, history_bits: int) -> None:
+        super().__init__(bits)
+        self.history = 0
+        self.history_mask = (1 << history_bits) - 1
+
+    def index(self, pc: int) -> int:
+        return ((pc >> 2) ^ self.history) & self.mask
+
+    def update(self, pc: int, taken: bool) -> None:
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | taken) & self.history_mask
+
+class TimingModel:
+    """
+    Cycle-approximate model of a single-issue in-order pipeline.
+
+    Every instruction issues one cycle after the previous one unless one of
+    its source registers is not ready yet, which models load-use hazards and
+    the latency of multiplications and divisions. Control transfers add the
+    taken-branch or misprediction penalty. Indirect jumps are predicted with
+    the last target of the same jump.
+
+    The model wraps the instruction implementations of the VM while it is
+    attached. A VM without a timing model runs unchanged.
+
+    Attributes:
+        vm (VM): The modeled VM.
+        config (TimingConfig): The core parameters.
+        predictor (BranchPredictor): The conditional branch predictor.
+        cycles (int): Cycles elapsed so far.
+        instructions (int): Instructions issued so far.
+        stalls (dict[str, int]): Stall cycles by cause: "load_use", "muldiv", "branch" and "jump".
+        branches (int): Number of executed conditional branches.
+        mispredicts (int): Number of mispredicted branches and indirect jumps.
+    """
+    vm:           VM
+    config:       TimingConfig
+    predictor:    BranchPredictor
+    cycles:       int
+    instructions: int
+    stalls:       dict[str, int]
+    branches:     int
+    mispredicts:  int
+
+    def __init__(self, vm: VM, config: TimingConfig | None = None) -> None:
+        """
+        Initializes the model and instruments the VM.
+        """
+        self.vm = vm
+        self.config = config or TimingConfig()
+        if self.config.predictor == "bimodal":
+            self.predictor = BimodalPredictor(self.config.predictor_bits)
+        elif self.config.predictor == "gshare":
+            self.predictor = GsharePredictor(self.config.predictor_bits, self.config.history_bits)
+        else:
+            self.predictor = BranchPredictor()
+        self.cycles = 0
+        self.instructions = 0
+        self.stalls = {"load_use": 0, "muldiv": 0, "branch": 0, "jump": 0}
+        self.branches = 0
+        self.mispredicts = 0
+
+        # Cycle at which every register is ready, and whether a load or M instruction produced it
+        self._ready = [0] * 32
+        self._producer = ["load_use"] * 32
+        self._targets = {}
+
+        config = self.config
+        impls = vm.instruction_implementations
+        self._original = list(impls)
+        for i, impl in enumerate(impls):
+            base = unwrap(impl)
+            if isinstance(base, BRANCHES):
+                impls[i] = TimedBranch(impl, self)
+            elif isinstance(base, JalR):
+                impls[i] = TimedIndirectJump(impl, self)
+            elif isinstance(base, Jal):
+                impls[i] = TimedJump(impl, self)
+            elif isinstance(base, LOADS):
+                impls[i] = TimedImpl(impl, self, config.load_latency, "load_use")
+            elif isinstance(base, STORES):
+                impls[i] = TimedImpl(impl, self, writes_rd=False)
+            elif isinstance(base, MULTIPLIES):
+                impls[i] = TimedImpl(impl, self, config.mul_latency, "muldiv")
+            elif isinstance(base, DIVIDES):
+                impls[i] = TimedImpl(impl, self, config.div_latency, "muldiv")
+            elif isinstance(base, (Lui, Auipc)):
+                impls[i] = TimedImpl(impl, self, 1, reads=False)
+            else:
+                impls[i] = TimedImpl(impl, self)
+        vm.flush_decode_cache()
+
+    def issue(self, instruction: Instruction, reads: bool, latency: int, producer: str,
+              writes_rd: bool = True) -> None:
+        """
+        Issues an instruction, stalling until its source registers are ready.
+
+        Parameters:
+            instruction (Instruction): The issued instruction.
+            reads (bool): Whether the instruction reads rs1 (and rs2 for R, S and B formats).
+            latency (int): Cycles until the result in rd can be used.
+            producer (str): Stall cause charged to instructions waiting for rd.
+            writes_rd (bool): Whether the instruction writes rd. Stores and branches have
+                immediate bits in its place.
+        """
+        start = self.cycles
+        if reads:
+            word = int(instruction.instruction_word)
+            ready = self._ready
+            source = 0
+            rs1 = (word >> 15) & 0x1F
+            if rs1 and ready[rs1] > start:
+                start, source = ready[rs1], rs1
+            if word & 0x7F in READS_RS2:
+                rs2 = (word >> 20) & 0x1F
+                if rs2 and ready[rs2] > start:
+                    start, source = ready[rs2], rs2
+            if source:
+                self.stalls[self._producer[source]] += start - self.cycles
+
+        if writes_rd:
+            rd = (int(instruction.instruction_word) >> 7) & 0x1F
+            if rd:
+                self._ready[rd] = start + latency
+                self._producer[rd] = producer
+        self.cycles = start + 1
+        self.instructions += 1
+
+    def redirect(self, cause: str, penalty: int) -> None:
+        """
+        Charges the bubble cycles of a control transfer.
+        """
+        self.cycles += penalty
+        self.stalls[cause] += penalty
+
+    def cpi(self) -> float:
+        return self.cycles / self.instructions if self.instructions else 0.0
+
+    def report(self) -> dict:
+        """
+        Summarizes the modeled execution.
+        """
+        return {
+            "cycles": self.cycles,
+            "instructions": self.instructions,
+            "cpi": self.cpi(),
+            "stalls": dict(self.stalls),
+            "branches": self.branches,
+            "mispredicts": self.mispredicts,
+        }
+
+    def detach(self) -> None:
+        """
+        Removes the instrumentation from the VM.
+        """
+        self.vm.instruction_implementations[:] = self._original
+        self.vm.flush_decode_cache()
+
+class TimedImpl(ImplWrapper):
+    """
+    Issues a non-control instruction in the timing model.
+    """
+
+    def __init__(self, impl: InstructionImpl, model: TimingModel, latency: int = 1,
+                 producer: str = "load_use", reads: bool = True, writes_rd: bool = True) -> None:
+        super().__init__(impl)
+        self.model = model
+        self.latency = latency
+        self.producer = producer
+        self.reads = reads
+        self.writes_rd = writes_rd
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        self.impl.execute(state, instruction)
+        self.model.issue(instruction, self.reads, self.latency, self.producer, self.writes_rd)
+
+class TimedBranch(TimedImpl):
+    """
+    Issues a conditional branch and charges its prediction outcome.
+    """
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        self.impl.execute(state, instruction)
+        model = self.model
+        model.issue(instruction, True, 1, "load_use", False)
+
+        taken = int(state.pc) != pc + 4
+        predictor = model.predictor
+        predicted = predictor.predict(pc, int(instruction.imm_b) < 0)
+        predictor.update(pc, taken)
+        model.branches += 1
+        if predicted != taken:
+            model.mispredicts += 1
+            model.redirect("branch", model.config.mispredict_penalty)
+        elif taken:
+            model.redirect("branch", model.config.taken_branch_penalty)
+
+class TimedJump(TimedImpl):
+    """
+    Issues a direct jump, whose target is known at decode.
+    """
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        self.impl.execute(state, instruction)
+        model = self.model
+        model.issue(instruction, False, 1, "load_use")
+        model.redirect("jump", model.config.taken_branch_penalty)
+
+class TimedIndirectJump(TimedImpl):
+    """
+    Issues an indirect jump, predicted with the last target of the same jump.
+    """
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        pc = int(state.pc)
+        self.impl.execute(state, instruction)
+        model = self.model
+        model.issue(instruction, True, 1, "load_use")
+
+        target = int(state.pc)
+        if model._targets.get(pc) == target:
+            model.redirect("jump", model.config.taken_branch_penalty)
+        else:
+            model._targets[pc] = target
+            model.mispredicts += 1
+            model.redirect("jump", model.config.mispredict_penalty)
@@ -2,27 +2,116 @@
 #
 # This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
 # It is released under the GNU General Public License v3.0.
+import time
 import numpy as np
-from state import RVState
+from typing import Callable, TYPE_CHECKING
+from state import RVState, as_bytes
 from instruction_impl import InstructionImpl
 from instruction import Instruction
-from nums import u32
+from nums import u8, u32, signed32
 from extension import Extension
+from state import PAGE_SHIFT
+from spin import SpinLoop
+from fusion import fuse
+from region import Region, compile_region
+from engine import Engine, ReferenceEngine, BlockEngine, LockstepEngine, Stop, RunResult
+from engine import HALTED, BUDGET, TIMEOUT, EBREAK, ILLEGAL_INSTRUCTION, ACCESS_FAULT, IDLE
+
+if TYPE_CHECKING:
+    from coverage import CoverageCollector
+    from hooks import Hook, Hooks
+
+# Opcodes of instructions that may change the control flow or halt the VM
+BRANCH_OPCODE = 0b1100011
+JAL_OPCODE    = 0b1101111
+JALR_OPCODE   = 0b1100111
+SYSTEM_OPCODE = 0b1110011
+BLOCK_ENDING_OPCODES = {BRANCH_OPCODE, JAL_OPCODE, JALR_OPCODE, SYSTEM_OPCODE}
+
+# Maximum number of instructions in a decoded block
+MAX_BLOCK_LENGTH = 64
+
+# Number of back edge executions after which a loop is compiled into a region
+HOT_THRESHOLD = 50
+
+# Maximum number of instructions in a compiled region
+MAX_REGION_LENGTH = 1024
+
+# Number of instructions between checks of the wall-clock budget of a run
+WATCHDOG_INTERVAL = 10_000
+
+# Instruction word of EBREAK
+EBREAK_WORD = 0x00100073
+
+# Engines that can be selected by name
+ENGINES = {engine.name: engine for engine in (ReferenceEngine, BlockEngine, LockstepEngine)}
+
+def clear_x0(execute: Callable[[RVState, Instruction], None]) -> Callable[[RVState, Instruction], None]:
+    """
+    Wraps the execute method of an instruction with rd = x0, so that x0 is
+    zero again before the next instruction of a block reads it.
+    """
+    def execute_and_clear(state: RVState, instruction: Instruction) -> None:
+        execute(state, instruction)
+        state.rf[0] = 0
+    return execute_and_clear
+
+class Block:
+    """
+    A decoded basic block: a run of instructions that is entered at its first
+    instruction and only leaves the straight-line path at its last one.
+
+    Attributes:
+        start (int): Address of the first instruction.
+        entries (list[tuple[Callable, Instruction]]): Execute method and decoded instruction of every
+            instruction or fused pair of instructions.
+        length (int): Number of instructions in the block.
+        loop (SpinLoop | None): Set if the block is a loop that may be fast-forwarded.
+        region (Region | None): Set if the block is the header of a compiled hot loop.
+    """
+    start:   int
+    entries: list[tuple[Callable[[RVState, Instruction], None], Instruction]]
+    length:  int
+    loop:    SpinLoop | None
+    region:  Region | None
+
+    def __init__(self, start: int, entries: list[tuple[Callable[[RVState, Instruction], None], Instruction]],
+                 length: int) -> None:
+        self.start = start
+        self.entries = entries
+        self.length = length
+        self.loop = None
+        self.region = None
 
 class VM:
     """
     Virtual Machine (VM) for executing RISC-V instructions.
     """
     state: RVState
+    engine: Engine
+    extensions: list[Extension]
     instruction_implementations: list[InstructionImpl]
+    intercepts: dict[int, Callable[[RVState], None]]
+    breakpoints: set[int]
+    blocks: dict[int, Block]
+    idle_handler: Callable[[RVState], None] | None
+    hot_threshold: int | None
+    back_edges: dict[int, int]
+    fusion: bool
+    fusions: dict[str, int]
+    hooks: "Hooks | None"
+    coverage: "CoverageCollector | None"
 
-    def __init__(self, mem_size: int = 1024 * 1024 * 1024, extensions: list[Extension] = []) -> None:
+    def __init__(self, mem_size: int = 1024 * 1024 * 1024, extensions: list[Extension] = [],
+                 engine: Engine | str = "block") -> None:
         """
         Initializes the VM with a given memory size.
 
         Parameters:
             mem_size (int): Size of the memory in bytes. Defaults to 1 GiB.
             extensions (list[Extension]): List of extensions to load into the VM.
+            engine (Engine | str): The engine that executes run(), or the name of one in ENGINES.
+                Defaults to the block engine.
         """
         # Validate memory size
         if not isinstance(mem_size, int) or mem_size <= 0:
@@ -31,7 +120,41 @@ class VM:
         # Initialize the state and instruction implementations
         self.state = RVState(mem_size)
 
+        # Select the execution engine
+        if isinstance(engine, str):
+            if engine not in ENGINES:
+                raise ValueError(f"Unknown engine '{engine}', expected one of {', '.join(ENGINES)}")
+            engine = ENGINES[engine]()
+        self.engine = engine
+
+        # Host routines that replace guest code at specific addresses
+        self.intercepts = {}
+
+        # Addresses at which run() stops before executing the instruction
+        self.breakpoints = set()
+
+        # Cache of decoded blocks by start address
+        self.blocks = {}
+
+        # Called when the guest spins in a loop that only memory changes can end
+        self.idle_handler = None
+
+        # Back edge counts by loop header, loops are compiled once they get hot
+        self.hot_threshold = HOT_THRESHOLD
+        self.back_edges = {}
+
+        # Whether adjacent instruction idioms are fused at decode, and the number of fused pairs by idiom
+        self.fusion = True
+        self.fusions = {}
+
+        # Callbacks for execution events, created by the first hook
+        self.hooks = None
+
+        # Receives the range of every executed block while coverage is collected
+        self.coverage = None
+
         # Initialize the instruction implementations list and load extensions
+        self.extensions = []
         self.instruction_implementations = []
         for ext in extensions:
             if not isinstance(ext, Extension):
@@ -47,28 +170,163 @@ class VM:
         ext_impls = extension.get_instruction_implementations()
         if not isinstance(ext_impls, list):
             raise TypeError(f"Expected list of instruction implementations, got {type(ext_impls)}")
+        self.extensions.append(extension)
         self.instruction_implementations.extend(ext_impls)
+        self.flush_decode_cache()
+
+    def snapshot_extensions(self) -> list[object | None]:
+        """
+        Returns a copy of the state every loaded extension keeps outside of RVState,
+        None for extensions that keep none.
+        """
+        return [extension.snapshot() for extension in self.extensions]
+
+    def restore_extensions(self, snapshots: list[object | None]) -> None:
+        """
+        Restores copies returned by snapshot_extensions().
+        """
+        for extension, snapshot in zip(self.extensions, snapshots):
+            if snapshot is not None:
+                extension.restore(snapshot)
+
+    def reset_extensions(self) -> None:
+        """
+        Resets the state the loaded extensions keep outside of RVState.
+        """
+        for extension in self.extensions:
+            extension.reset()
+
+    def flush_decode_cache(self) -> None:
+        """
+        Discards all decoded blocks.
+        Must be called after instruction_implementations is modified.
+        """
+        self.blocks.clear()
+        self.back_edges.clear()
+        self.state.code.fill(False)
+        self.state.code_words.clear()
+        self.state.code_modified = False
+
+    def add_intercept(self, address: int, handler: Callable[[RVState], None]) -> None:
+        """
+        Runs a host function instead of the guest instruction whenever the
+        program counter reaches the given address. The handler is responsible
+        for updating the state, including the program counter.
+
+        Parameters:
+            address (int): The guest address to intercept.
+            handler (Callable[[RVState], None]): The host function to run.
+        """
+        self.intercepts[int(address)] = handler
+        self.flush_decode_cache()
+
+    def remove_intercept(self, address: int) -> None:
+        """
+        Removes the intercept at the given address.
+        Parameters:
+            address (int): The guest address of the intercept.
+        """
+        self.intercepts.pop(int(address), None)
+        self.flush_decode_cache()
+
+    def add_breakpoint(self, address: int) -> None:
+        """
+        Stops run() whenever the program counter reaches the given address,
+        before the instruction there is executed. run() then returns
+        engine.BREAKPOINT. A run that starts at a breakpoint steps over it,
+        so that a stopped run can be continued.
+
+        Parameters:
+            address (int): The guest address of the breakpoint.
+        """
+        self.breakpoints.add(int(address))
+        self.flush_decode_cache()
+
+    def remove_breakpoint(self, address: int) -> None:
+        """
+        Removes the breakpoint at the given address.
+        Parameters:
+            address (int): The guest address of the breakpoint.
+        """
+        self.breakpoints.discard(int(address))
+        self.flush_decode_cache()
+
+    def add_hook(self, event: str, callback: Callable[[np.ndarray], None], batch_size: int = 1) -> "Hook":
+        """
+        Calls a function for events during runs: memory reads and writes,
+        branches, jumps, system calls and halts. The events are passed as
+        NumPy record arrays of up to batch_size events, whenever a batch is
+        full and at the end of every run. Only the instructions of hooked
+        events are instrumented, and only while a hook is registered.
+        Callbacks run in the middle of a run and must not modify the state.
+
+        Parameters:
+            event (str): One of the events in hooks.EVENTS, e.g. hooks.READ.
+            callback (Callable[[np.ndarray], None]): Receives the events as a record array of hooks.EVENTS[event].
+            batch_size (int): Maximum number of events per call, 1 to call it for every event.
+        Returns:
+            Hook: The hook, to remove it with remove_hook().
+        Raises:
+            ValueError: If the event is unknown or the batch size is not positive.
+        """
+        from hooks import Hook, Hooks, EVENTS
+        if event not in EVENTS:
+            raise ValueError(f"Unknown event '{event}', expected one of {', '.join(EVENTS)}")
+        if batch_size <= 0:
+            raise ValueError(f"Batch size must be positive, got {batch_size}")
+        if self.hooks is None:
+            self.hooks = Hooks(self)
+        hook = Hook(event, callback, batch_size)
+        self.hooks.add(hook)
+        return hook
+
+    def remove_hook(self, hook: "Hook") -> None:
+        """
+        Passes the remaining events of a hook to its callback and removes it.
+        Parameters:
+            hook (Hook): The hook returned by add_hook().
+        """
+        if self.hooks is None:
+            return
+        self.hooks.remove(hook)
+        if self.hooks.empty():
+            self.hooks = None
 
-    def load_memory(self, address: int, data: np.ndarray[u32]) -> None:
+    def load_memory(self, address: int, data) -> None:
         """
-        Loads data into memory at a specified address.
+        Loads data into memory at a specified address, without an intermediate copy.
 
         Parameters:
             address (int): The starting address in memory.
-            data (np.ndarray[u32]): The data to load into memory.
+            data: The data to load: a NumPy array of any type, bytes, memoryview, mmap
+                or any other object that supports the buffer protocol.
         """
-        if not isinstance(data, np.ndarray) or data.dtype != u32:
-            raise TypeError(f"Data must be a numpy array of type u32, got {type(data)}")
-        if address < 0 or address + len(data) * 4 > len(self.state.mem):
-            raise ValueError(f"Memory access out of bounds: {address} + {len(data) * 4} exceeds memory size")
-        
-        self.state.mem[address:address + len(data) * 4] = data.tobytes()
+        source = as_bytes(data)
+        if address < 0 or address + source.size > len(self.state.mem):
+            raise ValueError(f"Memory access out of bounds: {address} + {source.size} exceeds memory size")
+        self.state.load_memory(address, source)
+
+    def view(self, address: int, dtype, shape: int | tuple[int, ...], writable: bool = True) -> np.ndarray:
+        """
+        Returns a NumPy array that shares its data with guest memory, see RVState.view().
+
+        Parameters:
+            address (int): Address of the first element.
+            dtype: Type of the elements, e.g. np.int32 or "<f4".
+            shape (int | tuple[int, ...]): Shape of the array.
+            writable (bool): Whether the host may write through the view.
+        Returns:
+            np.ndarray: The view.
+        """
+        return self.state.view(address, dtype, shape, writable)
 
     def reset(self) -> None:
         """
         Resets the VM to its initial state.
         """
         self.state.reset()
+        self.reset_extensions()
+        self.flush_decode_cache()
 
     def match_impl(self, instruction: Instruction) -> InstructionImpl | None:
         """
@@ -110,8 +368,15 @@ class VM:
         if self.state.halt:
             return # If the VM is halted, do nothing
         
-        # Fetch the instruction from memory as little-endian
+        # Run the host handler if the guest code at this address is intercepted
         pc = self.state.pc
+        if self.intercepts and int(pc) in self.intercepts:
+            self.intercepts[int(pc)](self.state)
+            self.state.rf[0] = 0
+            self.state.instret += 1
+            return
+
+        # Fetch the instruction from memory as little-endian
         instruction_word = np.frombuffer(self.state.mem[pc:pc + 4], dtype=u32)[0]
         instruction = Instruction(instruction_word)
         
@@ -119,19 +384,270 @@ class VM:
         impl = self.match_impl(instruction)
         if impl is None:
             raise ValueError(f"No matching instruction implementation for {instruction}")
-        impl.execute(self.state, instruction)
+        try:
+            impl.execute(self.state, instruction)
+        except Stop:
+            # The instruction completed before the run was stopped
+            self.state.rf[0] = 0
+            self.state.instret += 1
+            if self.coverage is not None:
+                self.coverage.mark(int(pc), int(pc) + 4, int(self.state.pc))
+            raise
 
         # Ensure x0 register is always zero
         self.state.rf[0] = 0
+        self.state.instret += 1
+        if self.coverage is not None:
+            self.coverage.mark(int(pc), int(pc) + 4, int(self.state.pc))
 
-    def run(self, n_steps: int = -1) -> None:
+    def decode_block(self, pc: int) -> Block:
         """
-        Runs the VM for a specified number of steps.
+        Decodes the block starting at the given address and caches it.
+
+        A block ends after a branch, jump or system instruction, or after
+        MAX_BLOCK_LENGTH instructions. System instructions (ECALL, EBREAK and
+        CSR accesses) always form a block of their own, so that they observe
+        an exact retired instruction counter. Unknown instructions,
+        intercepted addresses and breakpoints also end the block before them.
+        Blocks at breakpoints are not cached, so that the engine checks the
+        breakpoint whenever the block is entered.
+
+        Common pairs of adjacent instructions are fused into one entry. Since
+        a block is only entered at its start, a jump to the second instruction
+        of a pair decodes a separate block from there, which runs it unfused.
+
+        Parameters:
+            pc (int): Address of the first instruction.
+        Returns:
+            Block: The decoded block. It is empty if the first instruction is unknown.
+        """
+        mem = self.state.mem
+        instructions = []
+        impls = []
+        address = pc
+        while len(instructions) < MAX_BLOCK_LENGTH and address + 4 <= mem.size:
+            if instructions and (address in self.intercepts or address in self.breakpoints):
+                break
+            instruction = Instruction(np.frombuffer(mem[address:address + 4], dtype=u32)[0])
+            opcode = int(instruction.opcode)
+            if instructions and opcode == SYSTEM_OPCODE:
+                break
+            impl = self.match_impl(instruction)
+            if impl is None:
+                break
+            instructions.append(instruction)
+            impls.append(impl)
+            address += 4
+            if opcode in BLOCK_ENDING_OPCODES:
+                break
+
+        entries = []
+        i = 0
+        while i < len(instructions):
+            instruction, impl = instructions[i], impls[i]
+            if self.fusion and i + 1 < len(instructions):
+                fused = fuse(pc + 4 * i, impl, instruction, impls[i + 1], instructions[i + 1])
+                if fused is not None:
+                    name, execute = fused
+                    self.fusions[name] = self.fusions.get(name, 0) + 1
+                    entries.append((execute, instruction))
+                    i += 2
+                    continue
+            execute = impl.execute if instruction.rd != 0 else clear_x0(impl.execute)
+            entries.append((execute, instruction))
+            i += 1
+
+        block = Block(pc, entries, len(instructions))
+        if entries:
+            block.loop = SpinLoop.analyze(pc, instructions, impls)
+            if pc not in self.breakpoints:
+                self.blocks[pc] = block
+            self.mark_code(pc, address)
+        return block
+
+    def run(self, n_steps: int = -1, timeout: float | None = None) -> RunResult:
+        """
+        Runs the VM for a specified number of steps with its engine.
+
+        The step budget is checked by the engine at block boundaries. The
+        wall-clock budget is checked every WATCHDOG_INTERVAL instructions,
+        so a run may exceed it by the time of one interval. Guest faults end
+        the run instead of raising: an unknown or unsupported instruction,
+        and an access or instruction fetch outside of memory.
 
         Parameters:
             n_steps (int): Number of steps to execute. If -1, runs indefinitely until halted.
+            timeout (float | None): Maximum wall-clock duration of the run in seconds, None for no limit.
+        Returns:
+            RunResult: The reason the run ended, which compares equal to it, with the retired
+                instructions and the elapsed time. The reason is engine.HALTED or engine.EBREAK if the
+                guest halted, engine.BUDGET or engine.TIMEOUT if a budget was used up,
+                engine.ILLEGAL_INSTRUCTION or engine.ACCESS_FAULT, engine.IDLE if the block engine
+                finds an idle loop without an idle handler or budget, engine.DIVERGED for the lockstep
+                engine, or the reason of a Stop raised by an instruction or engine, like
+                engine.WATCHPOINT or engine.BREAKPOINT.
         """
-        steps = 0
-        while not self.state.halt and (n_steps == -1 or steps < n_steps):
-            self.step()
-            steps += 1
+        state = self.state
+        instret = state.instret
+        started = time.perf_counter()
+        error = None
+        try:
+            if self.breakpoints and n_steps != 0 and not state.halt and int(state.pc) in self.breakpoints:
+                # Step over the breakpoint the run starts at
+                self.step()
+                if n_steps > 0:
+                    n_steps -= 1
+            if timeout is None:
+                reason = self.engine.run(self, n_steps)
+            else:
+                reason = self._run_until(n_steps, started + timeout)
+        except Stop as stop:
+            self.state.rf[0] = 0
+            reason = stop.reason
+        except IndexError as e:
+            reason, error = ACCESS_FAULT, e
+        except (ValueError, NotImplementedError) as e:
+            reason = self._fault(e)
+            error = e
+        finally:
+            if self.hooks is not None:
+                self.hooks.end_run(state.halt and state.instret != instret)
+
+        return self._result(reason, instret, started, error)
+
+    def _result(self, reason: str, instret: int, started: float, error: Exception | None = None) -> RunResult:
+        """
+        Returns the result of a run that started at the given retired instruction count and time,
+        telling a halt by EBREAK apart from other halts.
+        """
+        state = self.state
+        exit_code = None
+        if reason == HALTED:
+            pc = int(state.pc)
+            if pc + 4 <= state.mem.size and int(np.frombuffer(state.mem[pc:pc + 4], dtype=u32)[0]) == EBREAK_WORD:
+                reason = EBREAK
+            exit_code = int(state.rf[10])
+        return RunResult(reason, state.instret, state.instret - instret, time.perf_counter() - started,
+                         exit_code, error)
+
+    def _run_until(self, n_steps: int, deadline: float) -> str:
+        """
+        Runs the engine in intervals of WATCHDOG_INTERVAL instructions until the deadline.
+        """
+        state = self.state
+        remaining = n_steps
+        while True:
+            steps = WATCHDOG_INTERVAL if remaining < 0 else min(WATCHDOG_INTERVAL, remaining)
+            instret = state.instret
+            reason = self.engine.run(self, steps)
+            if remaining >= 0:
+                remaining -= state.instret - instret
+            if reason != BUDGET or remaining == 0:
+                return reason
+            if time.perf_counter() >= deadline:
+                return TIMEOUT
+
+    def _fault(self, error: ValueError | NotImplementedError) -> str:
+        """
+        Returns the reason for a guest fault, or raises the error again if it is not caused by the guest.
+        """
+        pc = int(self.state.pc)
+        if pc + 4 > self.state.mem.size:
+            return ACCESS_FAULT
+        if isinstance(error, NotImplementedError):
+            # Implementations raise NotImplementedError for illegal uses, like a write to a read-only CSR
+            return ILLEGAL_INSTRUCTION
+        # Other errors than an unknown instruction, like ambiguous implementations, are errors of the host
+        instruction = Instruction(np.frombuffer(self.state.mem[pc:pc + 4], dtype=u32)[0])
+        if self.match_impl(instruction) is not None:
+            raise error
+        return ILLEGAL_INSTRUCTION
+
+    def compile_loop(self, start: int, end: int) -> None:
+        """
+        Compiles a hot loop into a region that is run whenever its header is reached.
+
+        Parameters:
+            start (int): Address of the loop header.
+            end (int): Address after the instruction that jumps back to the header.
+        """
+        header = self.blocks.get(start)
+        if header is None or header.loop is not None or end - start > 4 * MAX_REGION_LENGTH:
+            return
+        if any(start <= address < end for address in (*self.intercepts, *self.breakpoints)):
+            return
+        mark = self.coverage.mark if self.coverage is not None else None
+        region = compile_region(start, end, self.state, self.match_impl, mark)
+        if region is not None:
+            header.region = region
+            self.mark_code(start, end)
+
+    def mark_code(self, start: int, end: int) -> None:
+        """
+        Records that the instructions in a memory range were decoded,
+        so that writes to them flush the decode cache.
+        """
+        self.state.code[start >> PAGE_SHIFT:((end - 1) >> PAGE_SHIFT) + 1] = True
+        self.state.code_words.update(range(start >> 2, end >> 2))
+
+    def fast_forward(self, block: Block, before: np.ndarray, remaining: int) -> int:
+        """
+        Skips the remaining iterations of a loop block that just jumped back to its start.
+
+        An idle loop, which left all registers unchanged, is handed to the idle
+        handler, which may wait for the memory the guest polls to change. Without
+        a handler, the step budget is consumed. A counted loop jumps straight to
+        its exit with the counter set to its final value. The retired instruction
+        counter advances as if every skipped iteration had executed.
+
+        Parameters:
+            block (Block): The loop block.
+            before (np.ndarray): The register file before the last iteration.
+            remaining (int): The remaining steps of the run, negative if unlimited.
+        Returns:
+            int: The remaining steps after fast-forwarding.
+        Raises:
+            Stop: With engine.IDLE if an idle loop can never exit and the run is unlimited.
+        """
+        state = self.state
+        loop = block.loop
+        changed = np.flatnonzero(state.rf != before)
+
+        if changed.size == 0:
+            if self.idle_handler is not None:
+                self.idle_handler(state)
+                return remaining
+            if remaining < 0:
+                raise Stop(IDLE)
+            iterations = remaining // loop.length
+            state.instret += iterations * loop.length
+            return remaining - iterations * loop.length
+
+        counter = loop.counter
+        if counter is None or changed.size != 1 or changed[0] != counter \
+           or (int(state.rf[counter]) - int(before[counter]) - loop.step) & 0xFFFFFFFF:
+            # Some register other than the counter changed, retry a few times for loops
+            # that reach a fixed point after their first iterations
+            loop.checks -= 1
+            if loop.checks == 0:
+                block.loop = None
+            return remaining
+
+        iterations = loop.exit_iterations(int(state.rf[counter]), int(state.rf[loop.other]))
+        budget = remaining // loop.length if remaining >= 0 else None
+        if iterations is None and budget is None:
+            # The loop only ends by wrapping around, so execute it normally
+            block.loop = None
+            return remaining
+        exits = budget is None or (iterations is not None and iterations <= budget)
+        if not exits:
+            iterations = budget
+
+        state.rf[counter] = signed32(int(state.rf[counter]) + iterations * loop.step)
+        state.instret += iterations * loop.length
+        if exits:
+            state.pc = u32(loop.exit)
+            if self.coverage is not None:
+                # The last iteration falls through the branch at the end of the loop
+                self.coverage.mark(block.start, loop.exit, loop.exit)
+        return remaining - iterations * loop.length if remaining >= 0 else remaining
@@ -0,0 +1,212 @@
+# Author: Elias Oelschner
+#
+# This file is part of my project for the bachelor's seminar "Moderne Hardware" at Heinrich-Heine-Universität Düsseldorf.
+# It is released under the GNU General Public License v3.0.
+from extensions import rv32i
+from engine import Stop, WATCHPOINT
+from instruction import Instruction
+from instruction_impl import InstructionImpl, ImplWrapper, unwrap
+from state import RVState, PAGE_SHIFT
+from vm import VM
+
+# Kinds of watchpoints, like watch, rwatch and awatch in GDB
+READ   = "read"
+WRITE  = "write"
+ACCESS = "access"
+
+# Access size in bytes of the scalar loads and stores
+SIZES = {
+    rv32i.Lb: 1, rv32i.Lbu: 1, rv32i.Lh: 2, rv32i.Lhu: 2, rv32i.Lw: 4,
+    rv32i.Sb: 1, rv32i.Sh: 2, rv32i.Sw: 4,
+}
+
+class Watchpoint:
+    """
+    A watched memory range.
+
+    Attributes:
+        address (int): Address of the first watched byte.
+        size (int): Number of watched bytes.
+        kind (str): READ, WRITE or ACCESS for both.
+    """
+    address: int
+    size:    int
+    kind:    str
+
+    def __init__(self, address: int, size: int, kind: str) -> None:
+        self.address = address
+        self.size = size
+        self.kind = kind
+
+    def overlaps(self, address: int, size: int) -> bool:
+        return address < self.address + self.size and self.address < address + size
+
+    def __repr__(self) -> str:
+        return f"Watchpoint(address={self.address:#010x}, size={self.size}, kind={self.kind!r})"
+
+class WatchHit:
+    """
+    An access to a watched memory range, which stopped the run.
+
+    Attributes:
+        watchpoint (Watchpoint): The watchpoint that was hit.
+        pc (int): Address of the accessing instruction.
+        address (int): Address of the access.
+        kind (str): READ or WRITE.
+        old (int): Value of the watched range before the access, little-endian.
+        new (int): Value of the watched range after the access, equal to old for reads.
+    """
+    watchpoint: Watchpoint
+    pc:         int
+    address:    int
+    kind:       str
+    old:        int
+    new:        int
+
+    def __init__(self, watchpoint: Watchpoint, pc: int, address: int, kind: str, old: int, new: int) -> None:
+        self.watchpoint = watchpoint
+        self.pc = pc
+        self.address = address
+        self.kind = kind
+        self.old = old
+        self.new = new
+
+    def __repr__(self) -> str:
+        return (f"WatchHit(pc={self.pc:#010x}, address={self.watchpoint.address:#010x}, kind={self.kind!r}, "
+                f"old={self.old:#x}, new={self.new:#x})")
+
+class WatchedAccess(ImplWrapper):
+    """
+    Checks the accesses of a load or store against the watchpoints.
+
+    The fast path only tests the watched flag of the accessed pages. The
+    watchpoints are only compared on watched pages, and the old value is
+    only read there. Compiled loops inline the same test and only call the
+    wrapper for accesses to watched pages.
+
+    Attributes:
+        guard_pages (bytearray): The watched page flags, shared with the watcher.
+    """
+
+    def __init__(self, impl: InstructionImpl, watcher: "Watcher", kind: str, size: int) -> None:
+        super().__init__(impl)
+        self.watcher = watcher
+        self.kind = kind
+        self.size = size
+        self.guard_pages = watcher.pages
+
+    def execute(self, state: RVState, instruction: Instruction) -> None:
+        imm = instruction.imm_i if self.kind == READ else instruction.imm_s
+        address = (int(state.rf[instruction.rs1]) + int(imm)) & 0xFFFFFFFF
+        pages = self.guard_pages
+        if not pages[address >> PAGE_SHIFT] and not pages[((address + self.size - 1) & 0xFFFFFFFF) >> PAGE_SHIFT]:
+            self.impl.execute(state, instruction)
+            return
+
+        watchpoints = self.watcher.matching(address, self.size, self.kind)
+        if not watchpoints:
+            self.impl.execute(state, instruction)
+            return
+        pc = int(state.pc)
+        watchpoint = watchpoints[0]
+        old = read(state, watchpoint)
+        self.impl.execute(state, instruction)
+        self.watcher.hit = WatchHit(watchpoint, pc, address, self.kind, old, read(state, watchpoint))
+        raise Stop(WATCHPOINT)
+
+def read(state: RVState, watchpoint: Watchpoint) -> int:
+    """
+    Reads the value of a watched range as a little-endian integer.
+    """
+    return int.from_bytes(state.mem[watchpoint.address:watchpoint.address + watchpoint.size].tobytes(), "little")
+
+class Watcher:
+    """
+    Stops VM.run() when a watched memory range is accessed.
+
+    A bitmap holds one flag per page of the 32-bit address space, set while
+    a watchpoint covers the page. Every load and store only tests the flags
+    of its pages, and only accesses to watched pages are compared with the
+    watchpoints. When one matches, the access completes and run() returns
+    WATCHPOINT, with the details in hit.
+
+    Only the scalar loads and stores of RV32I are watched.
+
+    Attributes:
+        vm (VM): The watched VM.
+        watchpoints (list[Watchpoint]): The active watchpoints.
+        pages (bytearray): Watched flag of every page.
+        hit (WatchHit | None): The access that stopped the last run.
+    """
+    vm:          VM
+    watchpoints: list[Watchpoint]
+    pages:       bytearray
+    hit:         WatchHit | None
+
+    def __init__(self, vm: VM) -> None:
+        """
+        Initializes the watcher and instruments the VM.
+        """
+        self.vm = vm
+        self.watchpoints = []
+        self.pages = bytearray(1 << (32 - PAGE_SHIFT))
+        self.hit = None
+
+        impls = vm.instruction_implementations
+        self._original = list(impls)
+        for i, impl in enumerate(impls):
+            base = unwrap(impl)
+            if type(base) in SIZES:
+                kind = READ if isinstance(base, rv32i.LOADS) else WRITE
+                impls[i] = WatchedAccess(impl, self, kind, SIZES[type(base)])
+        vm.flush_decode_cache()
+
+    def watch(self, address: int, size: int = 4, kind: str = WRITE) -> Watchpoint:
+        """
+        Adds a watchpoint.
+
+        Parameters:
+            address (int): Address of the first watched byte.
+            size (int): Number of watched bytes.
+            kind (str): READ, WRITE or ACCESS.
+        Returns:
+            Watchpoint: The new watchpoint.
+        Raises:
+            ValueError: If the kind is unknown or the range is not within memory.
+        """
+        if kind not in (READ, WRITE, ACCESS):
+            raise ValueError(f"Unknown watchpoint kind '{kind}', expected {READ}, {WRITE} or {ACCESS}")
+        if size <= 0 or address < 0 or address + size > self.vm.state.mem.size:
+            raise ValueError(f"Watched range {address:#x} + {size} is not within memory")
+        watchpoint = Watchpoint(address, size, kind)
+        self.watchpoints.append(watchpoint)
+        self._update_pages()
+        return watchpoint
+
+    def unwatch(self, watchpoint: Watchpoint) -> None:
+        """
+        Removes a watchpoint.
+        """
+        self.watchpoints.remove(watchpoint)
+        self._update_pages()
+
+    def matching(self, address: int, size: int, kind: str) -> list[Watchpoint]:
+        """
+        Returns the watchpoints that an access of the given kind triggers.
+        """
+        return [watchpoint for watchpoint in self.watchpoints
+                if watchpoint.kind in (kind, ACCESS) and watchpoint.overlaps(address, size)]
+
+    def detach(self) -> None:
+        """
+        Removes the instrumentation from the VM.
+        """
+        self.vm.instruction_implementations[:] = self._original
+        self.vm.flush_decode_cache()
+
+    def _update_pages(self) -> None:
+        self.pages[:] = bytes(len(self.pages))
+        for watchpoint in self.watchpoints:
+            first = watchpoint.address >> PAGE_SHIFT
+            last = (watchpoint.address + watchpoint.size - 1) >> PAGE_SHIFT
+            self.pages[first:last + 1] = b"\x01" * (last - first + 1)